@@ -0,0 +1,48 @@
+#!/usr/bin/python
+"""
+Benchmark of the multiplexed A2S_INFO probe against local fake servers.
+
+Usage: python bench/bench_a2s.py [servers] [drop] [cycles]
+"""
+
+import asyncio
+import os
+import resource
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, os.path.join(BENCH_DIR, "..", "operator"))
+
+import fake_a2s
+import modules.a2s as a2s
+
+def main():
+    servers = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    drop = float(sys.argv[2]) if len(sys.argv) > 2 else 0.0
+    cycles = int(sys.argv[3]) if len(sys.argv) > 3 else 3
+
+    # One socket per fake server
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (min(hard, max(soft, servers + 256)), hard))
+
+    addresses, state = fake_a2s.serve(servers, challenge=True, drop=drop)
+    endpoints = {f"server-{index}": address for index, address in enumerate(addresses)}
+
+    for cycle in range(cycles):
+        start = time.perf_counter()
+        results = asyncio.run(a2s.query_endpoints(endpoints, timeout=0.5 if drop else 2.0))
+        elapsed = time.perf_counter() - start
+
+        answered = [rtt for info, rtt in results.values() if info is not None]
+        answered.sort()
+        median = answered[len(answered) // 2] * 1000 if answered else 0.0
+
+        print(f"cycle={cycle} servers={servers} answered={len(answered)} seconds={elapsed:.3f} "
+              f"servers_per_second={servers / elapsed:.0f} median_rtt={median:.2f}ms")
+
+    print(f"stats={a2s.a2s_stats} fake_queries={state.queries} fake_challenges={state.challenges}")
+
+if __name__ == "__main__":
+    main()
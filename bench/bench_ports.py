@@ -0,0 +1,35 @@
+#!/usr/bin/python
+"""
+Benchmark of the port allocator at a given occupancy.
+
+Usage: python bench/bench_ports.py [occupancy] [allocations]
+"""
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "operator"))
+
+import modules.ports as ports
+
+def main():
+    occupancy = float(sys.argv[1]) if len(sys.argv) > 1 else 0.9
+    allocations = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+
+    size = ports.PORT_MAX - ports.PORT_MIN + 1
+    taken = random.sample(range(ports.PORT_MIN, ports.PORT_MAX + 1), int(size * occupancy))
+    ports.seed(taken)
+
+    # Allocate and release again to stay at the requested occupancy
+    start = time.perf_counter()
+    for _ in range(allocations):
+        ports.release(ports.allocate())
+    elapsed = time.perf_counter() - start
+
+    print(f"occupancy={ports.occupancy():.2%} allocations={allocations} "
+          f"per_allocation={elapsed / allocations * 1e6:.2f}us")
+
+if __name__ == "__main__":
+    main()
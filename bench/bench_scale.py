@@ -0,0 +1,325 @@
+#!/usr/bin/python
+"""
+Scale benchmark of the operator against a local fake kube-apiserver and a fake UniFi controller.
+
+Loads N PrismServers, runs the real handlers of main.py and the forwarder against the fakes
+and writes a machine-readable report (API calls by verb and kind, latency percentiles,
+CPU time, RSS and thread count) per phase.
+
+Requires the operator's dependencies (operator/requirements.txt).
+
+Usage: python bench/bench_scale.py --servers 1000 --kube-latency 2 --unifi-latency 5 --output bench_output.json
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+OPERATOR_DIR = os.path.join(BENCH_DIR, "..", "operator")
+
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, OPERATOR_DIR)
+
+import fake_kube
+import fake_unifi
+
+NAMESPACE = "prism-servers"
+
+#  ------------------------
+#           FAKES
+#  ------------------------
+def run_fakes(kube_latency, unifi_latency, ports_queue):
+    """ Serve both fakes from a separate process, so they do not skew the operator's CPU and RSS """
+
+    kube_server, _ = fake_kube.serve(latency=kube_latency)
+    unifi_server, _ = fake_unifi.serve(latency=unifi_latency)
+
+    ports_queue.put((kube_server.server_address[1], unifi_server.server_address[1]))
+
+    threading.Event().wait()
+
+def http_json(url, method="GET", body=None):
+    data = json.dumps(body).encode() if body is not None else None
+    request = urllib.request.Request(url, data=data, method=method, headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read())
+
+def write_kubeconfig(kube_port):
+    kubeconfig = {
+        "apiVersion": "v1",
+        "kind": "Config",
+        "clusters": [{"name": "bench", "cluster": {"server": f"http://127.0.0.1:{kube_port}"}}],
+        "users": [{"name": "bench", "user": {"token": "bench"}}],
+        "contexts": [{"name": "bench", "context": {"cluster": "bench", "user": "bench", "namespace": NAMESPACE}}],
+        "current-context": "bench"
+    }
+
+    handle, path = tempfile.mkstemp(prefix="bench-kubeconfig-", suffix=".json")
+    with os.fdopen(handle, "w") as kubeconfig_file:
+        json.dump(kubeconfig, kubeconfig_file)
+
+    return path
+
+#  ------------------------
+#         REPORTING
+#  ------------------------
+def percentiles(samples):
+    if not samples:
+        return {}
+
+    ordered = sorted(samples)
+
+    def pick(fraction):
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+    return {
+        "count": len(ordered),
+        "p50": pick(0.50),
+        "p90": pick(0.90),
+        "p99": pick(0.99),
+        "max": ordered[-1],
+        "mean": sum(ordered) / len(ordered)
+    }
+
+def current_rss_mb():
+    try:
+        with open("/proc/self/status") as status_file:
+            for line in status_file:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+
+    return None
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=BENCH_DIR, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+class Phase:
+    """ Measures one phase of the benchmark """
+
+    def __init__(self, name, report, kube_url, unifi_url):
+        self.name = name
+        self.report = report
+        self.kube_url = kube_url
+        self.unifi_url = unifi_url
+        self.latencies = []
+
+    def __enter__(self):
+        http_json(f"{self.kube_url}/_stats", "POST", {})
+        http_json(f"{self.unifi_url}/_stats", "POST", {})
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+        return self
+
+    def timed(self, function, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            self.latencies.append(time.perf_counter() - start)
+
+    async def timed_async(self, coroutine):
+        start = time.perf_counter()
+        try:
+            return await coroutine
+        finally:
+            self.latencies.append(time.perf_counter() - start)
+
+    def __exit__(self, *exc):
+        wall = time.perf_counter() - self.wall
+        kube_calls = http_json(f"{self.kube_url}/_stats")["calls"]
+        unifi_calls = http_json(f"{self.unifi_url}/_stats")["calls"]
+
+        self.report["phases"][self.name] = {
+            "seconds": wall,
+            "cpu_seconds": time.process_time() - self.cpu,
+            "latency_seconds": percentiles(self.latencies),
+            "kube_calls": kube_calls,
+            "kube_calls_per_second": {key: count / wall for key, count in kube_calls.items()},
+            "unifi_calls": unifi_calls,
+            "unifi_calls_per_second": {key: count / wall for key, count in unifi_calls.items()},
+            "rss_mb": current_rss_mb(),
+            "threads": threading.active_count()
+        }
+
+        print(f"{self.name:<12} {wall:8.2f}s  kube={sum(kube_calls.values()):<6} unifi={sum(unifi_calls.values()):<6} "
+              f"p50={percentiles(self.latencies).get('p50', 0) * 1000:.1f}ms")
+
+#  ------------------------
+#           BENCH
+#  ------------------------
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--servers", type=int, default=100, help="Number of PrismServers")
+    parser.add_argument("--kube-latency", type=float, default=0.0, help="Added latency of the fake apiserver in ms")
+    parser.add_argument("--unifi-latency", type=float, default=0.0, help="Added latency of the fake UDM in ms")
+    parser.add_argument("--resyncs", type=int, default=3, help="Number of full forwarder resyncs to measure")
+    parser.add_argument("--probe-cycles", type=int, default=3, help="Number of probe cycles to measure")
+    parser.add_argument("--output", default="bench_output.json", help="Report file")
+    args = parser.parse_args()
+
+    ports_queue = multiprocessing.Queue()
+    fakes = multiprocessing.Process(target=run_fakes, args=(args.kube_latency / 1000, args.unifi_latency / 1000, ports_queue), daemon=True)
+    fakes.start()
+    kube_port, unifi_port = ports_queue.get(timeout=10)
+
+    kube_url = f"http://127.0.0.1:{kube_port}"
+    unifi_url = f"http://127.0.0.1:{unifi_port}"
+
+    os.environ["KUBECONFIG"] = write_kubeconfig(kube_port)
+    os.environ["UNIFI_API_HOST"] = f"127.0.0.1:{unifi_port}"
+    os.environ["UNIFI_API_SCHEME"] = "http"
+    os.environ["UNIFI_API_USER"] = "bench"
+    os.environ["UNIFI_API_PASS"] = "bench"
+    os.environ.setdefault("PATCH_WINDOW", "0.05")
+    # Measure the operator rather than the configured rate limits, export KUBE_RATE or UNIFI_RATE to include them
+    os.environ.setdefault("KUBE_RATE", "0")
+    os.environ.setdefault("UNIFI_RATE", "0")
+
+    logging.basicConfig(level=logging.WARNING)
+    logger = logging.getLogger("bench")
+
+    # Imported late, modules read their settings from the environment
+    import kopf
+    import main as operator_main
+    import modules.forwarder as forwarder
+    import modules.patch_queue as patch_queue
+    import modules.service_index as service_index
+    import modules.tcp_probe as probe
+    import modules.unifi as unifi
+    import modules.utils as utils
+
+    # Outside of kopf there is no handler context to take the owner from
+    adopt = kopf.adopt
+    owners = threading.local()
+    kopf.adopt = lambda objs, owner=None, **kwargs: adopt(objs, owner=owner or owners.body, **kwargs)
+
+    report = {
+        "commit": git_commit(),
+        "time": int(time.time()),
+        "servers": args.servers,
+        "kube_latency_ms": args.kube_latency,
+        "unifi_latency_ms": args.unifi_latency,
+        "phases": {}
+    }
+
+    # One event loop for everything that runs in kopf's loop in production
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    run = loop.run_until_complete
+    forwarder_tasks = [loop.create_task(forwarder.run_deletions(logger))]
+
+    try:
+        cpu_start = time.process_time()
+        prismservers_url = f"{kube_url}/apis/prism-hosting.ch/v1/namespaces/{NAMESPACE}/prismservers"
+
+        # --- Create ---
+        bodies = []
+        for index in range(args.servers):
+            bodies.append(http_json(prismservers_url, "POST", {
+                "apiVersion": "prism-hosting.ch/v1",
+                "kind": "PrismServer",
+                "metadata": {"name": f"bench-{index}", "namespace": NAMESPACE},
+                "spec": {
+                    "customer": f"cust-{index % 25}",
+                    "subscriptionStart": 1683139792,
+                    "env": [{"name": "CSGO_GSLT", "value": "bench"}, {"name": "SERVER_CONFIGS", "value": "False"}]
+                }
+            }))
+
+        with Phase("create", report, kube_url, unifi_url) as phase:
+            for body in bodies:
+                owners.body = body
+                phase.timed(operator_main.create, spec=body["spec"], meta=body["metadata"], body=body, status={}, logger=logger)
+
+            patch_queue.flush()
+
+        # --- Watch events, as kopf would deliver them ---
+        services = http_json(f"{kube_url}/api/v1/namespaces/{NAMESPACE}/services")["items"]
+        prismservers = http_json(prismservers_url)["items"]
+
+        with Phase("index", report, kube_url, unifi_url) as phase:
+            for service in services:
+                phase.timed(service_index.apply_event, "ADDED", service)
+            for prismserver in prismservers:
+                phase.timed(probe.track_target, "ADDED", prismserver["metadata"], prismserver.get("status") or {})
+                phase.timed(patch_queue.observe, prismserver["metadata"]["name"], prismserver)
+
+        # --- Forwarder ---
+        with Phase("forward", report, kube_url, unifi_url) as phase:
+            phase.timed(run, forwarder.reconcile_services([service["metadata"]["labels"]["custObjUuid"] for service in services]))
+            patch_queue.flush()
+
+        with Phase("resync", report, kube_url, unifi_url) as phase:
+            for _ in range(args.resyncs):
+                phase.timed(run, forwarder.supervise_ips())
+            patch_queue.flush()
+
+        # --- Probes ---
+        with Phase("probe", report, kube_url, unifi_url) as phase:
+            for _ in range(args.probe_cycles):
+                # Probe every server in every cycle, regardless of its adaptive interval
+                for obj_uuid in list(probe.probe_targets):
+                    probe.expedite(obj_uuid)
+
+                phase.timed(run, probe.run_probe_cycle(logger))
+            patch_queue.flush()
+
+        # --- Delete ---
+        prismservers = http_json(prismservers_url)["items"]
+
+        async def delete(prismserver):
+            try:
+                await operator_main.clean_port_forward(spec=prismserver["spec"], meta=prismserver["metadata"],
+                                                       status=prismserver.get("status") or {}, logger=logger)
+            except Exception as e:
+                logger.warning(f"clean_port_forward(): {str(e)}")
+
+        # Deleted concurrently, like kopf does on a bulk delete
+        with Phase("delete", report, kube_url, unifi_url) as phase:
+            run(asyncio.gather(*(phase.timed_async(delete(prismserver)) for prismserver in prismservers)))
+    finally:
+        # Also on failure, so the UDM session does not leak
+        for task in forwarder_tasks:
+            task.cancel()
+        run(asyncio.gather(*forwarder_tasks, return_exceptions=True))
+        run(unifi.close())
+        patch_queue.stop_worker()
+
+        fakes.terminate()
+        os.unlink(os.environ["KUBECONFIG"])
+
+    report["process"] = {
+        "cpu_seconds": time.process_time() - cpu_start,
+        "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "threads": threading.active_count()
+    }
+    report["stats"] = {
+        "kube_client": dict(utils.kube_client_stats),
+        "patch_queue": dict(patch_queue.patch_stats),
+        "probe": dict(probe.probe_stats),
+        "unifi": json.loads(json.dumps(unifi.unifi_stats))
+    }
+
+    with open(args.output, "w") as output_file:
+        json.dump(report, output_file, indent=2, sort_keys=True)
+
+    print(f"Report written to {args.output}")
+
+if __name__ == "__main__":
+    main()
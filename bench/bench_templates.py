@@ -0,0 +1,70 @@
+#!/usr/bin/python
+"""
+Micro-benchmark of resource rendering: legacy read+format+yaml.safe_load versus pre-compiled templates.
+
+Usage: python bench/bench_templates.py [renders]
+"""
+
+import logging
+import os
+import sys
+import time
+import uuid
+import yaml
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "operator"))
+
+import modules.resources as resources
+
+ENV_VARS = [
+    {"name": "CSGO_GSLT", "value": "my_code"},
+    {"name": "SERVER_CONFIGS", "value": "False"}
+]
+
+def legacy_deployment_body(str_uuid, name, namespace, customer, port, labels, env_vars):
+    """ Rendering as done before templates were pre-compiled """
+
+    full_name = f"csgo-server-{name}-{customer}-{str_uuid[:8]}"
+    tmp_yaml = open(os.path.join(resources.TEMPLATE_DIR, 'Deployment.yaml'), 'rt').read()
+
+    return yaml.safe_load(
+        tmp_yaml.format(
+            full_name=full_name,
+            namespace=namespace,
+            customer=customer,
+            sub_start=labels["subscriptionStart"],
+            str_uuid=labels["custObjUuid"],
+            secret_name="gslt-code",
+            dyn_port=port,
+            env_vars=resources.add_port_to_env_vars(env_vars, port),
+        )
+    )
+
+def measure(label, renders, render):
+    start = time.perf_counter()
+    for _ in range(renders):
+        render()
+    elapsed = time.perf_counter() - start
+
+    print(f"{label:<28} {renders / elapsed:>12.0f} renders/s")
+
+def main():
+    renders = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    logger = logging.getLogger("bench")
+
+    str_uuid = str(uuid.uuid4())
+    labels = {"subscriptionStart": "1683139792", "custObjUuid": str_uuid}
+    args = (str_uuid, "bench", "prism-servers", "cust-01", 27015, labels)
+
+    measure("legacy", renders, lambda: legacy_deployment_body(*args, ENV_VARS))
+    measure("compiled (cached inputs)", renders, lambda: resources.get_deployment_body(logger, *args, ENV_VARS))
+
+    def fresh_inputs():
+        fresh_uuid = str(uuid.uuid4())
+        resources.get_deployment_body(logger, fresh_uuid, "bench", "prism-servers", "cust-01", 27015,
+                                      {"subscriptionStart": "1683139792", "custObjUuid": fresh_uuid}, ENV_VARS)
+
+    measure("compiled (fresh inputs)", renders, fresh_inputs)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+#!/usr/bin/python
+"""
+Fake Source engine servers answering A2S_INFO queries, one UDP socket per server.
+
+Optionally demands a challenge first and drops a share of the queries. Not a faithful game server.
+"""
+
+import asyncio
+import os
+import random
+import struct
+import threading
+
+A2S_HEADER = b"\xFF\xFF\xFF\xFF"
+A2S_INFO_REQUEST = A2S_HEADER + b"TSource Engine Query\x00"
+
+class FakeA2SState:
+    """ Server settings and counters shared by all fake servers """
+
+    def __init__(self, challenge=True, drop=0.0, delay=0.0):
+        self.challenge = challenge
+        self.drop = drop
+        self.delay = delay
+        self.queries = 0
+        self.challenges = 0
+        self.answers = 0
+
+class FakeA2SServer(asyncio.DatagramProtocol):
+    def __init__(self, state, index):
+        self.state = state
+        self.index = index
+        self.token = os.urandom(4)
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def info(self):
+        players = self.index % 11
+
+        return (A2S_HEADER + b"I" + bytes([17])
+                + f"fake-server-{self.index}".encode() + b"\x00"
+                + b"de_dust2\x00"
+                + b"csgo\x00"
+                + b"Counter-Strike: Global Offensive\x00"
+                + struct.pack("<HBBB", 730, players, 10, 0)
+                + b"dlo\x00\x01")
+
+    def datagram_received(self, data, address):
+        state = self.state
+        if not data.startswith(A2S_INFO_REQUEST):
+            return
+
+        state.queries += 1
+        if state.drop and random.random() < state.drop:
+            return
+
+        challenge = data[len(A2S_INFO_REQUEST):]
+        if state.challenge and challenge != self.token:
+            state.challenges += 1
+            self.transport.sendto(A2S_HEADER + b"A" + self.token, address)
+            return
+
+        state.answers += 1
+        if state.delay:
+            asyncio.get_running_loop().call_later(state.delay, self.transport.sendto, self.info(), address)
+        else:
+            self.transport.sendto(self.info(), address)
+
+def serve(count, challenge=True, drop=0.0, delay=0.0):
+    """ Start `count` fake servers on 127.0.0.1 in a background thread
+
+    Returns:
+        tuple: (addresses: list of (ip, port), state)
+    """
+
+    state = FakeA2SState(challenge, drop, delay)
+    loop = asyncio.new_event_loop()
+    ready = threading.Event()
+    addresses = []
+
+    async def start():
+        for index in range(count):
+            transport, _ = await loop.create_datagram_endpoint(lambda index=index: FakeA2SServer(state, index),
+                                                               local_addr=("127.0.0.1", 0))
+            addresses.append(transport.get_extra_info("sockname")[:2])
+        ready.set()
+
+    def run():
+        loop.run_until_complete(start())
+        loop.run_forever()
+
+    threading.Thread(target=run, daemon=True).start()
+    ready.wait()
+
+    return addresses, state
@@ -0,0 +1,360 @@
+#!/usr/bin/python
+"""
+Minimal in-memory stand-in for the Kubernetes API, sufficient for the operator's dynamic client.
+
+Serves discovery plus list/get/create/patch/delete of the kinds used by the operator
+and counts every call by verb and kind. Not a conformant apiserver.
+"""
+
+import copy
+import itertools
+import json
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+RESOURCES = {
+    # (group, version, plural): (kind, namespaced)
+    ("", "v1", "services"): ("Service", True),
+    ("", "v1", "configmaps"): ("ConfigMap", True),
+    ("", "v1", "pods"): ("Pod", True),
+    ("", "v1", "namespaces"): ("Namespace", False),
+    ("apps", "v1", "deployments"): ("Deployment", True),
+    ("coordination.k8s.io", "v1", "leases"): ("Lease", True),
+    ("prism-hosting.ch", "v1", "prismservers"): ("PrismServer", True),
+    ("prism-hosting.ch", "v1", "prismserverfleets"): ("PrismServerFleet", True),
+}
+
+VERBS = ["create", "delete", "get", "list", "patch", "update", "watch"]
+
+def group_version(group, version):
+    return f"{group}/{version}" if group else version
+
+def merge_patch(target, patch):
+    """ RFC 7386 merge-patch """
+
+    if not isinstance(patch, dict):
+        return copy.deepcopy(patch)
+    if not isinstance(target, dict):
+        target = {}
+
+    for key, value in patch.items():
+        if value is None:
+            target.pop(key, None)
+        else:
+            target[key] = merge_patch(target.get(key), value)
+
+    return target
+
+def json_patch(target, operations):
+    """ Subset of RFC 6902 (add, replace, remove, test) """
+
+    for operation in operations:
+        parts = [part.replace("~1", "/").replace("~0", "~") for part in operation["path"].split("/")[1:]]
+        parent = target
+        for part in parts[:-1]:
+            parent = parent[int(part)] if isinstance(parent, list) else parent.setdefault(part, {})
+
+        last = parts[-1]
+        if isinstance(parent, list):
+            last = len(parent) if last == "-" else int(last)
+
+        if operation["op"] == "test":
+            if parent[last] != operation["value"]:
+                raise ValueError(f"test failed for {operation['path']}")
+        elif operation["op"] == "remove":
+            del parent[last]
+        elif operation["op"] == "add" and isinstance(parent, list):
+            parent.insert(last, copy.deepcopy(operation["value"]))
+        else:
+            parent[last] = copy.deepcopy(operation["value"])
+
+    return target
+
+def matches_selector(labels, selector):
+    """ Equality-based label selectors: "key", "key=value", "key!=value", comma separated """
+
+    if not selector:
+        return True
+
+    labels = labels or {}
+    for requirement in selector.split(","):
+        requirement = requirement.strip()
+        if "!=" in requirement:
+            key, value = requirement.split("!=", 1)
+            if labels.get(key) == value:
+                return False
+        elif "=" in requirement:
+            key, value = requirement.split("=", 1)
+            if labels.get(key.rstrip("=")) != value.lstrip("="):
+                return False
+        elif requirement.startswith("!"):
+            if requirement[1:] in labels:
+                return False
+        elif requirement not in labels:
+            return False
+
+    return True
+
+class FakeKubeState:
+    """ Object store and call counters """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.objects = {}
+        # { (plural, namespace, name): object }
+        self.resource_version = itertools.count(1)
+        self.ip_counter = itertools.count(1)
+        self.calls = {}
+
+    def count(self, verb, kind):
+        with self.lock:
+            key = f"{verb} {kind}"
+            self.calls[key] = self.calls.get(key, 0) + 1
+
+    def next_ip(self):
+        value = next(self.ip_counter)
+        return f"10.{(value >> 16) & 255}.{(value >> 8) & 255}.{value & 255}"
+
+    def stamp(self, obj):
+        obj["metadata"]["resourceVersion"] = str(next(self.resource_version))
+        obj["metadata"]["generation"] = obj["metadata"].get("generation", 0) + 1
+
+    def create(self, plural, namespace, body):
+        metadata = body.setdefault("metadata", {})
+        if not metadata.get("name") and metadata.get("generateName"):
+            metadata["name"] = metadata["generateName"] + uuid.uuid4().hex[:5]
+
+        key = (plural, namespace, metadata["name"])
+        with self.lock:
+            if key in self.objects:
+                return 409, status_body(409, "AlreadyExists", f"{plural} \"{metadata['name']}\" already exists")
+
+            metadata["namespace"] = namespace
+            metadata["uid"] = str(uuid.uuid4())
+            metadata["creationTimestamp"] = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+
+            if plural == "services":
+                body.setdefault("spec", {})["clusterIP"] = "127.0.0.1"
+                body["status"] = {"loadBalancer": {"ingress": [{"ip": self.next_ip()}]}}
+
+            self.stamp(body)
+            self.objects[key] = body
+            return 201, copy.deepcopy(body)
+
+class FakeKubeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    # Headers and body are written separately, Nagle would hold the body back for a delayed ACK
+    state = None
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, code, body):
+        payload = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length) or b"null")
+
+    # --- Discovery ---
+    def discovery(self, path):
+        if path == "/version":
+            return {"major": "1", "minor": "26", "gitVersion": "v1.26.0"}
+
+        if path == "/api":
+            return {"kind": "APIVersions", "versions": ["v1"],
+                    "serverAddressByClientCIDRs": [{"clientCIDR": "0.0.0.0/0", "serverAddress": "127.0.0.1"}]}
+
+        if path == "/apis":
+            groups = sorted({(group, version) for group, version, _ in RESOURCES if group})
+            return {"kind": "APIGroupList", "apiVersion": "v1", "groups": [
+                {"name": group,
+                 "versions": [{"groupVersion": f"{group}/{version}", "version": version}],
+                 "preferredVersion": {"groupVersion": f"{group}/{version}", "version": version}}
+                for group, version in groups
+            ]}
+
+        for (group, version, _) in RESOURCES:
+            prefix = f"/apis/{group}/{version}" if group else f"/api/{version}"
+            if path == prefix:
+                resources = []
+                for (res_group, res_version, plural), (kind, namespaced) in RESOURCES.items():
+                    if (res_group, res_version) != (group, version):
+                        continue
+                    resources.append({"name": plural, "singularName": kind.lower(), "namespaced": namespaced,
+                                      "kind": kind, "verbs": VERBS})
+                    resources.append({"name": f"{plural}/status", "singularName": "", "namespaced": namespaced,
+                                      "kind": kind, "verbs": ["get", "patch", "update"]})
+                return {"kind": "APIResourceList", "groupVersion": group_version(group, version), "resources": resources}
+
+        return None
+
+    def route(self, path):
+        """ Split a resource path into (plural, namespace, name, subresource) """
+
+        parts = path.strip("/").split("/")
+        if parts[0] == "api":
+            group = ""
+            parts = parts[2:]
+        elif parts[0] == "apis" and len(parts) > 2:
+            group = parts[1]
+            parts = parts[3:]
+        else:
+            return None
+
+        # "namespaces/{ns}/{plural}/..." is namespaced, "namespaces/{name}" is a namespace itself
+        namespace = None
+        if len(parts) >= 3 and parts[0] == "namespaces":
+            namespace = parts[1]
+            parts = parts[2:]
+
+        if not parts:
+            return None
+
+        plural = parts[0]
+        name = parts[1] if len(parts) > 1 else None
+        subresource = parts[2] if len(parts) > 2 else None
+
+        for (res_group, _, res_plural), (kind, _) in RESOURCES.items():
+            if res_plural == plural and res_group == group:
+                return kind, plural, namespace, name, subresource
+
+        return None
+
+    def handle_any(self, method):
+        state = self.state
+        if state.latency:
+            time.sleep(state.latency)
+
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+
+        if url.path.startswith("/_stats"):
+            if method == "POST":
+                with state.lock:
+                    state.calls = {}
+            with state.lock:
+                return self.reply(200, {"calls": dict(state.calls), "objects": len(state.objects)})
+
+        if method == "GET":
+            found = self.discovery(url.path)
+            if found is not None:
+                state.count("discovery", url.path)
+                return self.reply(200, found)
+
+        routed = self.route(url.path)
+        if routed is None:
+            state.count("notfound", url.path)
+            return self.reply(404, status_body(404, "NotFound", f"{url.path} not found"))
+
+        kind, plural, namespace, name, _ = routed
+
+        if method == "GET" and name is None:
+            watching = query.get("watch", ["false"])[0] in ("true", "1")
+            state.count("watch" if watching else "list", kind)
+            selector = query.get("labelSelector", [""])[0]
+            with state.lock:
+                items = [copy.deepcopy(obj) for (obj_plural, obj_namespace, _), obj in state.objects.items()
+                         if obj_plural == plural and (namespace is None or obj_namespace == namespace)
+                         and matches_selector(obj["metadata"].get("labels"), selector)]
+            return self.reply(200, {"kind": f"{kind}List", "apiVersion": "v1",
+                                    "metadata": {"resourceVersion": str(next(state.resource_version))}, "items": items})
+
+        if method == "POST":
+            state.count("create", kind)
+            code, body = state.create(plural, namespace, self.read_body())
+            return self.reply(code, body)
+
+        key = (plural, namespace, name)
+
+        if method == "GET":
+            state.count("get", kind)
+            with state.lock:
+                obj = copy.deepcopy(state.objects.get(key))
+            if obj is None:
+                return self.reply(404, status_body(404, "NotFound", f"{plural} \"{name}\" not found"))
+            return self.reply(200, obj)
+
+        if method == "DELETE":
+            state.count("delete", kind)
+            with state.lock:
+                obj = state.objects.pop(key, None)
+            if obj is None:
+                return self.reply(404, status_body(404, "NotFound", f"{plural} \"{name}\" not found"))
+            return self.reply(200, obj)
+
+        if method in ("PATCH", "PUT"):
+            content_type = self.headers.get("Content-Type", "")
+            body = self.read_body()
+            state.count("apply" if "apply-patch" in content_type else method.lower() if method == "PATCH" else "update", kind)
+
+            with state.lock:
+                obj = state.objects.get(key)
+                if obj is None:
+                    if "apply-patch" not in content_type:
+                        return self.reply(404, status_body(404, "NotFound", f"{plural} \"{name}\" not found"))
+            if obj is None:
+                code, created = state.create(plural, namespace, body)
+                return self.reply(code, created)
+
+            with state.lock:
+                try:
+                    if method == "PUT":
+                        body["metadata"]["uid"] = obj["metadata"]["uid"]
+                        obj = body
+                    elif "json-patch" in content_type:
+                        obj = json_patch(copy.deepcopy(obj), body)
+                    else:
+                        obj = merge_patch(copy.deepcopy(obj), body)
+                except (KeyError, IndexError, ValueError) as e:
+                    return self.reply(422, status_body(422, "Invalid", str(e)))
+
+                state.stamp(obj)
+                state.objects[key] = obj
+                return self.reply(200, copy.deepcopy(obj))
+
+        return self.reply(405, status_body(405, "MethodNotAllowed", method))
+
+    def do_GET(self):
+        self.handle_any("GET")
+
+    def do_POST(self):
+        self.handle_any("POST")
+
+    def do_PUT(self):
+        self.handle_any("PUT")
+
+    def do_PATCH(self):
+        self.handle_any("PATCH")
+
+    def do_DELETE(self):
+        self.handle_any("DELETE")
+
+def status_body(code, reason, message):
+    return {"kind": "Status", "apiVersion": "v1", "status": "Failure", "code": code, "reason": reason, "message": message}
+
+def serve(port=0, latency=0.0):
+    """ Start the fake apiserver in a background thread
+
+    Returns:
+        tuple: (server, state)
+    """
+
+    state = FakeKubeState(latency)
+    handler = type("BoundFakeKubeHandler", (FakeKubeHandler, ), {"state": state})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server, state
@@ -0,0 +1,140 @@
+#!/usr/bin/python
+"""
+Minimal in-memory stand-in for the UDM login and portforward REST API.
+
+Counts every call by method and path kind. Not a faithful UniFi implementation.
+"""
+
+import json
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+PORTFORWARD_PATH = "/proxy/network/api/s/default/rest/portforward"
+
+class FakeUnifiState:
+    """ Rule table, sessions and call counters """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.rules = {}
+        # { "_id": rule }
+        self.tokens = set()
+        self.calls = {}
+
+    def count(self, method, what):
+        with self.lock:
+            key = f"{method} {what}"
+            self.calls[key] = self.calls.get(key, 0) + 1
+
+class FakeUnifiHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    # Headers and body are written separately, Nagle would hold the body back for a delayed ACK
+    state = None
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, code, body, headers=None):
+        payload = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length) or b"null")
+
+    def authorized(self):
+        cookies = self.headers.get("Cookie", "")
+        return any(f"TOKEN={token}" in cookies for token in self.state.tokens)
+
+    def handle_any(self, method):
+        state = self.state
+        if state.latency:
+            time.sleep(state.latency)
+
+        path = self.path.split("?")[0]
+
+        if path.startswith("/_stats"):
+            if method == "POST":
+                with state.lock:
+                    state.calls = {}
+            with state.lock:
+                return self.reply(200, {"calls": dict(state.calls), "rules": len(state.rules)})
+
+        if path == "/api/auth/login" and method == "POST":
+            state.count(method, "login")
+            self.read_body()
+            token = uuid.uuid4().hex
+            with state.lock:
+                state.tokens.add(token)
+            return self.reply(200, {}, {"Set-Cookie": f"TOKEN={token}; Path=/", "X-CSRF-Token": uuid.uuid4().hex})
+
+        if not path.startswith(PORTFORWARD_PATH):
+            state.count(method, "notfound")
+            return self.reply(404, {"meta": {"rc": "error"}})
+
+        state.count(method, "portforward")
+
+        if not self.authorized():
+            self.read_body()
+            return self.reply(401, {"meta": {"rc": "error", "msg": "api.err.LoginRequired"}})
+
+        rule_id = path[len(PORTFORWARD_PATH):].strip("/")
+
+        with state.lock:
+            if method == "GET":
+                return self.reply(200, {"meta": {"rc": "ok"}, "data": list(state.rules.values())})
+
+            if method == "POST":
+                rule = dict(self.read_body(), _id=uuid.uuid4().hex[:24], site_id="default")
+                state.rules[rule["_id"]] = rule
+                return self.reply(200, {"meta": {"rc": "ok"}, "data": [rule]})
+
+            if method == "PUT" and rule_id in state.rules:
+                rule = dict(self.read_body(), _id=rule_id)
+                state.rules[rule_id] = rule
+                return self.reply(200, {"meta": {"rc": "ok"}, "data": [rule]})
+
+            if method == "DELETE" and rule_id in state.rules:
+                del state.rules[rule_id]
+                return self.reply(200, {"meta": {"rc": "ok"}, "data": []})
+
+        self.read_body()
+        return self.reply(400, {"meta": {"rc": "error", "msg": "api.err.IdInvalid"}})
+
+    def do_GET(self):
+        self.handle_any("GET")
+
+    def do_POST(self):
+        self.handle_any("POST")
+
+    def do_PUT(self):
+        self.handle_any("PUT")
+
+    def do_DELETE(self):
+        self.handle_any("DELETE")
+
+def serve(port=0, latency=0.0):
+    """ Start the fake UniFi controller in a background thread
+
+    Returns:
+        tuple: (server, state)
+    """
+
+    state = FakeUnifiState(latency)
+    handler = type("BoundFakeUnifiHandler", (FakeUnifiHandler, ), {"state": state})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server, state
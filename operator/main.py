@@ -3,47 +3,217 @@
 Operator to create and manage CS:GO servers.
 """
 
+import asyncio
 import time
 import logging
 import kopf
 import traceback
-from threading import Thread
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from openshift.dynamic import DynamicClient
 import modules.resources as resources
+import modules.a2s as a2s
+import modules.checkpoint as checkpoint
+import modules.drift as drift
+import modules.fleet as fleet
 import modules.forwarder as forwarder
 import modules.tcp_probe as probe
+import modules.service_index as service_index
+import modules.deployment_index as deployment_index
+import modules.shards as shards
+import modules.label_baseline as label_baseline
+import modules.metrics as metrics
+import modules.patch_queue as patch_queue
+import modules.pool as pool
+import modules.profiling as profiling
+import modules.ratelimit as ratelimit
+import modules.ports as ports
+import modules.unifi as unifi
 import modules.utils as utils
 
-#  ------------------------
-#           VARS
-#  ------------------------
-prism_object_initial_label_cache = {}
-# { "prism_object": labels{} }
-# Used for label_guard()
-
 #  ------------------------
 #         HANDLERS
 #  ------------------------
 # --- STARTUP ---
 @kopf.on.startup()
+@profiling.profiled
 def start_up(settings: kopf.OperatorSettings, logger, **kwargs):
     settings.posting.level = logging.ERROR
-    settings.persistence.finalizer = 'prism-server-operator.prism-hosting.ch/kopf-finalizer'
+    settings.persistence.finalizer = shards.FINALIZER
+    settings.execution.max_workers = utils.env_int("HANDLER_WORKERS", 20)
     
     logger.info("Operator startup succeeded!")
 
 @kopf.on.startup()
-def launch_supervisor_loop(settings: None, logger, **kwargs):
-    thread = Thread(target=supervisor_loop)
-    thread.start()
+@profiling.profiled
+def start_metrics_server(logger, **kwargs):
+    """ Expose /metrics, including the internal counters of the shared clients and queues """
+    
+    metrics.register_stats("prism_operator_kube_client", utils.kube_client_stats, "Shared Kubernetes client counters")
+    metrics.register_stats("prism_operator_patch_queue", patch_queue.patch_stats, "Coalescing patch queue counters")
+    metrics.register_stats("prism_operator_unifi_client", unifi.unifi_stats, "UniFi client counters")
+    metrics.register_stats("prism_operator_a2s_queries", a2s.a2s_stats, "A2S_INFO query counters")
+    metrics.register_stats("prism_operator_probes", probe.probe_stats, "Probe engine counters")
+    metrics.register_stats("prism_operator_forward_deletions", forwarder.deletion_stats, "Batched port forward deletion counters")
+    metrics.register_stats("prism_operator_checkpoint", checkpoint.checkpoint_stats, "Warm-start checkpoint counters")
+    metrics.register_stats("prism_operator_drift", drift.drift_stats, "Drift detection and repair counters")
+    metrics.register_stats("prism_operator_fleet", fleet.fleet_stats, "Fleet provisioning counters")
+    metrics.register_stats("prism_operator_pool", pool.pool_stats, "Warm pool counters")
+    metrics.register_stats("prism_operator_kube_rate_limiter", ratelimit.kube_bucket.stats, "Kubernetes API rate limiter counters")
+    metrics.register_stats("prism_operator_unifi_rate_limiter", ratelimit.unifi_bucket.stats, "UniFi API rate limiter counters")
+    metrics.start_server()
+    
+    logger.info(f"Serving metrics on port {metrics.METRICS_PORT}")
+
+@kopf.on.startup()
+@profiling.profiled
+async def start_profiling(logger, **kwargs):
+    """ Runs in the event loop, i.e. the main thread, which may install the SIGUSR1 trigger """
+    
+    profiling.start(logger)
+
+@kopf.on.startup()
+@profiling.profiled
+def restore_checkpoint(logger, **kwargs):
+    """ Warm-start from the last checkpoint, before the watches deliver their initial events """
+    
+    if not checkpoint.CHECKPOINT_ENABLED:
+        return
+    
+    snapshot = checkpoint.load(logger)
+    if snapshot:
+        checkpoint.restore(snapshot, logger)
+
+@kopf.on.startup()
+@profiling.profiled
+async def seed_port_allocator(logger, **kwargs):
+    """ Reserve the ports of existing services and port forwards before any server is created """
+    
+    response = await asyncio.to_thread(utils.kube_request, "get", "Service", namespace="prism-servers", label_selector="custObjUuid")
+    used_ports = [service.spec.ports[0].port for service in response.items if service.spec.ports]
+    
+    # A restored bitmap misses the ports allocated after the checkpoint was written, the services add them
+    if checkpoint.checkpoint_state["restored"]:
+        ports.seed(used_ports)
+        logger.info(f"Port allocator seeded from checkpoint and services, occupancy: {ports.occupancy():.2%}")
+        return
+    
+    try:
+        for forward in (await forwarder.get_port_forward())["data"]:
+            used_ports += [forward.get("dst_port"), forward.get("fwd_port")]
+    except Exception as e:
+        logger.warning(f"Could not seed ports from port forwards: {str(e)}")
+    
+    ports.seed(used_ports)
+    logger.info(f"Port allocator seeded, occupancy: {ports.occupancy():.2%}")
+
+@kopf.on.startup()
+@profiling.profiled
+async def launch_probe_engine(memo: kopf.Memo, logger, **kwargs):
+    memo.probe_engine = asyncio.create_task(probe.run_probe_engine(logger))
+
+@kopf.on.cleanup()
+@profiling.profiled
+async def stop_probe_engine(memo: kopf.Memo, **kwargs):
+    if memo.get("probe_engine"):
+        memo.probe_engine.cancel()
+
+@kopf.on.cleanup()
+@profiling.profiled
+def flush_patch_queue(**kwargs):
+    patch_queue.flush()
+
+@kopf.on.startup()
+@profiling.profiled
+async def launch_checkpoints(memo: kopf.Memo, logger, **kwargs):
+    if checkpoint.CHECKPOINT_ENABLED:
+        memo.checkpoints = asyncio.create_task(checkpoint.run_checkpoints(logger))
+
+@kopf.on.cleanup()
+@profiling.profiled
+async def write_checkpoint(memo: kopf.Memo, logger, **kwargs):
+    """ Checkpoint the final state on shutdown, so a rollout restarts warm """
+    
+    if not memo.get("checkpoints"):
+        return
+    
+    memo.checkpoints.cancel()
+    if checkpoint.checkpoint_state["ready"]:
+        await asyncio.to_thread(checkpoint.write, logger)
+
+@kopf.on.startup()
+@profiling.profiled
+async def launch_drift_sweep(memo: kopf.Memo, logger, **kwargs):
+    if drift.DRIFT_ENABLED:
+        memo.drift_sweep = asyncio.create_task(drift.run_drift_sweep(logger))
+
+@kopf.on.cleanup()
+@profiling.profiled
+async def stop_drift_sweep(memo: kopf.Memo, **kwargs):
+    if memo.get("drift_sweep"):
+        memo.drift_sweep.cancel()
+
+@kopf.on.startup()
+@profiling.profiled
+async def launch_pool(memo: kopf.Memo, logger, **kwargs):
+    # Also without a pool, it drains the standby servers left from when it was enabled
+    memo.pool = asyncio.create_task(pool.run_pool(logger))
+
+@kopf.on.cleanup()
+@profiling.profiled
+async def stop_pool(memo: kopf.Memo, **kwargs):
+    if memo.get("pool"):
+        memo.pool.cancel()
+
+@kopf.on.startup()
+@profiling.profiled
+def check_shard(logger, **kwargs):
+    """ Refuse to start on a shard outside of SHARD_COUNT, its objects would be handled twice or never """
+    
+    if not shards.SHARDING_ENABLED:
+        return
+    
+    try:
+        shards.validate()
+    except ValueError as e:
+        raise kopf.PermanentError(str(e))
+    
+    logger.info(f"Sharding enabled as {shards.SHARD_IDENTITY}, shard {shards.SHARD_INDEX} of {shards.SHARD_COUNT}")
+
+@kopf.on.startup()
+@profiling.profiled
+async def launch_forwarder(memo: kopf.Memo, logger, **kwargs):
+    memo.forwarder = asyncio.create_task(forwarder.run_forwarder(logger))
+    memo.forward_deletions = asyncio.create_task(forwarder.run_deletions(logger))
+
+@kopf.on.cleanup()
+@profiling.profiled
+async def stop_forwarder(memo: kopf.Memo, **kwargs):
+    tasks = [task for task in (memo.get("forwarder"), memo.get("forward_deletions")) if task]
+    for task in tasks:
+        task.cancel()
+    
+    # Let them unwind first, a request still in flight would open a new session after the close
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await unifi.close()
 
 # --- CREATE ---
-@kopf.on.create('prism-hosting.ch', 'v1', 'prismservers')
-def create(spec, meta, logger, **kwargs):
+@kopf.on.create('prism-hosting.ch', 'v1', 'prismservers', labels=shards.HANDLER_LABELS)
+@metrics.timed_handler
+@profiling.profiled
+def create(body, spec, meta, logger, **kwargs):
     """resource create handler"""
 
     logger.info("A resource is being created...")
 
+    # Members of a fleet are created along with their resources
+    labels = meta.get('labels') or {}
+    if labels.get(fleet.FLEET_LABEL) and labels.get('custObjUuid'):
+        logger.info(f"> Provisioned by fleet {labels[fleet.FLEET_LABEL]}, nothing to create")
+        return {
+            'message': 'Provisioned by fleet',
+            'time': f"{str( int( time.time() ) )}"
+        }
+
     # Get resource metadata
     this_name = meta['name']
     namespace = meta['namespace']
@@ -68,30 +238,37 @@ def create(spec, meta, logger, **kwargs):
             offending_entry = var["name"]
             err_msg = f"A bool cannot be accepted here: spec.env['{offending_entry}']. Must be a string."
 
-            utils.patch_resource(this_name, {'status': {'error': {'message': err_msg}}})
+            patch_queue.submit(this_name, {'status': {'error': {'message': err_msg}}})
             
             raise kopf.PermanentError(err_msg)
 
-    # Create server
-    logger.info("Calling 'create_server'...")
-    obj = create_server(logger, this_name, namespace, customer, sub_start, env_vars)
+    # Claim a pre-warmed standby server, else create one from scratch
+    claimed = pool.claim(body, customer, sub_start, env_vars, logger)
+    if claimed:
+        objs, annotations = claimed
+    else:
+        logger.info("Calling 'create_server'...")
+        objs, annotations = create_server(logger, this_name, namespace, customer, sub_start, env_vars), {}
+    
+    # The PrismServer takes the labels of its Deployment, the Service holds the port
+    deployment = next(obj for obj in objs if obj.kind == "Deployment")
+    service = next(obj for obj in objs if obj.kind == "Service")
 
     logger.info("PRISM server created, updating labels...")
 
-    # Patch labels of PrismResource
-    labels_body = {
-        "metadata": {
-            "labels": { 
-                'customer': obj.metadata.labels.customer,
-                'name': obj.metadata.labels.name,
-                'subscriptionStart': obj.metadata.labels.subscriptionStart,
-                'custObjUuid': obj.metadata.labels.custObjUuid
-            }
-        }
+    # Patch labels of PrismResource, along with their immutable baseline and the server port for drift detection
+    labels = {
+        'customer': deployment.metadata.labels.customer,
+        'name': deployment.metadata.labels.name,
+        'subscriptionStart': deployment.metadata.labels.subscriptionStart,
+        'custObjUuid': deployment.metadata.labels.custObjUuid
     }
+    labels_body = patch_queue.deep_merge({"metadata": {"labels": labels}}, label_baseline.baseline_annotation(labels))
+    labels_body["metadata"].setdefault("annotations", {}).update(annotations, **{drift.PORT_ANNOTATION: str(service.spec.ports[0].port)})
+    label_baseline.remember(this_name, labels)
     
     # Update status
-    utils.patch_resource(this_name, labels_body)
+    patch_queue.submit(this_name, labels_body)
 
     return {
         'message': 'Successfully created',
@@ -99,8 +276,10 @@ def create(spec, meta, logger, **kwargs):
     }
 
 # --- DELETE ---
-@kopf.on.delete('prism-hosting.ch', 'v1', 'prismservers')
-def clean_port_forward(spec: None, meta: None, status, logger, **kwargs):
+@kopf.on.delete('prism-hosting.ch', 'v1', 'prismservers', labels=shards.HANDLER_LABELS)
+@metrics.timed_handler
+@profiling.profiled
+async def clean_port_forward(spec: None, meta: None, status, logger, **kwargs):
     """
     Cleans a configured port forwarding of a service
     """
@@ -115,13 +294,21 @@ def clean_port_forward(spec: None, meta: None, status, logger, **kwargs):
             ip = status["forwarding"]["assignedIp"]
             
             logger.info(f"Triggering port forward deletion for: {ip}")
-            forwarder.delete_port_forward_by_ip(ip)        
+            await forwarder.delete_port_forward_by_ip(ip)        
+    except kopf.TemporaryError:
+        raise
     except Exception as e:
         raise kopf.PermanentError(f"clean_port_forward() error: {str(e)}")
 
 # --- UPDATES ---
-@kopf.on.field('prism-hosting.ch', 'v1', 'prismservers', field='spec.env')
-def update_env(new, meta, logger, **_):
+@kopf.on.field('prism-hosting.ch', 'v1', 'prismservers', field='spec.env', labels=shards.HANDLER_LABELS)
+@metrics.timed_handler
+@profiling.profiled
+def update_env(old, new, meta, logger, **_):
+    # The env of new resources is rendered into their deployment, e.g. for members of a fleet
+    if old is None:
+        return
+    
     # Check if resource was just created by checking its labels, ignore if so
     if meta["labels"]:
         if not meta["labels"]["custObjUuid"]:
@@ -132,161 +319,245 @@ def update_env(new, meta, logger, **_):
         return
     
     this_custObjUuid = meta["labels"]["custObjUuid"]
-    customer = meta["labels"]["customer"]
-    name = meta["name"]
     
     try:
-        client = utils.kube_auth()
-        api = client.resources.get(api_version="v1", kind="Deployment")
-        deployments = api.get(namespace="prism-servers", label_selector=f"custObjUuid={this_custObjUuid}").items
-
-        api = client.resources.get(api_version="v1", kind="Service")
-        services = api.get(namespace="prism-servers", label_selector=f"custObjUuid={this_custObjUuid}").items
+        deployment = deployment_index.lookup(this_custObjUuid)
+        service = service_index.lookup(this_custObjUuid)
         
-        if len(deployments) <= 0:
-            raise kopf.PermanentError(f"Found no deployments for custObjUuid: {this_custObjUuid}")
-        if len(deployments) > 1:
-            raise kopf.PermanentError(f"Found too many deployments for custObjUuid: {this_custObjUuid}")
-        # Existing deployment (meta)data
+        if not deployment:
+            raise kopf.TemporaryError(f"Deployment for custObjUuid {this_custObjUuid} is not indexed yet", delay=5)
+        if not service:
+            raise kopf.TemporaryError(f"Service for custObjUuid {this_custObjUuid} is not indexed yet", delay=5)
         
-        deployment_name = deployments[0]["metadata"]["name"]
-        port = services[0].spec.ports[0].port
-
-        # Dummy labels, not actually required but expected by get_deployment_body()
-        dummy_labels = {
-            "custObjUuid": "dummy",
-            "subscriptionStart": "dummy",
-        }
-
-        deployment_body = resources.get_deployment_body(logger, this_custObjUuid, name, "prism-servers", customer, port, labels=dummy_labels, env_vars=new)
+        # Effective env of the server container, as rendered by get_deployment_body()
+        env = resources.add_port_to_env_vars([{"name": var["name"], "value": var["value"]} for var in new or []], service["port"])
         
-        patch_body = {
-            "spec": {
-                "template": {
-                    "spec": {
-                        "containers": deployment_body["spec"]["template"]["spec"]["containers"]
-                    }
-                }
-            }
-        }
+        patch_body = deployment_index.env_patch(deployment, env)
+        if patch_body is None:
+            logger.info(f"> Env of deployment {deployment['name']} is unchanged, not patching")
+            return
+        
+        patched = utils.patch_resource(deployment["name"], patch_body, kind="Deployment", content_type="application/json-patch+json")
         
-        utils.patch_resource(deployment_name, patch_body, kind="Deployment")
+        # Compare the next change against this env rather than the lagging watch
+        deployment_index.apply_event("MODIFIED", patched.to_dict())
 
+    except kopf.TemporaryError:
+        raise
     except Exception as e:
         logger.warning(traceback.format_exc())
         raise kopf.PermanentError(f"Could not update env vars: {str(e)}")
 
-@kopf.on.field('prism-hosting.ch', 'v1', 'prismservers', field='metadata.labels')
+@kopf.on.field('prism-hosting.ch', 'v1', 'prismservers', field='metadata.labels', labels=shards.HANDLER_LABELS)
+@metrics.timed_handler
+@profiling.profiled
 def label_guard(body, old, new, meta, logger, **_):
     """ Ensures that labels cannot get edited """
     
-    expected_labels = [
-        "custObjUuid",
-        "customer",
-        "name",
-        "subscriptionStart"
-    ]
-    
     this_name = meta["name"]
 
     # Handle scenarios in which PrismServer was just labeled after creation
     if not old:
         return None
-    else:
-        # Create volatile record of initial labels for this PrismServer resource
-        if not this_name in prism_object_initial_label_cache:
-            prism_object_initial_label_cache[this_name] = old
     
     try:
+        baseline = label_baseline.get_baseline(this_name, meta)
+        
+        # Objects created before baselines were persisted: Take the previous labels and persist them
+        if baseline is None:
+            baseline = dict(old)
+            label_baseline.remember(this_name, baseline)
+            patch_queue.submit(this_name, label_baseline.baseline_annotation(baseline))
+        
         # Determine if certain labels changed
-        patch_back = False
-        if not all(label in new for label in expected_labels):
-            logger.info("[i] Did not find expected labels for a PrismServer resource, patching back...")
-            patch_back = True
-            
-        mismatched_labels = [key for key in prism_object_initial_label_cache[this_name] if key in new and prism_object_initial_label_cache[this_name][key] != new[key]]
-        if len(mismatched_labels) > 0:
+        missing_labels, mismatched_labels = label_baseline.diff(baseline, new)
+        if missing_labels:
+            logger.info(f"[i] Did not find expected labels for a PrismServer resource: {missing_labels}")
+        if mismatched_labels:
             logger.info(f"[i] Found NEW labels that are mismatched: {mismatched_labels}")
-            patch_back = True
         
         # Actually do patching
-        if patch_back:
-            body = {'metadata': {'labels': prism_object_initial_label_cache[this_name]}}
-            utils.patch_resource(this_name, body)
+        if missing_labels or mismatched_labels:
+            logger.info("[i] Patching labels back...")
+            patch_queue.submit(this_name, {'metadata': {'labels': baseline}})
             kopf.warn(body, reason="LabelsImmutable", message="Certain labels may not be updated or removed.")
             
     except Exception as e:
         raise kopf.PermanentError(f"Label guard failed: {str(e)}")   
     
+# --- FLEETS ---
+@kopf.on.create('prism-hosting.ch', 'v1', 'prismserverfleets', labels=shards.HANDLER_LABELS)
+@kopf.on.update('prism-hosting.ch', 'v1', 'prismserverfleets', field='spec', labels=shards.HANDLER_LABELS)
+@kopf.on.resume('prism-hosting.ch', 'v1', 'prismserverfleets', labels=shards.HANDLER_LABELS)
+@metrics.timed_handler
+@profiling.profiled
+def reconcile_fleet(body, meta, spec, logger, **kwargs):
+    """ Expand a fleet into its PrismServers, and scale it down """
+    
+    if not spec.get('customer'):
+        raise kopf.PermanentError("Must set spec.customer")
+    
+    result = fleet.expand(body, logger)
+    
+    patch_queue.submit(meta['name'], {'status': {
+        'replicas': spec.get('replicas', 0),
+        'failed': result['failed'] or None
+    }}, kind="PrismServerFleet", namespace=meta['namespace'])
+    
+    # Existing members are skipped on the retry
+    if result['failed']:
+        raise kopf.TemporaryError(f"{len(result['failed'])} servers could not be created", delay=30)
+    
+    return {
+        'message': f"Created {len(result['created'])}, updated {len(result['updated'])}, deleted {len(result['deleted'])} servers",
+        'time': f"{str( int( time.time() ) )}"
+    }
+
+# --- SHARDS ---
+@kopf.on.event('prism-hosting.ch', 'v1', 'prismservers')
+@kopf.on.event('prism-hosting.ch', 'v1', 'prismserverfleets')
+@profiling.profiled
+async def assign_shard(type, body, meta, **kwargs):
+    """ Label the objects of this replica's shard with their shard, which their handlers are filtered by """
+    
+    if type == "DELETED":
+        return
+    
+    patch_body = shards.assign_patch(meta)
+    if patch_body:
+        patch_queue.submit(meta['name'], patch_body, kind=body['kind'], namespace=meta['namespace'], priority=ratelimit.CREATE)
+
 #  ------------------------
-#          TIMERS
+#          PROBES
 #  ------------------------
-@kopf.timer('prism-hosting.ch', 'v1', 'prismservers', interval=3.0, initial_delay=20)
-def monitor_service_port(stopped, meta, name, status, logger, **kwargs):
-    """ Continuosly monitor the readiness of a CS:GO service and update the PrismServer object. """
+@kopf.on.event('prism-hosting.ch', 'v1', 'prismservers')
+@metrics.timed_handler
+@profiling.profiled
+async def track_probe_target(type, body, meta, status, **kwargs):
+    """ Keep the probe engine's target list, the patch queue's known state, the desired state of drift detection and the status of fleets in sync with PrismServer objects """
     
-    try:
-        this_custObjUuid = meta["labels"]["custObjUuid"]
-        
-        # Test the service
-        probe_verdict = False
-        try:
-            probe_verdict = probe.probe_service(this_custObjUuid)
-        except Exception as e:  # Do not fatally exit, we want to ensure that status is False
-            # Debug
-            logger.warn(f"Exception calling probe_service(): {str(e)}")
-        
-        status_obj = {
-            "status": {
-                "tcpProbeResponding": probe_verdict
-            }
-        }
-        
-        # Only patch status if is not already as expected
-        if not "tcpProbeResponding" in status or status["tcpProbeResponding"] != probe_verdict:
-            logger.info(f"> Updating tcpProbeResponding (New: {probe_verdict}) for service with custObjUuid={this_custObjUuid}.")
-            utils.patch_resource(name, status_obj)
+    shards.track(type, meta)
+    probe.track_target(type, meta, status)
+    checkpoint.confirm_target((meta.get("labels") or {}).get("custObjUuid"))
+    patch_queue.observe(meta["name"], body, deleted=(type == "DELETED"))
+    
+    if type == "DELETED":
+        label_baseline.forget(meta["name"])
+    
+    # Only records the desired state, update_env() applies env changes and the objects' own events check them
+    drift.track_server(type, body)
+    
+    changed = fleet.track_member(type, body)
+    if changed and shards.owns(shards.object_key(changed[1])):
+        patch_queue.submit(changed[1]['name'], fleet.aggregated_status(changed[1]), kind="PrismServerFleet", namespace=changed[1]['namespace'])
+
+@kopf.on.event('', 'v1', 'services', labels={'custObjUuid': kopf.PRESENT})
+@metrics.timed_handler
+@profiling.profiled
+async def index_service(type, body, logger, **kwargs):
+    """ Keep the service index in sync with PrismServer services, and heal them if they drifted """
+    
+    previous, current = service_index.apply_event(type, body)
+    pool.observe("Service", type, body)
+    checkpoint.confirm_service((current or previous or {}).get("uuid"))
+    
+    if current:
+        ports.reserve(current["port"])
         
-    except Exception as e:
-        logger.warn(f"monitor_service_port(): {str(e)}")
+        # A new service can be probed right away
+        if not previous:
+            probe.expedite(current["uuid"])
+    elif previous:
+        ports.release(previous["port"])
+        forwarder.forwarding_phases.pop(previous["uuid"], None)
+    
+    # The forwarder reconciles the services of this replica's shard only
+    if forwarder.needs_reconcile(previous, current):
+        await forwarder.request_reconcile(current["uuid"])
+    
+    await drift.check(drift.observe("Service", type, body), logger)
+
+@kopf.on.event('apps', 'v1', 'deployments', labels={'custObjUuid': kopf.PRESENT})
+@metrics.timed_handler
+@profiling.profiled
+async def index_deployment(type, body, logger, **kwargs):
+    """ Keep the deployment index in sync with PrismServer deployments, and heal them if they drifted """
+    
+    deployment_index.apply_event(type, body)
+    pool.observe("Deployment", type, body)
+    await drift.check(drift.observe("Deployment", type, body), logger)
+
+@kopf.on.event('', 'v1', 'pods', labels={'custObjUuid': kopf.PRESENT})
+@profiling.profiled
+async def expedite_probe(body, **kwargs):
+    """ Probe a server right away whenever its pod changes (restart, readiness, eviction, ...) """
+    
+    probe.expedite(body["metadata"]["labels"]["custObjUuid"])
 
 #  ------------------------
 #         FUNCTIONS
 #  ------------------------
-def supervisor_loop():
-    """ Port forwarder supervisor loop """
-    
-    while (True):
-        try:
-            forwarder.supervise_ips()
-        except Exception as e:
-            print(f"supervisor_loop() error: {str(e)}")
-        
-        time.sleep(3)
-
 def create_server(logger, name, namespace, customer, sub_start, env_vars=None):
-    """ Create the server """
+    """ Create the server
+
+    Creates all resources concurrently and removes the ones already created if any of them fails.
+
+    Returns:
+        list: All created objects, in the order of resources.get_resources()
+    """
     
     logger.info(f"Creating a resource in {namespace}")
     
     # Attempt logon
-    dyn_client = utils.kube_auth()
+    utils.kube_auth()
 
-    # Create the above schedule resource
     try:
-        bodies = resources.get_resources(logger, name, namespace, customer, sub_start, env_vars)
+        port = resources.allocate_random_port()
+    except Exception as e:
+        raise kopf.PermanentError(f"Resource creation has failed: {str(e)}")
     
-        logger.info(f"Resource gathering finished, creating resources...")
-        for body in bodies:
-            # Owner reference
-            kopf.adopt(body)
+    # Any failure from here on gives the port back
+    try:
+        try:
+            bodies = resources.get_resources(logger, name, namespace, customer, sub_start, env_vars, port=port)
             
-            resource = dyn_client.resources.get(api_version=body["apiVersion"], kind=body["kind"])
+            for body in bodies:
+                # Spec hash, then owner reference
+                drift.stamp(body)
+                kopf.adopt(body)
+        except Exception as e:
+            raise kopf.PermanentError(f"Resource creation has failed: {str(e)}")
+        
+        logger.info(f"Resource gathering finished, creating {len(bodies)} resources...")
+        
+        created = {}
+        errors = []
+        with ThreadPoolExecutor(max_workers=len(bodies)) as executor:
+            futures = {executor.submit(utils.apply_resource, body, namespace): index for index, body in enumerate(bodies)}
             
-            logger.info(f"> Resource body: {body}")
-            return_object = resource.create(body=body, namespace=namespace)
-    except Exception as e:
-        raise kopf.PermanentError(f"Resource creation has failed: {str(e)}")
+            for future in as_completed(futures):
+                body = bodies[futures[future]]
+                try:
+                    created[futures[future]] = future.result()
+                    logger.info(f"> Created {body['kind']} {body['metadata']['name']}")
+                except Exception as e:
+                    errors.append(f"{body['kind']} {body['metadata']['name']}: {str(e)}")
+        
+        if errors:
+            rollback_server(logger, [bodies[index] for index in created], namespace)
+            raise kopf.PermanentError(f"Resource creation has failed: {'; '.join(errors)}")
+    except Exception:
+        ports.release(port)
+        raise
     
-    # CAUTION: Will be the LAST resource that was created
-    return return_object
+    return [created[index] for index in range(len(bodies))]
+
+def rollback_server(logger, bodies, namespace):
+    """ Delete the resources of a partially created server """
+    
+    for body in bodies:
+        try:
+            logger.info(f"> Rolling back {body['kind']} {body['metadata']['name']}")
+            utils.delete_resource(body["metadata"]["name"], body["kind"], api_version=body["apiVersion"], namespace=namespace)
+        except Exception as e:
+            logger.warning(f"Rollback of {body['kind']} {body['metadata']['name']} failed: {str(e)}")
@@ -0,0 +1,190 @@
+"""
+Multiplexed Source engine A2S_INFO queries over a single UDP socket
+"""
+
+import asyncio
+import socket
+import struct
+import time
+
+#  ------------------------
+#           VARS
+#  ------------------------
+A2S_HEADER = b"\xFF\xFF\xFF\xFF"
+A2S_INFO_REQUEST = A2S_HEADER + b"TSource Engine Query\x00"
+
+A2S_INFO_RESPONSE = 0x49
+# "I"
+A2S_CHALLENGE_RESPONSE = 0x41
+# "A", the server wants the request again with the 4 byte challenge appended
+
+A2S_RECEIVE_BUFFER = 4 * 1024 * 1024
+
+a2s_stats = {
+    "queries": 0,
+    "answers": 0,
+    "challenges": 0,
+    "timeouts": 0,
+    "invalid": 0
+}
+
+#  ------------------------
+#         FUNCTIONS
+#  ------------------------
+def info_request(challenge=None):
+    """ Build an A2S_INFO request, optionally answering a challenge """
+
+    if challenge is None:
+        return A2S_INFO_REQUEST
+
+    return A2S_INFO_REQUEST + challenge
+
+def read_string(payload, offset):
+    """ Read a null-terminated string, returns (string, next offset) """
+
+    end = payload.index(b"\x00", offset)
+    return payload[offset:end].decode("utf-8", errors="replace"), end + 1
+
+def parse_info(payload):
+    """ Parse the body of an A2S_INFO response
+
+    Args:
+        payload (bytes): Datagram without the 4 byte header and the response type
+
+    Returns:
+        dict: {"name", "map", "folder", "game", "players", "maxPlayers", "bots"}
+    """
+
+    offset = 1
+    # Protocol version
+
+    name, offset = read_string(payload, offset)
+    map_name, offset = read_string(payload, offset)
+    folder, offset = read_string(payload, offset)
+    game, offset = read_string(payload, offset)
+
+    _, players, max_players, bots = struct.unpack_from("<HBBB", payload, offset)
+
+    return {
+        "name": name,
+        "map": map_name,
+        "folder": folder,
+        "game": game,
+        "players": players,
+        "maxPlayers": max_players,
+        "bots": bots
+    }
+
+class QueryProtocol(asyncio.DatagramProtocol):
+    """ Matches datagrams to outstanding queries by their source address """
+
+    def __init__(self):
+        self.transport = None
+        self.pending = {}
+        # { (ip, port): { "future": Future, "sent": float } }
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def query(self, address):
+        """ Send an A2S_INFO request and return a future for its (info, rtt) answer """
+
+        future = asyncio.get_running_loop().create_future()
+        self.pending[address] = {"future": future, "sent": time.monotonic()}
+
+        self.transport.sendto(info_request(), address)
+        a2s_stats["queries"] += 1
+
+        return future
+
+    def datagram_received(self, data, address):
+        entry = self.pending.get(address[:2])
+        if entry is None or entry["future"].done():
+            return
+
+        if len(data) < 5 or data[:4] != A2S_HEADER:
+            a2s_stats["invalid"] += 1
+            return
+
+        if data[4] == A2S_CHALLENGE_RESPONSE and len(data) >= 9:
+            # The RTT is measured on the request that actually gets answered
+            a2s_stats["challenges"] += 1
+            entry["sent"] = time.monotonic()
+            self.transport.sendto(info_request(data[5:9]), address[:2])
+            return
+
+        if data[4] != A2S_INFO_RESPONSE:
+            a2s_stats["invalid"] += 1
+            return
+
+        try:
+            info = parse_info(data[5:])
+        except (ValueError, struct.error):
+            a2s_stats["invalid"] += 1
+            return
+
+        a2s_stats["answers"] += 1
+        entry["future"].set_result((info, time.monotonic() - entry["sent"]))
+
+    def error_received(self, exc):
+        # ICMP errors cannot be attributed to a target on an unconnected socket, they end in a timeout
+        pass
+
+async def query_endpoints(endpoints, timeout=2.0, send_rate=0):
+    """ Query all endpoints from one UDP socket
+
+    Args:
+        endpoints (dict): { "key": (ip, port) or None }
+        timeout (float): Seconds to wait for the answers after the last request went out
+        send_rate (int): Maximum requests per second, 0 sends them all at once
+
+    Returns:
+        dict: { "key": (info: dict or None, rtt: float in seconds or None) }
+    """
+
+    loop = asyncio.get_running_loop()
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, A2S_RECEIVE_BUFFER)
+    except OSError:
+        pass
+    sock.bind(("0.0.0.0", 0))
+
+    transport, protocol = await loop.create_datagram_endpoint(QueryProtocol, sock=sock)
+
+    # Paced sending goes out in bursts every 10ms
+    burst = max(1, send_rate // 100) if send_rate else 0
+
+    try:
+        futures = {}
+        for key, endpoint in endpoints.items():
+            if endpoint is None:
+                continue
+
+            address = (endpoint[0], int(endpoint[1]))
+            if address not in protocol.pending:
+                protocol.query(address)
+
+                if burst and len(protocol.pending) % burst == 0:
+                    await asyncio.sleep(0.01)
+
+            futures[key] = protocol.pending[address]["future"]
+
+        if futures:
+            await asyncio.wait(set(futures.values()), timeout=timeout)
+
+        results = {}
+        for key in endpoints:
+            future = futures.get(key)
+            if future is not None and future.done():
+                results[key] = future.result()
+            else:
+                results[key] = (None, None)
+
+        a2s_stats["timeouts"] += sum(1 for future in set(futures.values()) if not future.done())
+
+        return results
+
+    finally:
+        transport.close()
@@ -0,0 +1,255 @@
+"""
+Warm-start checkpoint of the operator's in-memory state, kept in a ConfigMap
+"""
+
+import asyncio
+import base64
+import json
+import os
+import random
+import time
+import zlib
+import modules.forwarder as forwarder
+import modules.ports as ports
+import modules.ratelimit as ratelimit
+import modules.service_index as service_index
+import modules.shards as shards
+import modules.tcp_probe as probe
+import modules.utils as utils
+
+#  ------------------------
+#           VARS
+#  ------------------------
+CHECKPOINT_VERSION = 3
+CHECKPOINT_KEY = "snapshot.json.z"
+CHECKPOINT_MAX_BYTES = 1000 * 1024
+# ConfigMaps are limited to 1 MiB
+
+SERVICE_FIELDS = ["name", "uuid", "ip", "port", "ingress_ip", "owner", "standby", "namespace"]
+TARGET_FIELDS = ["name", "verdict", "query", "interval"]
+# Entries are stored as lists in this order, which keeps the snapshot compact
+
+CHECKPOINT_ENABLED = os.environ.get("CHECKPOINT_ENABLED", "true").lower() in ("true", "1", "yes") and not shards.SHARDING_ENABLED
+# Replicas of a sharded operator do not share their state
+CHECKPOINT_NAME = os.environ.get("CHECKPOINT_NAME") or "prismserver-operator-checkpoint"
+CHECKPOINT_NAMESPACE = os.environ.get("ENV_NAMESPACE") or "prism-servers"
+CHECKPOINT_INTERVAL = utils.env_float("CHECKPOINT_INTERVAL", 60.0)
+CHECKPOINT_MAX_AGE = utils.env_float("CHECKPOINT_MAX_AGE", 3600.0)
+CHECKPOINT_CONFIRM_DELAY = utils.env_float("CHECKPOINT_CONFIRM_DELAY", 60.0)
+
+checkpoint_state = {
+    "generation": 0,
+    "restored": False,
+    "ready": False,
+    "last_written": None,
+    "unconfirmed_services": set(),
+    "unconfirmed_targets": set()
+}
+# Restored objects stay unconfirmed until their first watch event, see confirm_service() and confirm_target()
+# The state is only written once it is "ready", i.e. complete
+
+checkpoint_stats = {
+    "writes": 0,
+    "skipped_writes": 0,
+    "bytes": 0,
+    "restored_services": 0,
+    "restored_targets": 0,
+    "pruned": 0
+}
+
+#  ------------------------
+#         FUNCTIONS
+#  ------------------------
+def take_snapshot():
+    """ Collect the state worth restoring
+
+    Returns:
+        dict: Snapshot, without its generation stamp
+    """
+
+    targets = {}
+    for obj_uuid, target in list(probe.probe_targets.items()):
+        targets[obj_uuid] = [target.get(field) for field in TARGET_FIELDS]
+
+    return {
+        "version": CHECKPOINT_VERSION,
+        "services": [[entry.get(field) for field in SERVICE_FIELDS] for entry in service_index.snapshot()],
+        "ports": base64.b64encode(bytes(ports.port_bitmap)).decode(),
+        "ports_range": [ports.PORT_MIN, ports.PORT_MAX],
+        "probe_targets": targets,
+        "forwarding_phases": dict(forwarder.forwarding_phases)
+    }
+
+def encode(snapshot):
+    """ Compress a snapshot for the ConfigMap, which is limited to 1 MiB """
+
+    return base64.b64encode(zlib.compress(json.dumps(snapshot, sort_keys=True, separators=(",", ":")).encode(), 9)).decode()
+
+def decode(data):
+    return json.loads(zlib.decompress(base64.b64decode(data)))
+
+def write(logger):
+    """ Write the checkpoint, unless the state did not change since the last write """
+
+    snapshot = take_snapshot()
+
+    # Compare without the stamp
+    content = encode(snapshot)
+    if content == checkpoint_state["last_written"]:
+        checkpoint_stats["skipped_writes"] += 1
+        return
+
+    checkpoint_state["generation"] += 1
+    stamped = dict(snapshot, generation=checkpoint_state["generation"], written=time.time())
+
+    data = encode(stamped)
+    if len(data) * 3 // 4 > CHECKPOINT_MAX_BYTES:
+        logger.warning(f"Checkpoint of {len(data) * 3 // 4} bytes exceeds the ConfigMap size limit, not writing it")
+        return
+
+    # Background write, any other call goes first
+    with ratelimit.priority(ratelimit.PROBE):
+        utils.apply_resource({
+            "apiVersion": "v1",
+            "kind": "ConfigMap",
+            "metadata": {
+                "name": CHECKPOINT_NAME,
+                "namespace": CHECKPOINT_NAMESPACE
+            },
+            "binaryData": {
+                CHECKPOINT_KEY: data
+            }
+        }, namespace=CHECKPOINT_NAMESPACE)
+
+    checkpoint_state["last_written"] = content
+    checkpoint_stats["writes"] += 1
+    checkpoint_stats["bytes"] = len(data)
+
+def load(logger):
+    """ Read the checkpoint
+
+    Returns:
+        dict: Snapshot, None if there is no usable one
+    """
+
+    try:
+        configmap = utils.kube_request("get", "ConfigMap", name=CHECKPOINT_NAME, namespace=CHECKPOINT_NAMESPACE).to_dict()
+    except Exception as e:
+        if getattr(e, "status", None) != 404:
+            logger.warning(f"Could not read checkpoint: {str(e)}")
+        return None
+
+    try:
+        snapshot = decode((configmap.get("binaryData") or {})[CHECKPOINT_KEY])
+    except Exception as e:
+        logger.warning(f"Ignoring unreadable checkpoint: {str(e)}")
+        return None
+
+    if snapshot.get("version") != CHECKPOINT_VERSION:
+        logger.info(f"Ignoring checkpoint of version {snapshot.get('version')}")
+        return None
+
+    if snapshot.get("ports_range") != [ports.PORT_MIN, ports.PORT_MAX]:
+        logger.info("Ignoring checkpoint of another port range")
+        return None
+
+    age = time.time() - snapshot.get("written", 0)
+    if age > CHECKPOINT_MAX_AGE:
+        logger.info(f"Ignoring checkpoint which is {age:.0f}s old")
+        return None
+
+    return snapshot
+
+def restore(snapshot, logger):
+    """ Seed the service index, port allocator, probe targets and forwarding phases from a snapshot
+
+    Watch events arriving afterwards are compared against the restored state, so only
+    what changed while the operator was down gets reconciled. The restored ports are
+    completed from the services on startup, see main.seed_port_allocator().
+
+    Args:
+        snapshot (dict): Snapshot returned by load()
+        logger: Logger to report to
+    """
+
+    services = [dict(zip(SERVICE_FIELDS, values)) for values in snapshot["services"]]
+    with service_index.index_lock:
+        for entry in services:
+            service_index.services_by_uuid[entry["uuid"]] = entry
+
+    bitmap = base64.b64decode(snapshot["ports"])
+    with ports.port_lock:
+        ports.port_bitmap[:] = bitmap
+        ports.port_state["used"] = sum(bin(byte).count("1") for byte in bitmap)
+    ports.port_state["seeded"] = True
+
+    now = time.monotonic()
+    for obj_uuid, values in snapshot["probe_targets"].items():
+        target = dict(zip(TARGET_FIELDS, values))
+        probe.probe_targets[obj_uuid] = dict(target, due=now + random.uniform(0, target["interval"]))
+
+    forwarder.forwarding_phases.update(snapshot["forwarding_phases"])
+
+    checkpoint_state["generation"] = snapshot["generation"]
+    checkpoint_state["restored"] = True
+    checkpoint_state["unconfirmed_services"] = {entry["uuid"] for entry in services}
+    checkpoint_state["unconfirmed_targets"] = set(snapshot["probe_targets"])
+
+    checkpoint_stats["restored_services"] = len(snapshot["services"])
+    checkpoint_stats["restored_targets"] = len(snapshot["probe_targets"])
+
+    logger.info(f"Restored checkpoint generation {snapshot['generation']}: {len(snapshot['services'])} services, "
+                f"{len(snapshot['probe_targets'])} probe targets, port occupancy {ports.occupancy():.2%}")
+
+def confirm_service(obj_uuid):
+    checkpoint_state["unconfirmed_services"].discard(obj_uuid)
+
+def confirm_target(obj_uuid):
+    checkpoint_state["unconfirmed_targets"].discard(obj_uuid)
+
+def prune_unconfirmed(logger):
+    """ Drop restored services and probe targets that were deleted while the operator was down """
+
+    for obj_uuid in list(checkpoint_state["unconfirmed_services"]):
+        with service_index.index_lock:
+            entry = service_index.services_by_uuid.pop(obj_uuid, None)
+
+        if entry:
+            ports.release(entry["port"])
+        forwarder.forwarding_phases.pop(obj_uuid, None)
+        checkpoint_stats["pruned"] += 1
+
+    for obj_uuid in list(checkpoint_state["unconfirmed_targets"]):
+        probe.probe_targets.pop(obj_uuid, None)
+        checkpoint_stats["pruned"] += 1
+
+    if checkpoint_state["unconfirmed_services"] or checkpoint_state["unconfirmed_targets"]:
+        logger.info(f"Pruned {len(checkpoint_state['unconfirmed_services'])} services and "
+                    f"{len(checkpoint_state['unconfirmed_targets'])} probe targets which are gone")
+
+    checkpoint_state["unconfirmed_services"] = set()
+    checkpoint_state["unconfirmed_targets"] = set()
+
+#  ------------------------
+#           LOGIC
+#  ------------------------
+async def run_checkpoints(logger):
+    """ Write the checkpoint periodically, once the initial watch events had time to arrive """
+
+    if checkpoint_state["restored"]:
+        await asyncio.sleep(CHECKPOINT_CONFIRM_DELAY)
+        prune_unconfirmed(logger)
+    else:
+        await asyncio.sleep(CHECKPOINT_INTERVAL)
+
+    checkpoint_state["ready"] = True
+
+    while True:
+        try:
+            await asyncio.to_thread(write, logger)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"run_checkpoints(): {str(e)}")
+
+        await asyncio.sleep(CHECKPOINT_INTERVAL)
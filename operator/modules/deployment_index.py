@@ -0,0 +1,114 @@
+"""
+Watch-fed index of the env of CS:GO deployments, keyed by custObjUuid
+"""
+
+import threading
+
+#  ------------------------
+#           VARS
+#  ------------------------
+deployments_by_uuid = {}
+# { "custObjUuid": { "name": "csgo-server-...", "uuid": "UUID-...", "generation": 3, "container": 0, "container_name": "csgo-server-...",
+#                    "env": [ { "name": "CSGO_PORT", "value": "27015" }, ... ] } }
+# Fed by watch events and by the responses of our own patches, see apply_event()
+
+index_lock = threading.Lock()
+
+#  ------------------------
+#         FUNCTIONS
+#  ------------------------
+def deployment_entry(body):
+    """ Extract the indexed fields from a Deployment body
+
+    Args:
+        body (dict): Deployment object
+
+    Returns:
+        dict: Index entry, None if the deployment is not a PrismServer deployment
+    """
+
+    metadata = body.get("metadata") or {}
+    labels = metadata.get("labels") or {}
+    containers = (((body.get("spec") or {}).get("template") or {}).get("spec") or {}).get("containers") or []
+
+    obj_uuid = labels.get("custObjUuid")
+    if not obj_uuid or not containers:
+        return None
+
+    # The server container is named like its deployment
+    container = next((index for index, container in enumerate(containers) if container.get("name") == metadata["name"]), 0)
+
+    return {
+        "name": metadata["name"],
+        "uuid": obj_uuid,
+        "generation": metadata.get("generation") or 0,
+        "container": container,
+        "container_name": containers[container].get("name"),
+        "env": [dict(var) for var in containers[container].get("env") or []]
+    }
+
+def apply_event(event_type, body):
+    """ Update the index from a Deployment watch event or patch response
+
+    The watch lags behind our own patches, events older than the indexed generation are ignored.
+
+    Args:
+        event_type (string): Watch event type (None, ADDED, MODIFIED, DELETED)
+        body (dict): Deployment object
+
+    Returns:
+        dict: Current entry, None if the deployment is gone or not indexed
+    """
+
+    entry = deployment_entry(body)
+    if entry is None:
+        return None
+
+    with index_lock:
+        if event_type == "DELETED":
+            previous = deployments_by_uuid.get(entry["uuid"])
+            if previous and previous["name"] == entry["name"]:
+                del deployments_by_uuid[entry["uuid"]]
+            return None
+
+        previous = deployments_by_uuid.get(entry["uuid"])
+        if previous and previous["name"] == entry["name"] and previous["generation"] > entry["generation"]:
+            return previous
+
+        deployments_by_uuid[entry["uuid"]] = entry
+
+    return entry
+
+def lookup(obj_uuid):
+    """ Return the indexed deployment of a PrismServer
+
+    Args:
+        obj_uuid (string): custObjUuid of the PrismServer
+
+    Returns:
+        dict: Index entry, None if unknown
+    """
+
+    return deployments_by_uuid.get(obj_uuid)
+
+def env_patch(entry, env):
+    """ Minimal JSON patch replacing the env of the server container, None if it is already up to date
+
+    Args:
+        entry (dict): Index entry of the deployment
+        env (list): Desired env of the server container
+
+    Returns:
+        list: JSON patch operations, or None
+    """
+
+    if entry["env"] == env:
+        return None
+
+    path = f"/spec/template/spec/containers/{entry['container']}/env"
+
+    return [
+        # Fails instead of clobbering if the deployment changed since it was indexed
+        {"op": "test", "path": f"/spec/template/spec/containers/{entry['container']}/name", "value": entry["container_name"]},
+        {"op": "add", "path": path, "value": env}
+    ]
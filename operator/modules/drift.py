@@ -0,0 +1,409 @@
+"""
+Drift detection and self-healing of the Deployments and Services managed for PrismServers
+
+Every managed object carries the hash of its rendered spec. Watch events only hash the
+managed part of the live object and compare it against the desired hash, which is computed
+once per PrismServer change, so objects are only re-applied when they actually differ.
+"""
+
+import asyncio
+import collections.abc
+import hashlib
+import json
+import logging
+import os
+import time
+import kopf
+import modules.resources as resources
+import modules.service_index as service_index
+import modules.shards as shards
+import modules.utils as utils
+
+#  ------------------------
+#           VARS
+#  ------------------------
+HASH_ANNOTATION = "prism-hosting.ch/spec-hash"
+PORT_ANNOTATION = "prism-hosting.ch/port"
+# Port of the server, set on the PrismServer so a changed Service port is detected as drift
+CLAIM_ANNOTATION = "prism-hosting.ch/claimed-from"
+# Identity a claimed standby server was rendered with, see pool.claim()
+
+DRIFT_ENABLED = os.environ.get("DRIFT_ENABLED", "true").lower() in ("true", "1", "yes")
+DRIFT_SWEEP_INTERVAL = utils.env_float("DRIFT_SWEEP_INTERVAL", 60.0)
+DRIFT_MISSING_GRACE = utils.env_float("DRIFT_MISSING_GRACE", 60.0)
+# Seconds a managed object must be missing before it is re-created
+
+KINDS = ["Service", "Deployment"]
+
+servers = {}
+# { "custObjUuid": { "name": "prismserver-name", "namespace": "prism-servers", "uid": "...", "customer": "...",
+#                    "sub_start": "...", "env": [ ... ], "port": 27015 or None, "deleting": False,
+#                    "claim": { "name": "pool", "customer": "standby", "subscriptionStart": "..." } or None,
+#                    "hashes": (port, { "Service": "...", "Deployment": "..." }) or None } }
+# Inputs of the desired state, fed by PrismServer watch events
+
+live_views = {}
+# { ("Deployment", "custObjUuid"): { "name": "csgo-server-...", "hash": "...", "stamp": "..." or None, "repaired": "..." or None } }
+# Hash of the managed part of each live object and the hash it is annotated with
+
+missing_since = {}
+# { ("Deployment", "custObjUuid"): monotonic time the sweep first found it missing }
+
+healing = set()
+# Objects with a repair in flight
+
+drift_stats = {
+    "checks": 0,
+    "stamped": 0,
+    "repaired": 0,
+    "recreated": 0,
+    "unrepairable": 0,
+    "failed": 0
+}
+
+render_logger = logging.getLogger(__name__)
+
+#  ------------------------
+#         FUNCTIONS
+#  ------------------------
+def project(live, shape):
+    """ Reduce an object to the fields the template manages, so defaults set by the API server are ignored
+
+    Args:
+        live: Node of the live object
+        shape: Node of the parsed template, with its placeholders as sentinel strings
+
+    Returns:
+        Projected node
+    """
+
+    if isinstance(shape, dict):
+        # Watch events deliver kopf bodies, which are mappings but no dicts
+        if not isinstance(live, collections.abc.Mapping):
+            return live
+
+        return {key: project(live.get(key), value) for key, value in shape.items()}
+
+    if isinstance(shape, list) and isinstance(live, list):
+        # Items the template does not know about are kept as they are, so they count as drift
+        return [project(item, item_shape) for item, item_shape in zip(live, shape)] + live[len(shape):]
+
+    return live
+
+def spec_hash(kind, body):
+    """ Hash the managed part of a Service or Deployment
+
+    Args:
+        kind (string): Service or Deployment
+        body (dict): Object, rendered or live
+
+    Returns:
+        string: Hex digest
+    """
+
+    view = json.dumps(project(body, resources.templates[kind]), sort_keys=True, separators=(",", ":"))
+
+    return hashlib.sha256(view.encode()).hexdigest()[:32]
+
+def stamp(body):
+    """ Annotate a rendered body with its spec hash, before it is applied """
+
+    body["metadata"].setdefault("annotations", {})[HASH_ANNOTATION] = spec_hash(body["kind"], body)
+
+    return body
+
+def track_server(event_type, body):
+    """ Record the inputs of a PrismServer's desired state from its watch event
+
+    Args:
+        event_type (string): Watch event type (None, ADDED, MODIFIED, DELETED)
+        body (dict): PrismServer object
+
+    Returns:
+        string: custObjUuid if the desired state may have changed, else None
+    """
+
+    metadata = body.get("metadata") or {}
+    labels = metadata.get("labels") or {}
+    obj_uuid = labels.get("custObjUuid")
+
+    if not obj_uuid:
+        return None
+
+    if event_type == "DELETED":
+        servers.pop(obj_uuid, None)
+        for kind in KINDS:
+            live_views.pop((kind, obj_uuid), None)
+            missing_since.pop((kind, obj_uuid), None)
+        return None
+
+    annotations = metadata.get("annotations") or {}
+    port = annotations.get(PORT_ANNOTATION)
+    entry = {
+        "name": metadata["name"],
+        "namespace": metadata["namespace"],
+        "uid": metadata.get("uid"),
+        "customer": labels.get("customer"),
+        "sub_start": labels.get("subscriptionStart"),
+        "env": [{"name": var["name"], "value": var["value"]} for var in (body.get("spec") or {}).get("env") or []],
+        "port": int(port) if port else None,
+        "claim": json.loads(annotations[CLAIM_ANNOTATION]) if annotations.get(CLAIM_ANNOTATION) else None,
+        "deleting": bool(metadata.get("deletionTimestamp"))
+    }
+
+    previous = servers.get(obj_uuid)
+    if previous and all(previous[key] == value for key, value in entry.items()):
+        return None
+
+    servers[obj_uuid] = dict(entry, hashes=None)
+
+    # A new desired state may be reachable from states which could not be repaired before
+    for kind in KINDS:
+        if (kind, obj_uuid) in live_views:
+            live_views[(kind, obj_uuid)].update(repaired=None, unrepairable=False)
+
+    return obj_uuid
+
+def server_port(obj_uuid):
+    """ Port of a server, from its PrismServer or else from its indexed Service """
+
+    server = servers[obj_uuid]
+    if server["port"]:
+        return server["port"]
+
+    service = service_index.lookup(obj_uuid)
+
+    return service["port"] if service else None
+
+def desired_body(obj_uuid, kind):
+    """ Render the desired Service or Deployment of a PrismServer
+
+    Args:
+        obj_uuid (string): custObjUuid of the PrismServer
+        kind (string): Service or Deployment
+
+    Returns:
+        dict: Stamped body, None if the desired state is not known (yet)
+    """
+
+    server = servers.get(obj_uuid)
+    port = server and server_port(obj_uuid)
+    if not port or not server["customer"] or not server["sub_start"]:
+        return None
+
+    # Rejected by create(), never render them
+    if any(not isinstance(var["value"], str) for var in server["env"]):
+        return None
+
+    # Claimed standby servers keep the names, selector and pod labels they were rendered with
+    identity = server["claim"] or {"name": server["name"], "customer": server["customer"], "subscriptionStart": server["sub_start"]}
+
+    labels = {
+        'customer': identity["customer"],
+        'subscriptionStart': identity["subscriptionStart"],
+        'custObjUuid': obj_uuid
+    }
+
+    if kind == "Service":
+        body = resources.get_service_body(render_logger, obj_uuid, identity["name"], server["namespace"], identity["customer"], port, labels)
+    else:
+        body = resources.get_deployment_body(render_logger, obj_uuid, identity["name"], server["namespace"], identity["customer"], port, labels, server["env"])
+
+    if server["claim"]:
+        body["metadata"]["labels"].update(customer=server["customer"], subscriptionStart=server["sub_start"])
+
+    return stamp(body)
+
+def desired_hash(obj_uuid, kind):
+    """ Desired spec hash of a PrismServer's Service or Deployment, cached until its inputs change """
+
+    server = servers.get(obj_uuid)
+    if not server:
+        return None
+
+    port = server_port(obj_uuid)
+    if server["hashes"] is None or server["hashes"][0] != port:
+        hashes = {}
+        for body_kind in KINDS:
+            body = desired_body(obj_uuid, body_kind)
+            hashes[body_kind] = body and body["metadata"]["annotations"][HASH_ANNOTATION]
+
+        server["hashes"] = (port, hashes)
+
+    return server["hashes"][1][kind]
+
+def observe(kind, event_type, body):
+    """ Record the spec hash of a live Service or Deployment from its watch event
+
+    Args:
+        kind (string): Service or Deployment
+        event_type (string): Watch event type (None, ADDED, MODIFIED, DELETED)
+        body (dict): Object
+
+    Returns:
+        string: custObjUuid of the object, None if it is not managed
+    """
+
+    metadata = body.get("metadata") or {}
+    obj_uuid = (metadata.get("labels") or {}).get("custObjUuid")
+    if not obj_uuid:
+        return None
+
+    key = (kind, obj_uuid)
+    if event_type == "DELETED":
+        if (live_views.get(key) or {}).get("name") == metadata.get("name"):
+            del live_views[key]
+        return obj_uuid
+
+    previous = live_views.get(key) or {}
+    live_views[key] = {
+        "name": metadata.get("name"),
+        "hash": spec_hash(kind, body),
+        "stamp": (metadata.get("annotations") or {}).get(HASH_ANNOTATION),
+        "repaired": previous.get("repaired")
+    }
+    missing_since.pop(key, None)
+
+    return obj_uuid
+
+def pending_action(obj_uuid, kind, now=None):
+    """ Decide how to heal a managed object
+
+    Args:
+        obj_uuid (string): custObjUuid of the PrismServer
+        kind (string): Service or Deployment
+        now (float): Monotonic time of a sweep, missing objects are only re-created by sweeps
+
+    Returns:
+        string: "repair", "recreate", "stamp" or None
+    """
+
+    server = servers.get(obj_uuid)
+    if not server or server["deleting"]:
+        return None
+
+    expected = desired_hash(obj_uuid, kind)
+    if expected is None:
+        return None
+
+    key = (kind, obj_uuid)
+    view = live_views.get(key)
+    drift_stats["checks"] += 1
+
+    if view is None:
+        if now is None:
+            return None
+
+        # The watch may not have delivered the object yet
+        if now - missing_since.setdefault(key, now) < DRIFT_MISSING_GRACE:
+            return None
+
+        return "recreate"
+
+    if view["hash"] != expected:
+        # Already re-applied from this very state, the API server keeps it different
+        if view["hash"] == view["repaired"]:
+            if not view.get("unrepairable"):
+                view["unrepairable"] = True
+                drift_stats["unrepairable"] += 1
+            return None
+
+        return "repair"
+
+    if view["stamp"] != expected:
+        # E.g. after update_env() patched the env, or objects created before they were stamped
+        return "stamp"
+
+    return None
+
+def heal(obj_uuid, kind, action, logger):
+    """ Re-apply or re-stamp a managed object
+
+    Args:
+        obj_uuid (string): custObjUuid of the PrismServer
+        kind (string): Service or Deployment
+        action (string): Result of pending_action()
+        logger: Logger to report to
+    """
+
+    server = servers[obj_uuid]
+    key = (kind, obj_uuid)
+
+    if action == "stamp":
+        utils.patch_resource(live_views[key]["name"], {"metadata": {"annotations": {HASH_ANNOTATION: desired_hash(obj_uuid, kind)}}},
+                             kind=kind, namespace=server["namespace"])
+        drift_stats["stamped"] += 1
+        return
+
+    body = desired_body(obj_uuid, kind)
+    kopf.adopt(body, owner={
+        "apiVersion": "prism-hosting.ch/v1",
+        "kind": "PrismServer",
+        "metadata": {"name": server["name"], "namespace": server["namespace"], "uid": server["uid"]}
+    })
+
+    if action == "repair":
+        live_views[key]["repaired"] = live_views[key]["hash"]
+
+    utils.apply_resource(body, namespace=server["namespace"])
+
+    if action == "recreate":
+        missing_since.pop(key, None)
+        drift_stats["recreated"] += 1
+        logger.info(f"Re-created missing {kind} {body['metadata']['name']}")
+    else:
+        drift_stats["repaired"] += 1
+        logger.info(f"Repaired drifted {kind} {body['metadata']['name']}")
+
+#  ------------------------
+#           LOGIC
+#  ------------------------
+async def check(obj_uuid, logger, now=None):
+    """ Heal the Service and Deployment of a PrismServer if they drifted, on the owning replica only
+
+    Args:
+        obj_uuid (string): custObjUuid of the PrismServer
+        logger: Logger to report to
+        now (float): Monotonic time of a sweep, see pending_action()
+    """
+
+    if not DRIFT_ENABLED or not obj_uuid:
+        return
+
+    # Route by the PrismServer's key once its service is known, its own watch event may not have arrived yet
+    service = service_index.lookup(obj_uuid)
+    if not (shards.owns_service(service) if service else shards.owns(obj_uuid)):
+        return
+
+    for kind in KINDS:
+        key = (kind, obj_uuid)
+        if key in healing:
+            continue
+
+        action = pending_action(obj_uuid, kind, now)
+        if action is None:
+            continue
+
+        healing.add(key)
+        try:
+            await asyncio.to_thread(heal, obj_uuid, kind, action, logger)
+        except Exception as e:
+            drift_stats["failed"] += 1
+            logger.warning(f"Could not heal {kind} of {obj_uuid}: {str(e)}")
+        finally:
+            healing.discard(key)
+
+async def run_drift_sweep(logger):
+    """ Periodically check all known PrismServers, which covers missed events and missing objects """
+
+    while True:
+        await asyncio.sleep(DRIFT_SWEEP_INTERVAL)
+
+        now = time.monotonic()
+        for obj_uuid in list(servers):
+            try:
+                await check(obj_uuid, logger, now=now)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"run_drift_sweep(): {str(e)}")
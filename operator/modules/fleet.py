@@ -0,0 +1,285 @@
+"""
+Bulk provisioning of PrismServers declared by a PrismServerFleet
+"""
+
+import time
+import kopf
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import modules.drift as drift
+import modules.label_baseline as label_baseline
+import modules.ports as ports
+import modules.resources as resources
+import modules.shards as shards
+import modules.utils as utils
+
+#  ------------------------
+#           VARS
+#  ------------------------
+FLEET_LABEL = "prism-hosting.ch/fleet"
+# Set on every PrismServer of a fleet, its value is the fleet's name
+
+FLEET_CONCURRENCY = utils.env_int("FLEET_CONCURRENCY", 16)
+# Servers created in parallel
+
+fleet_members = {}
+# { "fleet uid": { "name": "fleet-name", "namespace": "prism-servers",
+#                  "members": { "fleet-name-0": (tcpProbeResponding, forwarding available) } } }
+# Fed by PrismServer watch events, see track_member()
+
+fleet_stats = {
+    "expansions": 0,
+    "created": 0,
+    "deleted": 0,
+    "updated": 0,
+    "failed": 0
+}
+
+#  ------------------------
+#         FUNCTIONS
+#  ------------------------
+def member_name(fleet_name, index):
+    return f"{fleet_name}-{index}"
+
+def member_index(fleet_name, name):
+    """ Index of a member from its name, None if it does not follow member_name() """
+
+    suffix = name[len(fleet_name) + 1:]
+
+    return int(suffix) if name.startswith(f"{fleet_name}-") and suffix.isdigit() else None
+
+def member_env(env, overrides, index):
+    """ Env of a member: the shared env, with the variables of its override replaced or added
+
+    Args:
+        env (list): Shared env of the fleet
+        overrides (list): Per-replica overrides, [ { "index": 0, "env": [ ... ] } ]
+        index (int): Index of the member
+
+    Returns:
+        list: Env of the member
+    """
+
+    merged = {var["name"]: var["value"] for var in env or []}
+
+    for override in overrides or []:
+        if override.get("index") == index:
+            merged.update({var["name"]: var["value"] for var in override.get("env") or []})
+
+    return [{"name": name, "value": value} for name, value in merged.items()]
+
+def owner_reference(body):
+    """ Owner to adopt objects with, without propagating its labels like kopf.adopt() would """
+
+    metadata = body["metadata"]
+
+    return {
+        "apiVersion": body["apiVersion"],
+        "kind": body["kind"],
+        "metadata": {"name": metadata["name"], "namespace": metadata["namespace"], "uid": metadata["uid"]}
+    }
+
+def render_member(fleet_body, index, port, customer, sub_start, env, logger):
+    """ Render a member PrismServer, labelled like create() would label it, and its Service and Deployment
+
+    Returns:
+        tuple: (PrismServer body, [Service body, Deployment body])
+    """
+
+    name = member_name(fleet_body["metadata"]["name"], index)
+    namespace = fleet_body["metadata"]["namespace"]
+
+    bodies = resources.get_resources(logger, name, namespace, customer, sub_start, env, port=port)
+    deployment = next(body for body in bodies if body["kind"] == "Deployment")
+    labels = dict(deployment["metadata"]["labels"])
+
+    annotations = label_baseline.baseline_annotation(labels)["metadata"]["annotations"]
+    annotations[drift.PORT_ANNOTATION] = str(port)
+
+    server = {
+        "apiVersion": "prism-hosting.ch/v1",
+        "kind": "PrismServer",
+        "metadata": {
+            "name": name,
+            "namespace": namespace,
+            "labels": dict(labels, **{FLEET_LABEL: fleet_body["metadata"]["name"]}, **shards.object_labels(namespace, name)),
+            "annotations": annotations
+        },
+        "spec": {
+            "customer": customer,
+            "subscriptionStart": int(sub_start),
+            "env": env
+        }
+    }
+    kopf.adopt(server, owner=owner_reference(fleet_body))
+
+    for body in bodies:
+        drift.stamp(body)
+
+    return server, bodies
+
+def provision_member(server, bodies):
+    """ Create a rendered member, removing it again if its Service or Deployment fails
+
+    Returns:
+        string: Name of the created PrismServer
+    """
+
+    namespace = server["metadata"]["namespace"]
+    created = utils.apply_resource(server, namespace=namespace).to_dict()
+    label_baseline.remember(server["metadata"]["name"], {key: value for key, value in server["metadata"]["labels"].items() if key not in (FLEET_LABEL, shards.SHARD_LABEL)})
+
+    try:
+        for body in bodies:
+            kopf.adopt(body, owner=owner_reference(created))
+            utils.apply_resource(body, namespace=namespace)
+    except Exception:
+        # Takes its Service and Deployment with it, if any
+        utils.delete_resource(server["metadata"]["name"], "PrismServer", namespace=namespace)
+        raise
+
+    return server["metadata"]["name"]
+
+def expand(fleet_body, logger):
+    """ Create the missing members of a fleet, roll env changes out to the existing ones and delete the ones beyond its replicas
+
+    Ports are allocated in one batch and all members are rendered before FLEET_CONCURRENCY
+    workers create them in parallel.
+
+    Args:
+        fleet_body (dict): PrismServerFleet object
+        logger: Logger to report to
+
+    Returns:
+        dict: { "created": [names], "updated": [names], "deleted": [names], "failed": { name: error } }
+    """
+
+    spec = fleet_body["spec"]
+    fleet_name = fleet_body["metadata"]["name"]
+    namespace = fleet_body["metadata"]["namespace"]
+    replicas = spec.get("replicas", 0)
+
+    for var in spec.get("env") or []:
+        if isinstance(var["value"], bool):
+            raise kopf.PermanentError(f"A bool cannot be accepted here: spec.env['{var['name']}']. Must be a string.")
+
+    existing = utils.kube_request("get", "PrismServer", namespace=namespace, label_selector=f"{FLEET_LABEL}={fleet_name}").to_dict()["items"]
+    indexes = {member_index(fleet_name, server["metadata"]["name"]) for server in existing}
+
+    result = {"created": [], "updated": [], "deleted": [], "failed": {}}
+
+    for server in existing:
+        name = server["metadata"]["name"]
+        index = member_index(fleet_name, name)
+        if index is None:
+            continue
+
+        # Scale down, the members' delete handlers clean up their forwards
+        if index >= replicas:
+            utils.delete_resource(name, "PrismServer", namespace=namespace)
+            result["deleted"].append(name)
+            fleet_stats["deleted"] += 1
+            continue
+
+        # The members' update_env handlers patch their Deployments
+        env = member_env(spec.get("env"), spec.get("overrides"), index)
+        if (server.get("spec") or {}).get("env") != env:
+            utils.patch_resource(name, {"spec": {"env": env}}, namespace=namespace)
+            result["updated"].append(name)
+            fleet_stats["updated"] += 1
+
+    missing = [index for index in range(replicas) if index not in indexes]
+    if not missing:
+        return result
+
+    fleet_stats["expansions"] += 1
+    logger.info(f"Fleet {fleet_name}: creating {len(missing)} servers")
+
+    sub_start = str(spec.get("subscriptionStart") or int(time.time()))
+    try:
+        allocated = resources.allocate_random_ports(len(missing))
+    except Exception as e:
+        raise kopf.TemporaryError(f"expand(): {str(e)}", delay=30)
+
+    try:
+        members = [
+            render_member(fleet_body, index, port, spec["customer"], sub_start, member_env(spec.get("env"), spec.get("overrides"), index), logger) + (port, )
+            for index, port in zip(missing, allocated)
+        ]
+    except Exception:
+        for port in allocated:
+            ports.release(port)
+        raise
+
+    with ThreadPoolExecutor(max_workers=min(FLEET_CONCURRENCY, len(members))) as executor:
+        futures = {executor.submit(provision_member, server, bodies): (server["metadata"]["name"], port)
+                   for server, bodies, port in members}
+
+        for future in as_completed(futures):
+            name, port = futures[future]
+            try:
+                result["created"].append(future.result())
+                fleet_stats["created"] += 1
+            except Exception as e:
+                ports.release(port)
+                result["failed"][name] = str(e)
+                fleet_stats["failed"] += 1
+
+    logger.info(f"Fleet {fleet_name}: created {len(result['created'])}, updated {len(result['updated'])}, deleted {len(result['deleted'])}, failed {len(result['failed'])}")
+
+    return result
+
+def track_member(event_type, body):
+    """ Record the state of a fleet member from its watch event
+
+    Args:
+        event_type (string): Watch event type (None, ADDED, MODIFIED, DELETED)
+        body (dict): PrismServer object
+
+    Returns:
+        tuple: (fleet uid, fleet entry) if the fleet's aggregated status changed, else None
+    """
+
+    metadata = body.get("metadata") or {}
+    fleet_name = (metadata.get("labels") or {}).get(FLEET_LABEL)
+    owner = next((ref for ref in metadata.get("ownerReferences") or [] if ref.get("kind") == "PrismServerFleet"), None)
+    if not fleet_name or not owner:
+        return None
+
+    fleet = fleet_members.setdefault(owner["uid"], {"name": fleet_name, "namespace": metadata["namespace"], "members": {}})
+
+    if event_type == "DELETED":
+        if fleet["members"].pop(metadata["name"], None) is None:
+            return None
+
+        # Fleets are gone once their last member is
+        if not fleet["members"]:
+            del fleet_members[owner["uid"]]
+
+        return owner["uid"], fleet
+
+    status = body.get("status") or {}
+    state = (bool(status.get("tcpProbeResponding")), bool((status.get("forwarding") or {}).get("available")))
+    if fleet["members"].get(metadata["name"]) == state:
+        return None
+
+    fleet["members"][metadata["name"]] = state
+
+    return owner["uid"], fleet
+
+def aggregated_status(fleet):
+    """ Status patch of a fleet, from the state of its members
+
+    Args:
+        fleet (dict): Entry of fleet_members
+
+    Returns:
+        dict: Merge-patch
+    """
+
+    members = fleet["members"].values()
+
+    return {"status": {
+        "servers": len(members),
+        "responding": sum(1 for responding, _ in members if responding),
+        "forwarding": sum(1 for _, forwarding in members if forwarding)
+    }}
@@ -1,100 +1,61 @@
 """
 Module to automatically forwards ports to CS:GO services on a UDM SE.
+
+Runs as a task in the operator's event loop, see run_forwarder().
 """
 
-from openshift.dynamic import DynamicClient
+import asyncio
 import kopf
-import kubernetes
-import os
+import logging
+import time
 import uuid
-import kopf
-import datetime
-import kubernetes
+import modules.metrics as metrics
+import modules.patch_queue as patch_queue
+import modules.profiling as profiling
+import modules.ratelimit as ratelimit
+import modules.service_index as service_index
+import modules.shards as shards
+import modules.unifi as unifi
 import modules.utils as utils
 
-import requests
-import urllib3
-
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
-
 #  ------------------------
 #           VARS
 #  ------------------------
-unifi_auth_data = {
-    "data": None,
-    "expiry": None
-}
+PORTFORWARD_PATH = "/proxy/network/api/s/default/rest/portforward"
 
-#  ------------------------
-#         FUNCTIONS
-#  ------------------------
-def do_unifi_request(mode, target_url, json=None, cookies=None, csrf_token=None):
-    """ Do a general web request, tailored to the Unifi API
+FORWARD_QUEUE_SIZE = utils.env_int("FORWARD_QUEUE_SIZE", 1024)
 
-    Args:
-        mode (string): Type of request
-        target_url (string): Target URL
-        json (dict): Body dict
-        cookies (dict): Cookie dict
-        csrf_token (string): CSRF token
+reconcile_queue = asyncio.Queue(maxsize=FORWARD_QUEUE_SIZE)
+# custObjUuids of services whose port forward should be reconciled
+# Bounded, a full queue makes the service event handlers wait
 
-    Returns:
-        response: Response object
-    """
-    
-    request_headers = {
-        "Accept": "*/*",
-        "Content-Type": "application/json"
-    }
-    
-    if csrf_token:
-        request_headers["X-CSRF-Token"] = csrf_token
-    
-    try:
-        session = requests.Session()
-        response = getattr(session, mode)(target_url, headers=request_headers, json=json, cookies=cookies, verify=False)
-        
-        session.close()
-            
-    except Exception as e:
-            raise ValueError(f"Error during request: {str(e)}")   
-        
-    return response  
+forwarding_phases = {}
+# { "custObjUuid": "Pending" | "Forwarded" | "Forwarding failed" }
 
-def unifi_api_logon():
-    """ Logs onto Unifi API
+FORWARD_RESYNC_INTERVAL = utils.env_float("FORWARD_RESYNC_INTERVAL", 300.0)
+FORWARD_DEBOUNCE = utils.env_float("FORWARD_DEBOUNCE", 0.2)
 
-    Returns:
-        dict = [ cookies: dict, csrf: string ]
-    """
-    
-    target_url = f"https://{os.environ['UNIFI_API_HOST']}/api/auth/login"
-    auth_payload = {
-        "username": os.environ['UNIFI_API_USER'],
-        "password": os.environ['UNIFI_API_PASS']
-    }
-    
-    # Only execute if auth has not yet expired
-    if unifi_auth_data["expiry"]:
-        now = datetime.datetime.now()
-        if now < unifi_auth_data["expiry"]:
-            # Not yet expired
-            return unifi_auth_data["data"]
-    
-    response = do_unifi_request("post", target_url, auth_payload)
-    response.raise_for_status()
-    
-    returnObj = {
-        # {'TOKEN': 'ey123...', ""}
-        "cookies": response.cookies,
-        "csrf": response.headers["X-CSRF-TOKEN"]
-    }
-    
-    unifi_auth_data["data"] = returnObj
-    unifi_auth_data["expiry"] = datetime.datetime.now() + datetime.timedelta(hours=1)
-    
-    return unifi_auth_data["data"]
-    
+pending_deletions = {}
+# { "ip": [Future, ...] } IPs whose rules are deleted in the next batch, with the delete handlers waiting for them
+
+deletions_requested = asyncio.Event()
+
+deletion_stats = {
+    "batches": 0,
+    "ips": 0,
+    "rules": 0,
+    "failed": 0
+}
+
+FORWARD_DELETE_WINDOW = utils.env_float("FORWARD_DELETE_WINDOW", 0.2)
+FORWARD_DELETE_CONCURRENCY = utils.env_int("FORWARD_DELETE_CONCURRENCY", unifi.UNIFI_POOL_SIZE)
+FORWARD_DELETE_TIMEOUT = utils.env_float("FORWARD_DELETE_TIMEOUT", 60.0)
+
+logger = logging.getLogger(__name__)
+
+#  ------------------------
+#         FUNCTIONS
+#  ------------------------
 def create_port_forward_body(target_ip, target_port):
     """ Create UDM SE/PRO port forwarding request body
 
@@ -121,196 +82,451 @@ def create_port_forward_body(target_ip, target_port):
     
     return body
     
-def create_port_forward(target_ip, target_port):
+async def create_port_forward(target_ip, target_port):
     """ Create UDM SE/PRO port forwarding rule
 
     Args:
         target_ip (string): IP of host to forward to.
         target_port (string): Port (source and dest) to forward.
+
+    Returns:
+        dict: Created port forwarding entry, None if the UDM did not return it
     """
-    
-    target_url = f"https://{os.environ['UNIFI_API_HOST']}/proxy/network/api/s/default/rest/portforward"
-    
+
     try:
-        auth = unifi_api_logon()
         body = create_port_forward_body(target_ip, target_port)
-        
-        response = do_unifi_request("post", target_url, body, cookies=auth["cookies"], csrf_token=auth["csrf"])
-        
+
+        response = await unifi.request("post", PORTFORWARD_PATH, json=body)
+
         if not response.status_code == 200:
             raise ValueError(f"Status code is {str(response.status_code)} - {response.text}")
-        
+
+        created = response.json().get("data") or [None]
+        return created[0]
+
     except Exception as e:
         raise ValueError(f"create_port_forward() error: {str(e)}")
 
-def delete_port_forward(id):
+async def delete_port_forward(id):
     """ Delete UDM SE/PRO port forwarding rule
 
     Args:
         target_ip (string): ID of port forward object
+
+    Returns:
+        bool: True if the rule was deleted
     """
-    
-    target_url = f"https://{os.environ['UNIFI_API_HOST']}/proxy/network/api/s/default/rest/portforward/{id}"
-    
+
     try:
-        auth = unifi_api_logon()
-        response = do_unifi_request("delete", target_url, cookies=auth["cookies"], csrf_token=auth["csrf"])
-        
+        response = await unifi.request("delete", f"{PORTFORWARD_PATH}/{id}")
+
         if not response.status_code == 200:
             raise ValueError(f"Status code is {str(response.status_code)} - {response.text}")
-        
+
     except Exception as e:
-        print(f"delete_port_forward() Error: {str(e)}")
-    
-    
+        logger.error(f"delete_port_forward() Error: {str(e)}")
+        return False
+
     return True
-        
-def get_port_forward():
+
+async def update_port_forward(forward, target_port):
+    """ Point an existing UDM SE/PRO port forwarding rule to another port
+
+    Args:
+        forward (dict): Existing port forwarding entry
+        target_port (string): Port (source and dest) to forward
+
+    Returns:
+        dict: Updated port forwarding entry
+    """
+
+    try:
+        body = dict(forward, dst_port=target_port, fwd_port=target_port)
+
+        response = await unifi.request("put", f"{PORTFORWARD_PATH}/{forward['_id']}", json=body)
+
+        if not response.status_code == 200:
+            raise ValueError(f"Status code is {str(response.status_code)} - {response.text}")
+
+        return body
+
+    except Exception as e:
+        raise ValueError(f"update_port_forward() error: {str(e)}")
+
+async def get_port_forward():
     """ Get UDM SE/PRO port forwarding rules
-    
+
     Returns:
         dict: Port forwarding entries
     """
-    
-    target_url = f"https://{os.environ['UNIFI_API_HOST']}/proxy/network/api/s/default/rest/portforward"
-    
+
     try:
-        auth = unifi_api_logon()
-        response = do_unifi_request("get", target_url, cookies=auth["cookies"], csrf_token=auth["csrf"])
-        
+        response = await unifi.request("get", PORTFORWARD_PATH)
+
         if not response.status_code == 200:
             raise ValueError(f"Status code is {str(response.status_code)} - {response.text}")
-        
+
     except Exception as e:
-        print(f"get_port_forward() failed: {str(e)}")
-        
+        raise ValueError(f"get_port_forward() failed: {str(e)}")
+
     return response.json()
 
-def delete_port_forward_by_ip(ip):
+async def delete_port_forwards(ips):
+    """ Delete the port forwards of many IPs against one table fetch, with bounded concurrency
+
+    Args:
+        ips (list): IP addresses the deleted services used to have
+
+    Returns:
+        dict: { "ip": None if all its rules are gone, error message otherwise }
+    """
+
+    # The table fetch holds up every deletion of the batch, it must not queue behind creates
+    with ratelimit.priority(ratelimit.DELETE):
+        forwards = index_forwards((await get_port_forward())["data"])["by_ip"]
+        rules = [(ip, forward) for ip in ips for forward in forwards.get(ip, [])]
+
+        results = dict.fromkeys(ips)
+        slots = asyncio.Semaphore(FORWARD_DELETE_CONCURRENCY)
+
+        async def delete(forward):
+            async with slots:
+                return await delete_port_forward(forward["_id"])
+
+        deleted = await asyncio.gather(*(delete(forward) for _, forward in rules))
+
+    for (ip, forward), success in zip(rules, deleted):
+        if not success:
+            results[ip] = f"Could not delete port forward {forward['_id']}"
+
+    deletion_stats["rules"] += len(rules)
+
+    return results
+
+async def delete_port_forward_by_ip(ip):
     """ Deletes a port forwarding of a k8s service that was deleted.
 
+    Joins the current deletion batch and waits until it was executed, see run_deletions().
+
     Args:
         ip (string): IP address the service used to have
     """
-    
+
+    waiter = asyncio.get_running_loop().create_future()
+    pending_deletions.setdefault(ip, []).append(waiter)
+    deletions_requested.set()
+
     try:
-        forwards = (get_port_forward())["data"]
-        for forward in forwards:
-            if forward["fwd"] == ip:
-                forward_id = forward["_id"]
-                delete_port_forward(forward_id)
-        
-    except Exception as e:
-        raise kopf.TemporaryError(f"delete_port_forward_by_ip() error: {str(e)}")
+        error = await asyncio.wait_for(asyncio.shield(waiter), timeout=FORWARD_DELETE_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise kopf.TemporaryError(f"delete_port_forward_by_ip() error: Timed out after {FORWARD_DELETE_TIMEOUT}s")
+
+    if error:
+        raise kopf.TemporaryError(f"delete_port_forward_by_ip() error: {error}")
 
 #  ------------------------
 #           LOGIC
 #  ------------------------
-def supervise_ips():
+async def request_reconcile(obj_uuid):
+    """ Schedule the port forward of a service for reconciliation, waits while the queue is full
+
+    Args:
+        obj_uuid (string): custObjUuid of the service
+    """
+
+    await reconcile_queue.put(obj_uuid)
+
+def needs_reconcile(previous, current):
+    """ Whether a service change affects its port forward
+
+    Args:
+        previous (dict): Previous service index entry or None
+        current (dict): Current service index entry or None
+
+    Returns:
+        bool: True if the LB IP or port changed
+    """
+
+    if not current or not current["ingress_ip"]:
+        return False
+
+    if not previous:
+        return True
+
+    return previous["ingress_ip"] != current["ingress_ip"] or previous["port"] != current["port"]
+
+def index_forwards(forwards):
+    """ Index port forwarding entries by target and by IP
+
+    Args:
+        forwards (list): Port forwarding entries of the UDM
+
+    Returns:
+        dict: { "by_target": { (ip, port): forward }, "by_ip": { ip: [forward, ...] } }
+    """
+
+    by_target = {}
+    by_ip = {}
+
+    for forward in forwards:
+        target = (forward["fwd"], str(forward["fwd_port"]))
+        by_target.setdefault(target, forward)
+        by_ip.setdefault(forward["fwd"], []).append(forward)
+
+    return {
+        "by_target": by_target,
+        "by_ip": by_ip
+    }
+
+def plan_forwards(desired, forwards):
+    """ Compute the changes required to make the UDM forward every desired target
+
+    Rules of IPs that are not desired at all are left alone, they are removed
+    by the delete handler of their PrismServer.
+
+    Args:
+        desired (iterable): (ip, port) targets that must be forwarded
+        forwards (list): Port forwarding entries of the UDM
+
+    Returns:
+        dict: { "create": [(ip, port)], "update": [(forward, port)], "delete": [forward] }
+    """
+
+    index = index_forwards(forwards)
+    desired = {(ip, str(port)) for ip, port in desired}
+    desired_ips = {ip for ip, _ in desired}
+
+    # Rules of a desired IP that do not match any of its desired ports
+    stale = {}
+    for ip in desired_ips:
+        for forward in index["by_ip"].get(ip, []):
+            if (ip, str(forward["fwd_port"])) not in desired:
+                stale.setdefault(ip, []).append(forward)
+
+    plan = {
+        "create": [],
+        "update": [],
+        "delete": []
+    }
+
+    for ip, port in sorted(desired):
+        if (ip, port) in index["by_target"]:
+            continue
+
+        if stale.get(ip):
+            plan["update"].append((stale[ip].pop(), port))
+        else:
+            plan["create"].append((ip, port))
+
+    for forwards_of_ip in stale.values():
+        plan["delete"].extend(forwards_of_ip)
+
+    return plan
+
+async def apply_forward_plan(plan):
+    """ Execute a plan computed by plan_forwards()
+
+    Args:
+        plan (dict): Plan to execute
+
+    Returns:
+        dict: { (ip, port): None if forwarded, error message otherwise } of every created or updated target
+    """
+
+    async def forward(ip, port, operation):
+        try:
+            await operation
+            return (ip, port), None
+        except Exception as e:
+            return (ip, port), str(e)
+
+    # Concurrency is bounded by the UniFi client
+    await asyncio.gather(*(delete_port_forward(forward["_id"]) for forward in plan["delete"]))
+
+    results = await asyncio.gather(
+        *(forward(rule["fwd"], port, update_port_forward(rule, port)) for rule, port in plan["update"]),
+        *(forward(ip, port, create_port_forward(ip, port)) for ip, port in plan["create"])
+    )
+
+    return dict(results)
+
+async def reconcile(services, forwards):
+    """ Ensure the given services have correct port forwards and report changes on their PrismServers
+
+    Args:
+        services (list): Service index entries, see service_index.service_entry()
+        forwards (list): Current port forwarding entries of the UDM
+    """
+
+    # Only proceed for services which the LB has assigned an IP to, standby services are forwarded ahead of their claim
+    services = {(service["ingress_ip"], str(service["port"])): service for service in services
+                if service["ingress_ip"] and (service["owner"] or service.get("standby"))}
+
+    plan = plan_forwards(services.keys(), forwards)
+    results = await apply_forward_plan(plan)
+
+    for target, service in services.items():
+        forwarding_phases[service["uuid"]] = "Forwarding failed" if results.get(target) else "Forwarded"
+
+    for target, error in results.items():
+        service = services[target]
+
+        # Generic status object
+        status_obj = {
+            "status": {
+                "forwarding": {
+                    "available": error is None,
+                    "phase": "Forwarded" if error is None else "Forwarding failed",
+                    "port": service["port"],
+                    "assignedIp": service["ingress_ip"]
+                }
+            }
+        }
+
+        if error is not None:
+            logger.error(f"Port forward of {service['ingress_ip']}:{service['port']} failed: {error}")
+            status_obj["status"]["forwarding"]["message"] = f"Operator error: \"{error}\""
+
+        if service["owner"]:
+            patch_queue.submit(service["owner"], status_obj)
+
+def report_phases():
+    """ Update the forwarding phase metrics """
+
+    metrics.count_state(list(forwarding_phases.values()), metrics.servers_by_forwarding_phase,
+                        ["Pending", "Forwarded", "Forwarding failed"])
+
+async def reconcile_services(obj_uuids):
+    """ Reconcile the port forwards of the given services of this replica's shard against one UDM table fetch
+
+    Args:
+        obj_uuids (iterable): custObjUuids of the services
+    """
+
+    services = [service_index.lookup(obj_uuid) for obj_uuid in set(obj_uuids)]
+    services = [service for service in services if service and service["ingress_ip"] and shards.owns_service(service)]
+
+    if not services:
+        return
+
+    try:
+        with metrics.supervisor_duration.labels("event").time():
+            await reconcile(services, (await get_port_forward())["data"])
+
+    except Exception as e:
+        raise kopf.TemporaryError(f"FORWARDER: Error during reconciliation: {str(e)}")
+
+    report_phases()
+
+@profiling.profiled
+async def supervise_ips():
     """
     Supervises services in prism-servers ns and checks if they have an External-IP asigned.
     If yes, checks if a port forwarding rule exists for them.
+
+    Full resync, acts as a safety net for missed service events.
     """
-    
+
     try:
-        client = utils.kube_auth()
-        
-        api = client.resources.get(api_version="v1", kind="Service")
-        items = api.get(namespace="prism-servers", label_selector="custObjUuid").items
-        
-        forwards = get_port_forward()["data"]
-        
-        for item in items:
-            do_create = False
-            do_delete = False
-            
-            this_port = item.spec.ports[0].port
-            this_prismserver_name = item.metadata.ownerReferences[0].name
-            
-            #print(" ")
-            #print(f"Iterating for: {this_prismserver_name}")
-            
-            # Generic status object
-            status_obj = {
-                "status": {
-                    "forwarding": {
-                        "available": None,
-                        "phase": None,
-                        "port": this_port
-                    }
-                }
-            }
-            
-            # Only proceed if LB has assigned an IP to service
-            if item.status.loadBalancer.ingress:
-                this_ip = item.status.loadBalancer.ingress[0].ip
-                #print(f"> Has IP: {this_ip}")
-                
-                if len(forwards) >= 1:
-                    for forward in forwards:
-                        forward_id = forward["_id"]
-                        
-                        if forward["fwd"] == this_ip:
-                            if forward["fwd_port"] == this_port:
-                                #print("> Forward found and it is correct.")
-                                
-                                # Do this, as otherwise a forwarding will be scheduled anyway if forwards{} has more than one item
-                                do_create = False
-                                break
-                            
-                            else:
-                                #print(f"> [i] Correcting forward for {this_ip}...")
-                                do_delete = True
-                                break
-                                
-                        else:
-                            # Forwarding is missing
-                            do_create = True
-
-                else:
-                    #print(f"> [i] Forwardings were initially empty, creating...")
-                    do_create = True
-                    
-            else:
-                #raise ValueError("Service does not yet have an external IP assigned.")
-                return False
-            
-            # (Re)create port forward
-            try:
-                if do_delete or do_create:
-                    do_status_update = True
-                    #print(f"> Creating forward for: {this_port} -> {this_ip}")
-                    
-                    if do_delete:
-                        delete_port_forward(forward_id)
-                        
-                    create_port_forward(this_ip, this_port)
-                    
-                    status_obj["status"]["forwarding"]["available"] = True
-                    status_obj["status"]["forwarding"]["phase"] = "Forwarded"
-                else:
-                    do_status_update = False
-                                
-            except Exception as e:
-                print(f"> Error -> {str(e)}")
-                
-                status_obj["status"]["forwarding"]["available"]  = False
-                status_obj["status"]["forwarding"]["phase"] = "Forwarding failed"
-                status_obj["status"]["forwarding"]["message"] = f"Operator error: \"{str(e)}\""
-            
-            finally:
-                # Update status obj
-                if do_status_update:
-                    if this_ip:
-                        status_obj["status"]["forwarding"]["assignedIp"] = this_ip
-                    
-                    prismserver_api = client.resources.get(api_version="v1", kind="PrismServer")
-                    prismserver_api.patch(
-                        namespace="prism-servers",
-                        name=this_prismserver_name,
-                        body=status_obj,
-                        content_type="application/merge-patch+json"
-                    )
-        
+        with metrics.supervisor_duration.labels("resync").time():
+            # Background reads, the forwards it creates or deletes keep their own priority
+            with ratelimit.priority(ratelimit.PROBE):
+                response = await asyncio.to_thread(utils.kube_request, "get", "Service", namespace="prism-servers", label_selector="custObjUuid")
+                forwards = (await get_port_forward())["data"]
+
+            services = [service_index.service_entry(item) for item in response.to_dict()["items"]]
+            services = [service for service in services if service and shards.owns_service(service)]
+
+            await reconcile(services, forwards)
+
     except Exception as e:
-        raise kopf.TemporaryError(f"FORWARDER: Error during supervision: {str(e)}")
\ No newline at end of file
+        raise kopf.TemporaryError(f"FORWARDER: Error during supervision: {str(e)}")
+
+    # Services which are gone or have no External-IP yet
+    known = {service["uuid"]: service for service in services}
+    for obj_uuid in list(forwarding_phases):
+        if obj_uuid not in known:
+            del forwarding_phases[obj_uuid]
+    for obj_uuid, service in known.items():
+        if not service["ingress_ip"]:
+            forwarding_phases[obj_uuid] = "Pending"
+
+    report_phases()
+
+async def next_batch(timeout):
+    """ Wait for reconcile requests, coalescing a burst of them into one batch
+
+    Returns:
+        list: custObjUuids to reconcile, None if the timeout passed
+    """
+
+    try:
+        obj_uuids = [await asyncio.wait_for(reconcile_queue.get(), timeout)]
+    except asyncio.TimeoutError:
+        return None
+
+    # Coalesce events arriving in a burst into one UDM table fetch
+    await asyncio.sleep(FORWARD_DEBOUNCE)
+    while not reconcile_queue.empty():
+        obj_uuids.append(reconcile_queue.get_nowait())
+
+    return obj_uuids
+
+async def run_forwarder(logger):
+    """ Port forwarder supervisor
+
+    Reconciles services as their events arrive and does a full resync every FORWARD_RESYNC_INTERVAL seconds.
+    Cancelling the task stops it between two UDM calls.
+    """
+
+    # Initial service events already trigger a reconciliation of every service
+    next_resync = time.monotonic() + FORWARD_RESYNC_INTERVAL
+
+    while True:
+        obj_uuids = None
+
+        try:
+            obj_uuids = await next_batch(max(0.0, next_resync - time.monotonic()))
+
+            if obj_uuids:
+                await reconcile_services(obj_uuids)
+                continue
+
+            await supervise_ips()
+            next_resync = time.monotonic() + FORWARD_RESYNC_INTERVAL
+
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"run_forwarder() error: {str(e)}")
+
+            # A failed resync is retried on the next interval
+            if obj_uuids is None:
+                next_resync = time.monotonic() + FORWARD_RESYNC_INTERVAL
+
+async def run_deletions(logger):
+    """ Collect deletions for FORWARD_DELETE_WINDOW seconds, execute them as one batch and report back per IP """
+
+    while True:
+        await deletions_requested.wait()
+        await asyncio.sleep(FORWARD_DELETE_WINDOW)
+
+        deletions_requested.clear()
+        batch = dict(pending_deletions)
+        pending_deletions.clear()
+
+        try:
+            results = await delete_port_forwards(list(batch))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            results = dict.fromkeys(batch, str(e))
+
+        deletion_stats["batches"] += 1
+        deletion_stats["ips"] += len(batch)
+        deletion_stats["failed"] += sum(1 for error in results.values() if error)
+
+        for ip, waiters in batch.items():
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.set_result(results[ip])
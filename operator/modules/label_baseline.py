@@ -0,0 +1,94 @@
+"""
+Immutable label baselines of PrismServer objects, persisted as an annotation and fronted by a bounded LRU
+"""
+
+import json
+import threading
+from collections import OrderedDict
+import modules.utils as utils
+
+#  ------------------------
+#           VARS
+#  ------------------------
+BASELINE_ANNOTATION = "prism-hosting.ch/label-baseline"
+
+BASELINE_CACHE_SIZE = utils.env_int("LABEL_BASELINE_CACHE_SIZE", 1024)
+
+baseline_cache = OrderedDict()
+# { "prism_object": labels{} }, least recently used first
+
+baseline_lock = threading.Lock()
+
+#  ------------------------
+#         FUNCTIONS
+#  ------------------------
+def baseline_annotation(labels):
+    """ Metadata patch persisting a label baseline on its object
+
+    Args:
+        labels (dict): Baseline labels
+
+    Returns:
+        dict: Patch body
+    """
+
+    return {"metadata": {"annotations": {BASELINE_ANNOTATION: json.dumps(labels, sort_keys=True)}}}
+
+def remember(name, labels):
+    """ Put a baseline into the LRU, evicting the least recently used one if full """
+
+    with baseline_lock:
+        baseline_cache[name] = dict(labels)
+        baseline_cache.move_to_end(name)
+
+        while len(baseline_cache) > BASELINE_CACHE_SIZE:
+            baseline_cache.popitem(last=False)
+
+def get_baseline(name, meta):
+    """ Return the label baseline of a PrismServer
+
+    Args:
+        name (string): Name of the PrismServer
+        meta (dict): Metadata of the PrismServer, read if the baseline is not cached
+
+    Returns:
+        dict: Baseline labels, None if the object has no baseline annotation
+    """
+
+    with baseline_lock:
+        if name in baseline_cache:
+            baseline_cache.move_to_end(name)
+            return baseline_cache[name]
+
+    annotation = (meta.get("annotations") or {}).get(BASELINE_ANNOTATION)
+    if not annotation:
+        return None
+
+    labels = json.loads(annotation)
+    remember(name, labels)
+
+    return labels
+
+def forget(name):
+    """ Evict the baseline of a deleted PrismServer """
+
+    with baseline_lock:
+        baseline_cache.pop(name, None)
+
+def diff(baseline, labels):
+    """ Compare labels against their baseline
+
+    Args:
+        baseline (dict): Baseline labels
+        labels (dict): Current labels
+
+    Returns:
+        tuple: (missing: list, mismatched: list) label keys
+    """
+
+    labels = labels or {}
+
+    missing = [key for key in baseline if key not in labels]
+    mismatched = [key for key, value in baseline.items() if key in labels and labels[key] != value]
+
+    return missing, mismatched
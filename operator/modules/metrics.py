@@ -0,0 +1,161 @@
+"""
+Prometheus metrics of the operator
+"""
+
+import asyncio
+import functools
+import os
+import time
+
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+#  ------------------------
+#           VARS
+#  ------------------------
+METRICS_PORT = int(os.environ.get("METRICS_PORT") or 9090)
+
+handler_duration = Histogram(
+    "prism_operator_handler_duration_seconds",
+    "Duration of kopf handlers",
+    ["handler"]
+)
+
+supervisor_duration = Histogram(
+    "prism_operator_supervisor_pass_duration_seconds",
+    "Duration of a port forward reconciliation pass",
+    ["mode"]
+)
+
+unifi_latency = Histogram(
+    "prism_operator_unifi_request_duration_seconds",
+    "Latency of UniFi API requests",
+    ["method"]
+)
+
+probe_rtt = Histogram(
+    "prism_operator_probe_connect_rtt_seconds",
+    "RTT of successful probes, TCP connect or A2S_INFO query depending on the probe mode",
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.0)
+)
+
+probe_cycle_duration = Histogram(
+    "prism_operator_probe_cycle_duration_seconds",
+    "Duration of a probe cycle over all servers"
+)
+
+kube_api_calls = Counter(
+    "prism_operator_kube_api_calls_total",
+    "Kubernetes API calls",
+    ["verb", "kind"]
+)
+
+pool_claim_duration = Histogram(
+    "prism_operator_pool_claim_duration_seconds",
+    "Duration of claiming a standby server from the warm pool",
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+)
+
+rate_limit_wait = Histogram(
+    "prism_operator_rate_limit_wait_seconds",
+    "Time calls waited for a token of their rate limiter",
+    ["backend", "priority"],
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+)
+
+rate_limit_queue_depth = Gauge(
+    "prism_operator_rate_limit_queue_depth",
+    "Calls waiting for a token of their rate limiter",
+    ["backend", "priority"]
+)
+
+servers_by_probe_state = Gauge(
+    "prism_operator_servers_by_probe_state",
+    "Number of servers by TCP probe state",
+    ["state"]
+)
+
+servers_by_forwarding_phase = Gauge(
+    "prism_operator_servers_by_forwarding_phase",
+    "Number of servers by port forwarding phase",
+    ["phase"]
+)
+
+stats_gauges = {}
+# { "metric name": Gauge }, registered by register_stats()
+
+metrics_server = {
+    "started": False
+}
+
+#  ------------------------
+#         FUNCTIONS
+#  ------------------------
+def start_server(port=METRICS_PORT):
+    """ Serve /metrics on the given port, once """
+
+    if metrics_server["started"]:
+        return
+
+    start_http_server(port)
+    metrics_server["started"] = True
+
+def register_stats(name, stats, documentation):
+    """ Expose a dict of counters as a gauge, read at scrape time
+
+    Registering a name again, e.g. from a retried startup handler, re-binds its gauge.
+
+    Args:
+        name (string): Metric name
+        stats (dict): Dict of numeric values, keys become the "stat" label
+        documentation (string): Metric description
+    """
+
+    gauge = stats_gauges.get(name)
+    if gauge is None:
+        gauge = stats_gauges[name] = Gauge(name, documentation, ["stat"])
+
+    for key, value in stats.items():
+        if isinstance(value, (int, float)):
+            gauge.labels(key).set_function(functools.partial(stats.get, key))
+
+def count_state(states, gauge, names):
+    """ Set a gauge per state name from an iterable of states
+
+    Args:
+        states (iterable): Current state of every server
+        gauge (Gauge): Gauge with one label
+        names (list): State names that are always reported, even if zero
+    """
+
+    counts = dict.fromkeys(names, 0)
+    for state in states:
+        counts[state] = counts.get(state, 0) + 1
+
+    for name, count in counts.items():
+        gauge.labels(name).set(count)
+
+def timed_handler(handler):
+    """ Decorator recording the duration of a kopf handler, keeps sync handlers sync and async ones async """
+
+    histogram = handler_duration.labels(handler.__name__)
+
+    if asyncio.iscoroutinefunction(handler):
+        @functools.wraps(handler)
+        async def async_wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await handler(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - start)
+
+        return async_wrapper
+
+    @functools.wraps(handler)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return handler(*args, **kwargs)
+        finally:
+            histogram.observe(time.perf_counter() - start)
+
+    return wrapper
@@ -0,0 +1,252 @@
+"""
+Write-behind queue which coalesces merge-patches per object before sending them
+"""
+
+import copy
+import logging
+import threading
+import time
+import modules.ratelimit as ratelimit
+import modules.utils as utils
+
+#  ------------------------
+#           VARS
+#  ------------------------
+pending_patches = {}
+# { (kind, namespace, name): { "body": dict, "due": float, "attempts": int, "priority": int } }
+
+last_known_state = {}
+# { (kind, namespace, name): dict }
+# Last known server state of an object, from watch events and successful patches
+
+patch_stats = {
+    "submitted": 0,
+    "sent": 0,
+    "coalesced": 0,
+    "dropped": 0,
+    "failed": 0
+}
+
+patch_condition = threading.Condition()
+
+patch_worker = {
+    "thread": None,
+    "stopping": False
+}
+
+PATCH_WINDOW = utils.env_float("PATCH_WINDOW", 0.25)
+PATCH_RETRIES = utils.env_int("PATCH_RETRIES", 3)
+
+logger = logging.getLogger(__name__)
+
+#  ------------------------
+#         FUNCTIONS
+#  ------------------------
+def deep_merge(target, patch):
+    """ Merge a merge-patch into a dict in place, like the apiserver would
+
+    Args:
+        target (dict): Dict to merge into
+        patch (dict): Patch to merge
+    """
+
+    for key, value in patch.items():
+        if isinstance(value, dict) and isinstance(target.get(key), dict):
+            deep_merge(target[key], value)
+        else:
+            target[key] = copy.deepcopy(value)
+
+    return target
+
+def is_applied(patch, state):
+    """ Whether applying a merge-patch would not change a state
+
+    Args:
+        patch (dict): Merge-patch
+        state (dict): Known state, None if unknown
+    """
+
+    if state is None:
+        return False
+
+    for key, value in patch.items():
+        if value is None:
+            if state.get(key) is not None:
+                return False
+        elif isinstance(value, dict):
+            if not isinstance(state.get(key), dict) or not is_applied(value, state[key]):
+                return False
+        elif state.get(key) != value:
+            return False
+
+    return True
+
+def observe(name, body, kind="PrismServer", namespace="prism-servers", deleted=False):
+    """ Record the server state of an object from a watch event
+
+    Args:
+        name (string): Name of the object
+        body (dict): Object as seen by the watch
+        kind (string): Resource kind
+        namespace (string): Namespace of the object
+        deleted (bool): Whether the object was deleted
+    """
+
+    key = (kind, namespace, name)
+
+    with patch_condition:
+        if deleted:
+            last_known_state.pop(key, None)
+            pending_patches.pop(key, None)
+            return
+
+        last_known_state[key] = {
+            "metadata": {"labels": dict(body.get("metadata", {}).get("labels") or {})},
+            "status": copy.deepcopy(dict(body.get("status") or {}))
+        }
+
+def submit(name, body, kind="PrismServer", namespace="prism-servers", priority=ratelimit.STATUS):
+    """ Queue a merge-patch of a kubernetes resource, defaults to "PrismServer"
+
+    Patches of the same object within PATCH_WINDOW seconds are merged and sent once.
+
+    Args:
+        name (string): Name of the kubernetes resource (meta.name)
+        body (dict): Body to patch resource with
+        kind (string): Resource kind
+        namespace (string): Namespace of the resource
+        priority (int): Rate limiter priority, merged patches keep the most urgent one
+    """
+
+    key = (kind, namespace, name)
+
+    with patch_condition:
+        patch_stats["submitted"] += 1
+
+        if key in pending_patches:
+            deep_merge(pending_patches[key]["body"], body)
+            pending_patches[key]["priority"] = min(pending_patches[key]["priority"], priority)
+            patch_stats["coalesced"] += 1
+            return
+
+        if is_applied(body, last_known_state.get(key)):
+            patch_stats["dropped"] += 1
+            return
+
+        pending_patches[key] = {
+            "body": copy.deepcopy(body),
+            "due": time.monotonic() + PATCH_WINDOW,
+            "attempts": 0,
+            "priority": priority
+        }
+
+        start_worker()
+        patch_condition.notify()
+
+def take_due():
+    """ Wait for and remove the most urgent due patch. Caller must hold patch_condition.
+
+    Returns:
+        tuple: (key, entry), None once the worker is stopping
+    """
+
+    while True:
+        if patch_worker["stopping"]:
+            return None
+
+        if not pending_patches:
+            patch_condition.wait()
+            continue
+
+        now = time.monotonic()
+        due = [item for item in pending_patches.items() if item[1]["due"] <= now]
+        if not due:
+            patch_condition.wait(min(entry["due"] for entry in pending_patches.values()) - now)
+            continue
+
+        key, entry = min(due, key=lambda item: (item[1]["priority"], item[1]["due"]))
+
+        del pending_patches[key]
+        return key, entry
+
+def send(key, entry):
+    """ Send a coalesced patch, re-queue it on failure """
+
+    kind, namespace, name = key
+
+    try:
+        with ratelimit.priority(entry["priority"]):
+            utils.patch_resource(name, entry["body"], kind=kind, namespace=namespace)
+
+    except Exception as e:
+        with patch_condition:
+            patch_stats["failed"] += 1
+
+            # Gone objects will never accept the patch
+            if getattr(e, "status", None) == 404 or entry["attempts"] + 1 >= PATCH_RETRIES:
+                logger.error(f"Dropping patch of {kind}/{name}: {str(e)}")
+                return
+
+            # Newer patches of the same object go on top of the failed one
+            if key in pending_patches:
+                entry["body"] = deep_merge(entry["body"], pending_patches[key]["body"])
+                entry["priority"] = min(entry["priority"], pending_patches[key]["priority"])
+
+            entry["attempts"] += 1
+            entry["due"] = time.monotonic() + PATCH_WINDOW * (2 ** entry["attempts"])
+            pending_patches[key] = entry
+        return
+
+    with patch_condition:
+        patch_stats["sent"] += 1
+        if key in last_known_state:
+            deep_merge(last_known_state[key], entry["body"])
+
+def worker_loop():
+    """ Send due patches one by one, which keeps the order of writes per object """
+
+    while True:
+        with patch_condition:
+            due = take_due()
+
+        if due is None:
+            return
+
+        send(*due)
+
+def start_worker():
+    """ Start the sending thread if it does not run yet. Caller must hold patch_condition. """
+
+    if patch_worker["thread"] is None and not patch_worker["stopping"]:
+        patch_worker["thread"] = threading.Thread(target=worker_loop, name="patch-queue", daemon=True)
+        patch_worker["thread"].start()
+
+def stop_worker():
+    """ Stop the sending thread once the patch it is sending is sent, the next submit() starts it again """
+
+    with patch_condition:
+        patch_worker["stopping"] = True
+        patch_condition.notify_all()
+        thread = patch_worker["thread"]
+
+    if thread is not None:
+        thread.join()
+
+    with patch_condition:
+        patch_worker["thread"] = None
+        patch_worker["stopping"] = False
+
+def flush():
+    """ Send all pending patches right away, e.g. on shutdown
+
+    Stops the sending thread first, so no patch is sent twice or out of order.
+    """
+
+    stop_worker()
+
+    with patch_condition:
+        entries = list(pending_patches.items())
+        pending_patches.clear()
+
+    for key, entry in entries:
+        send(key, entry)
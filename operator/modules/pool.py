@@ -0,0 +1,274 @@
+"""
+Warm pool of idle, already booted standby servers, which create() claims instead of building a server from scratch
+"""
+
+import asyncio
+import json
+import os
+import time
+import kopf
+import modules.deployment_index as deployment_index
+import modules.drift as drift
+import modules.forwarder as forwarder
+import modules.metrics as metrics
+import modules.patch_queue as patch_queue
+import modules.ports as ports
+import modules.resources as resources
+import modules.service_index as service_index
+import modules.shards as shards
+import modules.utils as utils
+
+#  ------------------------
+#           VARS
+#  ------------------------
+POOL_SIZE = utils.env_int("POOL_SIZE", 0)
+# Standby servers to keep, 0 disables the pool
+POOL_NAMESPACE = os.environ.get("ENV_NAMESPACE") or "prism-servers"
+POOL_REFILL_INTERVAL = utils.env_float("POOL_REFILL_INTERVAL", 10.0)
+POOL_REFILL_BATCH = utils.env_int("POOL_REFILL_BATCH", 4)
+# Standby servers created per refill round
+
+POOL_LABEL = service_index.POOL_LABEL
+POOL_NAME = "pool"
+POOL_CUSTOMER = "standby"
+# Standby servers are rendered like a PrismServer "pool" of customer "standby"
+
+CLAIM_ANNOTATION = drift.CLAIM_ANNOTATION
+# Set on PrismServers which claimed a standby server, holds the identity it was rendered with
+
+standby_servers = {}
+# { "custObjUuid": { "service": "service-csgo-server-pool-standby-...", "deployment": "csgo-server-pool-standby-...",
+#                    "sub_start": "1684500522", "ready": False } }
+# Fed by Service and Deployment watch events, see observe()
+
+pool_stats = {
+    "standby": 0,
+    "ready": 0,
+    "created": 0,
+    "claims": 0,
+    "misses": 0,
+    "failed_claims": 0
+}
+
+#  ------------------------
+#         FUNCTIONS
+#  ------------------------
+def observe(kind, event_type, body):
+    """ Track standby servers from Service and Deployment watch events
+
+    Args:
+        kind (string): Service or Deployment
+        event_type (string): Watch event type (None, ADDED, MODIFIED, DELETED)
+        body (dict): Object
+    """
+
+    metadata = body.get("metadata") or {}
+    labels = metadata.get("labels") or {}
+    obj_uuid = labels.get("custObjUuid")
+    if not obj_uuid:
+        return
+
+    # Claimed or gone
+    if event_type == "DELETED" or labels.get(POOL_LABEL) != "standby":
+        standby_servers.pop(obj_uuid, None)
+        count()
+        return
+
+    entry = standby_servers.setdefault(obj_uuid, {"service": None, "deployment": None, "sub_start": labels.get("subscriptionStart"), "ready": False})
+
+    if kind == "Service":
+        entry["service"] = metadata["name"]
+    else:
+        entry["deployment"] = metadata["name"]
+        entry["ready"] = ((body.get("status") or {}).get("readyReplicas") or 0) >= 1
+
+    count()
+
+def count():
+    pool_stats["standby"] = len(standby_servers)
+    pool_stats["ready"] = sum(1 for entry in standby_servers.values() if entry["ready"])
+
+def create_standby(logger):
+    """ Create one standby server, without owner
+
+    Returns:
+        string: custObjUuid of the standby server
+    """
+
+    bodies = resources.get_resources(logger, POOL_NAME, POOL_NAMESPACE, POOL_CUSTOMER, str(int(time.time())), [])
+    for body in bodies:
+        body["metadata"]["labels"][POOL_LABEL] = "standby"
+
+    try:
+        for body in bodies:
+            utils.apply_resource(body, namespace=POOL_NAMESPACE)
+    except Exception:
+        for body in bodies:
+            utils.delete_resource(body["metadata"]["name"], body["kind"], api_version=body["apiVersion"], namespace=POOL_NAMESPACE)
+        ports.release(bodies[0]["spec"]["ports"][0]["port"])
+        raise
+
+    labels = bodies[0]["metadata"]["labels"]
+    standby_servers.setdefault(labels["custObjUuid"], {
+        "service": bodies[0]["metadata"]["name"],
+        "deployment": bodies[1]["metadata"]["name"],
+        "sub_start": labels["subscriptionStart"],
+        "ready": False
+    })
+    pool_stats["created"] += 1
+    count()
+
+    return labels["custObjUuid"]
+
+async def delete_standby(obj_uuid):
+    """ Delete a standby server along with its port forward
+
+    It has no PrismServer whose delete handler would remove the forward, see forwarder.plan_forwards().
+    """
+
+    entry = standby_servers.pop(obj_uuid, None)
+    if entry is None:
+        return
+    count()
+
+    service = service_index.lookup(obj_uuid)
+    if service and service["ingress_ip"]:
+        try:
+            await forwarder.delete_port_forward_by_ip(service["ingress_ip"])
+        except Exception:
+            # Retried on the next round
+            standby_servers.setdefault(obj_uuid, entry)
+            count()
+            raise
+
+    await asyncio.to_thread(utils.delete_resource, entry["service"], "Service", namespace=POOL_NAMESPACE)
+    await asyncio.to_thread(utils.delete_resource, entry["deployment"], "Deployment", api_version="apps/v1", namespace=POOL_NAMESPACE)
+
+def claim_patch(owner_body, customer, sub_start):
+    """ JSON patch turning a standby object into an object of a PrismServer
+
+    Fails if another replica claimed it first. Names, selectors and pod labels stay those of the standby server.
+    """
+
+    return [
+        {"op": "test", "path": "/metadata/labels/prism-hosting.ch~1pool", "value": "standby"},
+        {"op": "remove", "path": "/metadata/labels/prism-hosting.ch~1pool"},
+        {"op": "replace", "path": "/metadata/labels/customer", "value": customer},
+        {"op": "replace", "path": "/metadata/labels/subscriptionStart", "value": str(sub_start)},
+        {"op": "add", "path": "/metadata/ownerReferences", "value": [kopf.build_owner_reference(owner_body)]}
+    ]
+
+def claim(owner_body, customer, sub_start, env_vars, logger):
+    """ Claim a ready standby server for a new PrismServer
+
+    Relabels and adopts its Service and Deployment and applies the customer's env, which restarts
+    the server on a pulled image with its port, LB IP and port forward already in place.
+
+    Args:
+        owner_body (dict): New PrismServer
+        customer (string): Customer
+        sub_start (string): Subscription start
+        env_vars (list): Env of the PrismServer
+        logger: Logger to report to
+
+    Returns:
+        tuple: ([Service, Deployment] objects, annotations for the PrismServer), None if no standby server could be claimed
+    """
+
+    if not POOL_SIZE or owner_body["metadata"]["namespace"] != POOL_NAMESPACE:
+        return None
+
+    start = time.perf_counter()
+
+    for obj_uuid, entry in list(standby_servers.items()):
+        deployment = deployment_index.lookup(obj_uuid)
+        service = service_index.lookup(obj_uuid)
+        if not entry["ready"] or not entry["service"] or not deployment or not service:
+            continue
+
+        # Taken by a concurrent claim meanwhile
+        if standby_servers.pop(obj_uuid, None) is None:
+            continue
+        count()
+
+        env = resources.add_port_to_env_vars([{"name": var["name"], "value": var["value"]} for var in env_vars or []], service["port"])
+        patch = claim_patch(owner_body, customer, sub_start)
+
+        try:
+            claimed_service = utils.kube_request("patch", "Service", namespace=POOL_NAMESPACE, name=entry["service"],
+                                                 body=patch, content_type="application/json-patch+json")
+        except Exception as e:
+            # Most likely claimed by another replica
+            logger.info(f"Could not claim standby server {obj_uuid}: {str(e)}")
+            continue
+
+        try:
+            claimed_deployment = utils.kube_request("patch", "Deployment", api_version="apps/v1", namespace=POOL_NAMESPACE, name=entry["deployment"],
+                                                    body=patch + (deployment_index.env_patch(deployment, env) or []),
+                                                    content_type="application/json-patch+json")
+        except Exception as e:
+            pool_stats["failed_claims"] += 1
+            logger.warning(f"Claim of standby server {obj_uuid} failed, removing it: {str(e)}")
+            utils.delete_resource(entry["service"], "Service", namespace=POOL_NAMESPACE)
+            utils.delete_resource(entry["deployment"], "Deployment", api_version="apps/v1", namespace=POOL_NAMESPACE)
+            continue
+
+        # An env change right after the claim is compared against the claimed env
+        deployment_index.apply_event("MODIFIED", claimed_deployment.to_dict())
+
+        # The forward exists already, it will not be reported by the forwarder
+        if forwarder.forwarding_phases.get(obj_uuid) == "Forwarded" and service["ingress_ip"]:
+            patch_queue.submit(owner_body["metadata"]["name"], {"status": {"forwarding": {
+                "available": True,
+                "phase": "Forwarded",
+                "port": service["port"],
+                "assignedIp": service["ingress_ip"]
+            }}})
+
+        elapsed = time.perf_counter() - start
+        metrics.pool_claim_duration.observe(elapsed)
+        pool_stats["claims"] += 1
+        logger.info(f"Claimed standby server {obj_uuid} in {elapsed:.3f}s")
+
+        identity = {"name": POOL_NAME, "customer": POOL_CUSTOMER, "subscriptionStart": entry["sub_start"]}
+
+        return [claimed_service, claimed_deployment], {CLAIM_ANNOTATION: json.dumps(identity, sort_keys=True)}
+
+    pool_stats["misses"] += 1
+
+    return None
+
+def refill(logger):
+    """ Create standby servers towards POOL_SIZE, at most POOL_REFILL_BATCH per round """
+
+    for _ in range(min(POOL_SIZE - len(standby_servers), POOL_REFILL_BATCH)):
+        logger.info(f"Created standby server {create_standby(logger)}")
+
+async def shrink(logger):
+    """ Delete the standby servers beyond POOL_SIZE, unready ones first, e.g. all of them once the pool is disabled """
+
+    surplus = len(standby_servers) - POOL_SIZE
+
+    for obj_uuid in sorted(standby_servers, key=lambda key: standby_servers[key]["ready"])[:max(0, surplus)]:
+        await delete_standby(obj_uuid)
+        logger.info(f"Deleted standby server {obj_uuid}")
+
+#  ------------------------
+#           LOGIC
+#  ------------------------
+async def run_pool(logger):
+    """ Keep the pool at POOL_SIZE, on a single replica when sharding """
+
+    while True:
+        await asyncio.sleep(POOL_REFILL_INTERVAL)
+
+        if not shards.owns("pool"):
+            continue
+
+        try:
+            await asyncio.to_thread(refill, logger)
+            await shrink(logger)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"run_pool(): {str(e)}")
@@ -0,0 +1,162 @@
+"""
+Collision-free allocation of server ports, backed by an occupancy bitmap
+"""
+
+import random
+import threading
+
+#  ------------------------
+#           VARS
+#  ------------------------
+PORT_MIN = 20000
+PORT_MAX = 50000
+
+port_bitmap = bytearray((PORT_MAX - PORT_MIN) // 8 + 1)
+# Bit (port - PORT_MIN) is set if the port is taken
+
+port_state = {
+    "used": 0,
+    "seeded": False
+}
+
+port_lock = threading.Lock()
+
+#  ------------------------
+#         FUNCTIONS
+#  ------------------------
+def in_range(port):
+    """ Whether a port is managed by the allocator """
+
+    return PORT_MIN <= port <= PORT_MAX
+
+def is_reserved(port):
+    """ Whether a port is currently taken """
+
+    offset = port - PORT_MIN
+    return bool(port_bitmap[offset >> 3] & (1 << (offset & 7)))
+
+def set_bit(port):
+    """ Mark a port as taken, returns True if it was free before. Caller must hold port_lock. """
+
+    offset = port - PORT_MIN
+    mask = 1 << (offset & 7)
+    if port_bitmap[offset >> 3] & mask:
+        return False
+
+    port_bitmap[offset >> 3] |= mask
+    port_state["used"] += 1
+    return True
+
+def reserve(port):
+    """ Mark a port as taken
+
+    Args:
+        port (int): Port to reserve
+
+    Returns:
+        bool: True if the port was free before
+    """
+
+    port = int(port)
+    if not in_range(port):
+        return False
+
+    with port_lock:
+        return set_bit(port)
+
+def release(port):
+    """ Mark a port as free again
+
+    Args:
+        port (int): Port to release
+    """
+
+    port = int(port)
+    if not in_range(port):
+        return
+
+    offset = port - PORT_MIN
+    mask = 1 << (offset & 7)
+
+    with port_lock:
+        if port_bitmap[offset >> 3] & mask:
+            port_bitmap[offset >> 3] &= ~mask
+            port_state["used"] -= 1
+
+def allocate(accept=None):
+    """ Allocate a free port
+
+    Starts at a random byte of the bitmap and scans forward for one that is not full,
+    which takes O(1) amortized steps as long as the range is not completely full.
+
+    Args:
+        accept (callable): Optional filter, only ports for which it returns True are handed out
+
+    Returns:
+        int: Reserved port
+    """
+
+    return allocate_many(1, accept)[0]
+
+def allocate_many(count, accept=None):
+    """ Allocate several free ports in one scan of the bitmap, see allocate()
+
+    Args:
+        count (int): Number of ports
+        accept (callable): Optional filter, only ports for which it returns True are handed out
+
+    Returns:
+        list: Reserved ports, either all of them or none
+    """
+
+    size = len(port_bitmap)
+    allocated = []
+
+    with port_lock:
+        start = random.randrange(size)
+
+        for step in range(size):
+            if len(allocated) == count:
+                return allocated
+
+            index = (start + step) % size
+            byte = port_bitmap[index]
+            if byte == 0xFF:
+                continue
+
+            for bit in range(8):
+                port = PORT_MIN + (index << 3) + bit
+                if byte & (1 << bit) or port > PORT_MAX:
+                    continue
+                if accept is not None and not accept(port):
+                    continue
+
+                set_bit(port)
+                allocated.append(port)
+                if len(allocated) == count:
+                    return allocated
+
+    for port in allocated:
+        release(port)
+
+    raise ValueError(f"No {count} free ports left between {PORT_MIN} and {PORT_MAX}")
+
+def seed(ports):
+    """ Reserve every port in use by existing services and port forwards
+
+    Args:
+        ports (iterable): Ports that are already taken
+    """
+
+    for port in ports:
+        try:
+            reserve(int(port))
+        except (TypeError, ValueError):
+            continue
+
+    port_state["seeded"] = True
+
+def occupancy():
+    """ Fraction of the port range that is taken """
+
+    return port_state["used"] / (PORT_MAX - PORT_MIN + 1)
@@ -0,0 +1,208 @@
+"""
+Opt-in profiling of handlers and hot paths: wall and CPU time, sampled cProfile and tracemalloc
+
+Disabled by default, in which case profiled() returns the function unchanged.
+"""
+
+import asyncio
+import cProfile
+import functools
+import io
+import os
+import pstats
+import random
+import signal
+import threading
+import time
+import tracemalloc
+import modules.utils as utils
+
+#  ------------------------
+#           VARS
+#  ------------------------
+PROFILING_ENABLED = os.environ.get("PROFILING_ENABLED", "false").lower() in ("true", "1", "yes")
+PROFILE_SAMPLE_RATE = utils.env_float("PROFILE_SAMPLE_RATE", 0.0)
+# Share of sync calls that run under cProfile, 0 disables cProfile
+PROFILE_TRACEMALLOC = os.environ.get("PROFILE_TRACEMALLOC", "false").lower() in ("true", "1", "yes")
+PROFILE_TRACEMALLOC_FRAMES = utils.env_int("PROFILE_TRACEMALLOC_FRAMES", 10)
+PROFILE_DIR = os.environ.get("PROFILE_DIR") or "/tmp/prism-profiles"
+PROFILE_DUMP_INTERVAL = utils.env_float("PROFILE_DUMP_INTERVAL", 300.0)
+PROFILE_TOP_N = utils.env_int("PROFILE_TOP_N", 25)
+
+timings = {}
+# { "function": { "calls": int, "wall": float, "cpu": float, "max_wall": float } }
+
+profile_state = {
+    "stats": None,
+    # pstats.Stats aggregated over all sampled calls
+    "snapshot": None,
+    # Previous tracemalloc snapshot, dumps report the growth since
+    "thread": None
+}
+
+profile_lock = threading.Lock()
+dump_requested = threading.Event()
+
+#  ------------------------
+#         FUNCTIONS
+#  ------------------------
+def record(name, wall, cpu):
+    with profile_lock:
+        timing = timings.setdefault(name, {"calls": 0, "wall": 0.0, "cpu": 0.0, "max_wall": 0.0})
+        timing["calls"] += 1
+        timing["wall"] += wall
+        timing["cpu"] += cpu
+        timing["max_wall"] = max(timing["max_wall"], wall)
+
+def merge_profile(profile):
+    with profile_lock:
+        if profile_state["stats"] is None:
+            profile_state["stats"] = pstats.Stats(profile)
+        else:
+            profile_state["stats"].add(profile)
+
+def call_sampled(func, args, kwargs):
+    """ Run a sync call under cProfile """
+
+    profile = cProfile.Profile()
+    try:
+        profile.enable()
+    except ValueError:
+        # Another call is already being profiled (one profiler per process on Python 3.12+)
+        return func(*args, **kwargs)
+
+    try:
+        return func(*args, **kwargs)
+    finally:
+        profile.disable()
+        merge_profile(profile)
+
+def profiled(func):
+    """ Decorator recording wall and CPU time of a function, keeps sync functions sync and async ones async
+
+    CPU time of async functions is the event loop thread's CPU time while they run, including
+    other tasks running during their awaits.
+    """
+
+    if not PROFILING_ENABLED:
+        return func
+
+    name = f"{func.__module__}.{func.__qualname__}"
+
+    if asyncio.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            wall, cpu = time.perf_counter(), time.thread_time()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                record(name, time.perf_counter() - wall, time.thread_time() - cpu)
+
+        return async_wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        wall, cpu = time.perf_counter(), time.thread_time()
+        try:
+            if PROFILE_SAMPLE_RATE and random.random() < PROFILE_SAMPLE_RATE:
+                return call_sampled(func, args, kwargs)
+
+            return func(*args, **kwargs)
+        finally:
+            record(name, time.perf_counter() - wall, time.thread_time() - cpu)
+
+    return wrapper
+
+def report():
+    """ Render the current profile as text
+
+    Returns:
+        string: Timings, hottest functions and allocation sites
+    """
+
+    lines = [f"# Profile at {time.strftime('%Y-%m-%dT%H:%M:%S')}", "", "## Timings (seconds)", ""]
+    lines.append(f"{'function':<60} {'calls':>8} {'wall':>10} {'cpu':>10} {'avg_wall':>10} {'max_wall':>10}")
+
+    with profile_lock:
+        rows = sorted(timings.items(), key=lambda item: item[1]["wall"], reverse=True)
+        for name, timing in rows:
+            lines.append(f"{name:<60} {timing['calls']:>8} {timing['wall']:>10.3f} {timing['cpu']:>10.3f} "
+                         f"{timing['wall'] / timing['calls']:>10.4f} {timing['max_wall']:>10.4f}")
+
+        if profile_state["stats"] is not None:
+            stream = io.StringIO()
+            stats = pstats.Stats(stream=stream)
+            stats.add(profile_state["stats"])
+            stats.sort_stats("cumulative").print_stats(PROFILE_TOP_N)
+            lines += ["", f"## Top {PROFILE_TOP_N} functions of sampled calls (cProfile)", "", stream.getvalue()]
+
+    if tracemalloc.is_tracing():
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__)
+        ])
+
+        lines += ["", f"## Top {PROFILE_TOP_N} allocation sites (tracemalloc)", ""]
+        lines += [str(stat) for stat in snapshot.statistics("lineno")[:PROFILE_TOP_N]]
+
+        if profile_state["snapshot"] is not None:
+            lines += ["", f"## Top {PROFILE_TOP_N} allocation growth since the last dump", ""]
+            lines += [str(stat) for stat in snapshot.compare_to(profile_state["snapshot"], "lineno")[:PROFILE_TOP_N]]
+
+        profile_state["snapshot"] = snapshot
+
+    return "\n".join(lines) + "\n"
+
+def dump(reason="periodic"):
+    """ Write the current profile to PROFILE_DIR
+
+    Returns:
+        string: Path of the written file
+    """
+
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    path = os.path.join(PROFILE_DIR, f"profile-{time.strftime('%Y%m%d-%H%M%S')}-{reason}.txt")
+
+    with open(path, "w") as profile_file:
+        profile_file.write(report())
+
+    return path
+
+def request_dump(*_):
+    """ Dump the profile right away, e.g. from the SIGUSR1 handler """
+
+    dump_requested.set()
+
+#  ------------------------
+#           LOGIC
+#  ------------------------
+def dump_loop(logger):
+    """ Dump every PROFILE_DUMP_INTERVAL seconds, or whenever a dump is requested """
+
+    while True:
+        reason = "requested" if dump_requested.wait(PROFILE_DUMP_INTERVAL) else "periodic"
+        dump_requested.clear()
+
+        try:
+            logger.info(f"Profile written to {dump(reason)}")
+        except Exception as e:
+            logger.warning(f"dump_loop(): {str(e)}")
+
+def start(logger):
+    """ Start tracemalloc, the dump thread and the SIGUSR1 trigger, if profiling is enabled """
+
+    if not PROFILING_ENABLED or profile_state["thread"] is not None:
+        return
+
+    if PROFILE_TRACEMALLOC:
+        tracemalloc.start(PROFILE_TRACEMALLOC_FRAMES)
+
+    try:
+        signal.signal(signal.SIGUSR1, request_dump)
+    except ValueError:
+        # Not running in the main thread
+        logger.warning("Could not install the SIGUSR1 profile trigger")
+
+    profile_state["thread"] = threading.Thread(target=dump_loop, args=(logger, ), name="profile-dump", daemon=True)
+    profile_state["thread"].start()
+
+    logger.info(f"Profiling enabled, writing profiles to {PROFILE_DIR} every {PROFILE_DUMP_INTERVAL:.0f}s and on SIGUSR1")
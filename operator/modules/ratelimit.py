@@ -0,0 +1,209 @@
+"""
+Priority-aware token buckets governing the calls against the Kubernetes API and the UniFi API
+"""
+
+import asyncio
+import contextlib
+import contextvars
+import heapq
+import itertools
+import os
+import threading
+import time
+import modules.metrics as metrics
+
+#  ------------------------
+#           VARS
+#  ------------------------
+DELETE = 0
+# Deletes and finalizers, and calls everything else waits for (UniFi logins)
+CREATE = 1
+STATUS = 2
+# Status and other updates, and reads
+PROBE = 3
+# Probe results and background resyncs
+
+PRIORITY_NAMES = {DELETE: "delete", CREATE: "create", STATUS: "status", PROBE: "probe"}
+
+VERB_PRIORITIES = {
+    "delete": DELETE,
+    "create": CREATE,
+    "post": CREATE,
+    "server_side_apply": CREATE
+}
+# Priority of calls made outside of a priority() block, everything else is STATUS
+
+KUBE_RATE = float(os.environ.get("KUBE_RATE") or 50)
+KUBE_BURST = float(os.environ.get("KUBE_BURST") or 100)
+UNIFI_RATE = float(os.environ.get("UNIFI_RATE") or 10)
+UNIFI_BURST = float(os.environ.get("UNIFI_BURST") or 20)
+# Calls per second and bucket size, a rate of 0 disables the bucket
+
+ASYNC_POLL_MAX = 0.05
+# Longest sleep of an async waiter which is not first in line
+
+current_priority = contextvars.ContextVar("current_priority", default=None)
+
+#  ------------------------
+#         FUNCTIONS
+#  ------------------------
+@contextlib.contextmanager
+def priority(value):
+    """ Run the calls of a block with the given priority, it carries over into asyncio.to_thread()
+
+    Args:
+        value (int): DELETE, CREATE, STATUS or PROBE
+    """
+
+    token = current_priority.set(value)
+    try:
+        yield
+    finally:
+        current_priority.reset(token)
+
+def priority_for(verb):
+    """ Priority of a call, from the enclosing priority() block or else from its verb """
+
+    value = current_priority.get()
+    if value is not None:
+        return value
+
+    return VERB_PRIORITIES.get(verb.lower(), STATUS)
+
+class PriorityBucket:
+    """ Token bucket handing out tokens strictly by priority, then in arrival order
+
+    Threads block in acquire(), coroutines await acquire_async(), both may share a bucket.
+    """
+
+    def __init__(self, name, rate, burst):
+        self.name = name
+        self.rate = rate
+        self.burst = max(burst, 1.0)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.waiters = []
+        # Heap of (priority, sequence) tickets
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+        self.stats = {
+            "acquired": 0,
+            "throttled": 0,
+            "waiting": 0,
+            "max_waiting": 0,
+            "wait_seconds": 0.0
+        }
+
+    def enqueue(self, value):
+        """ Queue a ticket. Caller must hold the condition. """
+
+        ticket = (value, next(self.sequence))
+        heapq.heappush(self.waiters, ticket)
+
+        self.stats["waiting"] = len(self.waiters)
+        self.stats["max_waiting"] = max(self.stats["max_waiting"], len(self.waiters))
+        metrics.rate_limit_queue_depth.labels(self.name, PRIORITY_NAMES[value]).inc()
+
+        return ticket
+
+    def dequeue(self, ticket):
+        """ Remove a ticket, granted or abandoned. Caller must hold the condition. """
+
+        if self.waiters and self.waiters[0] == ticket:
+            heapq.heappop(self.waiters)
+        else:
+            self.waiters.remove(ticket)
+            heapq.heapify(self.waiters)
+
+        self.stats["waiting"] = len(self.waiters)
+        metrics.rate_limit_queue_depth.labels(self.name, PRIORITY_NAMES[ticket[0]]).dec()
+
+        # The next ticket may be first in line now
+        self.condition.notify_all()
+
+    def grant(self, ticket):
+        """ Take a token for a ticket if it is first in line. Caller must hold the condition.
+
+        Returns:
+            float: 0 if granted, else seconds until a token is due, None if other tickets go first
+        """
+
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+        if self.waiters[0] != ticket:
+            return None
+
+        if self.tokens >= 1:
+            self.tokens -= 1
+            self.dequeue(ticket)
+            return 0.0
+
+        return (1 - self.tokens) / self.rate
+
+    def record(self, value, waited):
+        """ Account for a granted token. Caller must hold the condition. """
+
+        self.stats["acquired"] += 1
+        if waited > 0.001:
+            self.stats["throttled"] += 1
+        self.stats["wait_seconds"] += waited
+        metrics.rate_limit_wait.labels(self.name, PRIORITY_NAMES[value]).observe(waited)
+
+    def acquire(self, value):
+        """ Block the calling thread until a token is granted
+
+        Args:
+            value (int): Priority of the call
+        """
+
+        if self.rate <= 0:
+            return
+
+        start = time.monotonic()
+        with self.condition:
+            ticket = self.enqueue(value)
+
+            while True:
+                delay = self.grant(ticket)
+                if delay == 0:
+                    break
+
+                self.condition.wait(delay)
+
+            self.record(value, time.monotonic() - start)
+
+    async def acquire_async(self, value):
+        """ Wait in the event loop until a token is granted
+
+        Args:
+            value (int): Priority of the call
+        """
+
+        if self.rate <= 0:
+            return
+
+        start = time.monotonic()
+        with self.condition:
+            ticket = self.enqueue(value)
+
+        granted = False
+        try:
+            while True:
+                with self.condition:
+                    delay = self.grant(ticket)
+                    if delay == 0:
+                        granted = True
+                        self.record(value, time.monotonic() - start)
+                        return
+
+                # Not first in line: poll, threads cannot wake up coroutines
+                await asyncio.sleep(min(delay, 1.0) if delay is not None else min(ASYNC_POLL_MAX, 1 / self.rate))
+        finally:
+            if not granted:
+                with self.condition:
+                    self.dequeue(ticket)
+
+kube_bucket = PriorityBucket("kube", KUBE_RATE, KUBE_BURST)
+unifi_bucket = PriorityBucket("unifi", UNIFI_RATE, UNIFI_BURST)
@@ -2,11 +2,14 @@
 Module to load, transform and return kubernetes resources
 """
 
-import random
+import functools
 import yaml
 import uuid
 import kopf
 import os
+import modules.ports as ports
+import modules.shards as shards
+import modules.utils as utils
 
 def add_port_to_env_vars(env_vars, port):
     """
@@ -16,13 +19,26 @@ def add_port_to_env_vars(env_vars, port):
 
 def allocate_random_port():
     """
-    Allocate a random port to be used by a k8s service
+    Allocate a random, unused port to be used by a k8s service
     """
     
-    # TODO: Get current ports, generate port, return if non-existent or retry ad infinitum.
-    return random.randint(20000, 50000)
+    # Replicas of a sharded operator hand out disjoint ports
+    if shards.SHARDING_ENABLED:
+        return ports.allocate(accept=shards.owns_port)
+    
+    return ports.allocate()
+
+def allocate_random_ports(count):
+    """
+    Allocate several random, unused ports at once, e.g. for a fleet
+    """
+    
+    if shards.SHARDING_ENABLED:
+        return ports.allocate_many(count, accept=shards.owns_port)
+    
+    return ports.allocate_many(count)
 
-def get_resources(logger, name, namespace, customer, sub_start, env_vars=None):
+def get_resources(logger, name, namespace, customer, sub_start, env_vars=None, port=None):
     """ Creates an array of kubernetes resources (Deployment, service) for further use
 
     Args:
@@ -30,6 +46,7 @@ def get_resources(logger, name, namespace, customer, sub_start, env_vars=None):
         namespace (string): Namespace
         customer (string): Customer
         sub_start (string): DateTime of subscription start
+        port (int): Port reserved by the caller, a random one is allocated if not set
 
 
     Returns:
@@ -49,7 +66,7 @@ def get_resources(logger, name, namespace, customer, sub_start, env_vars=None):
     }
     
     try:
-        port = allocate_random_port()
+        port = port or allocate_random_port()
         resources = [
             get_service_body(logger, str_uuid, name, namespace, customer, port, labels),
             get_deployment_body(logger, str_uuid, name, namespace, customer, port, labels, env_vars)
@@ -71,33 +88,25 @@ def get_deployment_body(logger, str_uuid, name, namespace, customer, port, label
         labels (dict): Labels
     """
     
-    
-    
     uuid_part = str_uuid[:8]
     
     full_name = f"csgo-server-{name}-{customer}-{uuid_part}"
     secret_name = "gslt-code"
     
-    # Todo: Import yaml and do things with it
     try:
-        logger.info("Attempting to load deployment yaml...")
-        path = os.path.join(os.path.dirname("resources/"), 'Deployment.yaml')
-        tmp_yaml = open(path, 'rt').read()
-        
-        body = yaml.safe_load(
-            tmp_yaml.format(
-                full_name=full_name,
-                namespace=namespace,
-                customer=customer,
-                sub_start=labels["subscriptionStart"],
-                str_uuid=labels["custObjUuid"],
-                secret_name=secret_name,
-                dyn_port=port,
-                env_vars=add_port_to_env_vars(env_vars, port),
-            )
+        body = render_template(
+            "Deployment",
+            full_name=full_name,
+            namespace=namespace,
+            customer=customer,
+            sub_start=labels["subscriptionStart"],
+            str_uuid=labels["custObjUuid"],
+            secret_name=secret_name,
+            dyn_port=port,
+            env_vars=add_port_to_env_vars(env_vars or [], port),
         )
         
-        logger.info(f"> Populated deployment yaml: {body}")
+        logger.debug(f"> Populated deployment body: {body}")
     except Exception as e:
         raise kopf.PermanentError(f"Error during YAML population: {str(e)}.")
     
@@ -119,23 +128,107 @@ def get_service_body(logger, str_uuid, name, namespace, customer, port, labels):
     full_name = f"service-{full_name}"
     
     try:
-        logger.info("Attempting to load service yaml...")
-        path = os.path.join(os.path.dirname("resources/"), 'Service.yaml')
-        tmp_yaml = open(path, 'rt').read()
-        
-        body = yaml.safe_load(
-            tmp_yaml.format(
-                full_name=full_name,
-                customer=customer,
-                sub_start=labels["subscriptionStart"],
-                str_uuid=labels["custObjUuid"],
-                namespace=namespace,
-                dyn_port=port,
-            )
+        body = render_template(
+            "Service",
+            full_name=full_name,
+            customer=customer,
+            sub_start=labels["subscriptionStart"],
+            str_uuid=labels["custObjUuid"],
+            namespace=namespace,
+            dyn_port=port,
         )
         
-        logger.info(f"> Populated service yaml: {body}")
+        logger.debug(f"> Populated service body: {body}")
     except Exception as e:
         raise kopf.PermanentError(f"Error during YAML population: {str(e)}.")
 
     return body
+
+#  ------------------------
+#         TEMPLATES
+#  ------------------------
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "resources")
+
+TEMPLATE_FIELDS = ["full_name", "namespace", "customer", "sub_start", "str_uuid", "secret_name", "dyn_port", "env_vars"]
+
+TYPED_FIELDS = ["dyn_port", "env_vars"]
+# Unquoted placeholders in the templates, these keep the type of their value
+
+TEMPLATE_CACHE_SIZE = utils.env_int("TEMPLATE_CACHE_SIZE", 256)
+
+def sentinel(field):
+    """ Placeholder string a template field is parsed as """
+    
+    return f"__tpl_{field}__"
+
+def load_template(filename):
+    """ Parse a resource template once, with its placeholders kept as sentinel strings
+
+    Args:
+        filename (string): File in the resources folder
+
+    Returns:
+        dict: Parsed template
+    """
+    
+    with open(os.path.join(TEMPLATE_DIR, filename), 'rt') as template_file:
+        tmp_yaml = template_file.read()
+    
+    return yaml.safe_load(tmp_yaml.format(**{field: sentinel(field) for field in TEMPLATE_FIELDS}))
+
+def substitute(node, values):
+    """ Return a copy of a parsed template with all sentinels replaced
+
+    Args:
+        node: Template node (dict, list or scalar)
+        values (dict): Template field values
+    """
+    
+    if isinstance(node, dict):
+        return {key: substitute(value, values) for key, value in node.items()}
+    
+    if isinstance(node, list):
+        return [substitute(value, values) for value in node]
+    
+    if isinstance(node, str) and "__tpl_" in node:
+        for field in TYPED_FIELDS:
+            if node == sentinel(field):
+                return substitute(values[field], {})
+        
+        for field in TEMPLATE_FIELDS:
+            node = node.replace(sentinel(field), str(values.get(field, "")))
+    
+    return node
+
+@functools.lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def render_cached(kind, key):
+    """ Render a template for a hashable set of inputs, see render_template() """
+    
+    values = dict(key)
+    values["env_vars"] = [{"name": var_name, "value": var_value} for var_name, var_value in values.get("env_vars", ())]
+    
+    return substitute(templates[kind], values)
+
+def render_template(kind, **values):
+    """ Render a pre-compiled resource template
+
+    Args:
+        kind (string): Template to render (Deployment, Service)
+        values: Template field values
+
+    Returns:
+        dict: Resource body, owned by the caller
+    """
+    
+    if "env_vars" in values:
+        values["env_vars"] = tuple((var["name"], var["value"]) for var in values["env_vars"])
+    
+    key = tuple(sorted(values.items()))
+    
+    # Callers mutate the body (e.g. kopf.adopt()), never hand out the cached one
+    return substitute(render_cached(kind, key), {})
+
+templates = {
+    "Deployment": load_template("Deployment.yaml"),
+    "Service": load_template("Service.yaml")
+}
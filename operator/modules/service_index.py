@@ -0,0 +1,99 @@
+"""
+Watch-fed index of CS:GO service objects, keyed by custObjUuid
+"""
+
+import threading
+
+#  ------------------------
+#           VARS
+#  ------------------------
+services_by_uuid = {}
+# { "custObjUuid": { "name": "service-csgo-...", "namespace": "prism-servers", "uuid": "UUID-...", "ip": "10.0.0.1", "port": 27015,
+#                    "ingress_ip": "172.16.2.101" or None, "owner": "prismserver-name" or None, "standby": False } }
+
+POOL_LABEL = "prism-hosting.ch/pool"
+# Set to "standby" on the unclaimed servers of the warm pool, see pool.py
+
+index_lock = threading.Lock()
+
+#  ------------------------
+#         FUNCTIONS
+#  ------------------------
+def service_entry(body):
+    """ Extract the indexed fields from a Service body
+
+    Args:
+        body (dict): Service object
+
+    Returns:
+        dict: Index entry, None if the service is not a PrismServer service
+    """
+
+    metadata = body.get("metadata") or {}
+    spec = body.get("spec") or {}
+    labels = metadata.get("labels") or {}
+
+    obj_uuid = labels.get("custObjUuid")
+    ports = spec.get("ports") or []
+    if not obj_uuid or not ports:
+        return None
+
+    ingress = ((body.get("status") or {}).get("loadBalancer") or {}).get("ingress") or []
+    owners = metadata.get("ownerReferences") or []
+
+    return {
+        "name": metadata["name"],
+        "namespace": metadata.get("namespace"),
+        "uuid": obj_uuid,
+        "ip": spec.get("clusterIP"),
+        "port": ports[0]["port"],
+        "ingress_ip": ingress[0].get("ip") if ingress else None,
+        "owner": owners[0]["name"] if owners else None,
+        "standby": labels.get(POOL_LABEL) == "standby"
+    }
+
+def apply_event(event_type, body):
+    """ Update the index from a Service watch event
+
+    Args:
+        event_type (string): Watch event type (None, ADDED, MODIFIED, DELETED)
+        body (dict): Service object
+
+    Returns:
+        tuple: (previous entry or None, current entry or None)
+    """
+
+    entry = service_entry(body)
+    if entry is None:
+        return None, None
+
+    with index_lock:
+        previous = services_by_uuid.get(entry["uuid"])
+
+        if event_type == "DELETED":
+            # Ignore deletions of a service that has already been replaced
+            if previous and previous["name"] == entry["name"]:
+                del services_by_uuid[entry["uuid"]]
+            return previous, None
+
+        services_by_uuid[entry["uuid"]] = entry
+
+    return previous, entry
+
+def lookup(obj_uuid):
+    """ Return the indexed service of a PrismServer
+
+    Args:
+        obj_uuid (string): custObjUuid of the PrismServer
+
+    Returns:
+        dict: Index entry, None if unknown
+    """
+
+    return services_by_uuid.get(obj_uuid)
+
+def snapshot():
+    """ Return a list of all indexed services """
+
+    with index_lock:
+        return list(services_by_uuid.values())
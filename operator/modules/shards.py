@@ -0,0 +1,183 @@
+"""
+Opt-in sharding of PrismServers across a fixed number of operator replicas
+
+Every object belongs to the shard its namespace and name hash to, which never changes over
+its lifetime. The owning replica stamps the shard onto the object as a label, its kopf
+handlers only match that label, and each shard guards deletion with its own finalizer,
+so replicas never remove the finalizer of another shard.
+"""
+
+import hashlib
+import os
+import re
+import socket
+import modules.utils as utils
+
+#  ------------------------
+#           VARS
+#  ------------------------
+SHARDING_ENABLED = os.environ.get("SHARDING_ENABLED", "false").lower() in ("true", "1", "yes")
+SHARD_COUNT = utils.env_int("SHARD_COUNT", 1) if SHARDING_ENABLED else 1
+SHARD_IDENTITY = os.environ.get("POD_NAME") or socket.gethostname()
+
+SHARD_LABEL = "prism-hosting.ch/operator-shard"
+# Shard of a PrismServer or PrismServerFleet, see assign_patch()
+
+BASE_FINALIZER = "prism-server-operator.prism-hosting.ch/kopf-finalizer"
+
+object_shards = {}
+# { "custObjUuid": 0 }
+# Shard of every PrismServer, fed by PrismServer watch events, see track()
+
+#  ------------------------
+#         FUNCTIONS
+#  ------------------------
+def shard_index(identity):
+    """ Shard of this replica: SHARD_INDEX, else the ordinal of its StatefulSet pod name
+
+    Args:
+        identity (string): Pod name, e.g. "prismserver-operator-2"
+
+    Returns:
+        int: Shard index, None if it cannot be derived
+    """
+
+    if not SHARDING_ENABLED:
+        return 0
+
+    if os.environ.get("SHARD_INDEX"):
+        return int(os.environ["SHARD_INDEX"])
+
+    ordinal = re.search(r"-(\d+)$", identity)
+
+    return int(ordinal.group(1)) if ordinal else None
+
+SHARD_INDEX = shard_index(SHARD_IDENTITY)
+
+FINALIZER = BASE_FINALIZER if SHARD_INDEX == 0 else f"{BASE_FINALIZER}-{SHARD_INDEX}"
+# Shard 0 keeps the finalizer of unsharded operators, and so releases it from objects of other shards
+
+HANDLER_LABELS = {SHARD_LABEL: str(SHARD_INDEX)} if SHARDING_ENABLED else None
+# Label filter of all handlers which change objects
+
+def shard_of(key):
+    """ Shard of a key, stable across processes
+
+    Args:
+        key (string): Key to place, e.g. from object_key()
+
+    Returns:
+        int: Shard index
+    """
+
+    digest = hashlib.blake2b(key.encode(), digest_size=8).digest()
+
+    return int.from_bytes(digest, "big") % SHARD_COUNT
+
+def object_key(meta):
+    """ Shard key of an object: its namespace and name, which are immutable and known before it is created """
+
+    return f"{meta['namespace']}/{meta['name']}"
+
+def object_labels(namespace, name):
+    """ Labels placing an object into its shard, for objects the operator creates itself """
+
+    if not SHARDING_ENABLED:
+        return {}
+
+    return {SHARD_LABEL: str(shard_of(object_key({"namespace": namespace, "name": name})))}
+
+def owns(key):
+    """ Whether this replica owns a key. Always True if sharding is disabled.
+
+    custObjUuids of known PrismServers belong to the shard of their PrismServer, other keys are hashed.
+    """
+
+    if not SHARDING_ENABLED or not key:
+        return True
+
+    shard = object_shards.get(key)
+    if shard is None:
+        shard = shard_of(key)
+
+    return shard == SHARD_INDEX
+
+def owns_service(service):
+    """ Whether this replica owns a Service, by the key of its PrismServer rather than its custObjUuid,
+    which is only known once the PrismServer's own watch event arrived. Always True if sharding is disabled.
+
+    Standby services of the warm pool belong to the replica running the pool, see pool.run_pool().
+
+    Args:
+        service (dict): Service index entry, see service_index.service_entry()
+    """
+
+    if not SHARDING_ENABLED:
+        return True
+
+    if service["owner"]:
+        return shard_of(object_key({"namespace": service["namespace"], "name": service["owner"]})) == SHARD_INDEX
+
+    return owns("pool") if service.get("standby") else owns(service["uuid"])
+
+def owns_port(port):
+    """ Whether this replica may allocate a port, keeps concurrent allocations of replicas disjoint """
+
+    return owns(f"port/{port}")
+
+def track(event_type, meta):
+    """ Record the shard of a PrismServer from its watch event
+
+    Args:
+        event_type (string): Watch event type (None, ADDED, MODIFIED, DELETED)
+        meta (dict): Metadata of the PrismServer
+    """
+
+    obj_uuid = (meta.get("labels") or {}).get("custObjUuid")
+    if not SHARDING_ENABLED or not obj_uuid:
+        return
+
+    if event_type == "DELETED":
+        object_shards.pop(obj_uuid, None)
+    else:
+        object_shards[obj_uuid] = shard_of(object_key(meta))
+
+def stale_finalizer(finalizer):
+    """ Whether a finalizer is the one of a shard beyond SHARD_COUNT, e.g. after scaling down """
+
+    suffix = finalizer[len(BASE_FINALIZER) + 1:]
+
+    return finalizer.startswith(f"{BASE_FINALIZER}-") and suffix.isdigit() and int(suffix) >= SHARD_COUNT
+
+def assign_patch(meta):
+    """ Merge-patch labelling an object of this replica's shard with its shard
+
+    Also drops the finalizers of shards which no longer exist, nobody else would release them.
+
+    Returns:
+        dict: Merge-patch, None if the object is labelled correctly or belongs to another shard
+    """
+
+    shard = shard_of(object_key(meta))
+    if shard != SHARD_INDEX:
+        return None
+
+    patch_body = {"metadata": {}}
+
+    if SHARDING_ENABLED and (meta.get("labels") or {}).get(SHARD_LABEL) != str(shard):
+        patch_body["metadata"]["labels"] = {SHARD_LABEL: str(shard)}
+
+    finalizers = meta.get("finalizers") or []
+    if any(stale_finalizer(finalizer) for finalizer in finalizers):
+        patch_body["metadata"]["finalizers"] = [finalizer for finalizer in finalizers if not stale_finalizer(finalizer)]
+
+    return patch_body if patch_body["metadata"] else None
+
+def validate():
+    """ Raise if this replica has no shard or one beyond SHARD_COUNT """
+
+    if SHARD_INDEX is None:
+        raise ValueError(f"Cannot derive a shard from '{SHARD_IDENTITY}', set SHARD_INDEX or run the replicas as a StatefulSet")
+
+    if not 0 <= SHARD_INDEX < SHARD_COUNT:
+        raise ValueError(f"Shard {SHARD_INDEX} of {SHARD_IDENTITY} is out of range, SHARD_COUNT is {SHARD_COUNT}")
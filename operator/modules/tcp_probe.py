@@ -1,11 +1,20 @@
 """
-Module to probe TCP ports of CS:GO service objects
+Module to probe TCP ports of CS:GO service objects, or query them with A2S_INFO
 """
 
+import asyncio
 import kopf
-import kopf
+import os
+import random
+import modules.a2s as a2s
+import modules.metrics as metrics
+import modules.patch_queue as patch_queue
+import modules.profiling as profiling
+import modules.ratelimit as ratelimit
+import modules.service_index as service_index
+import modules.shards as shards
 import modules.utils as utils
-import socket
+import time
 
 import urllib3
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
@@ -13,92 +22,348 @@ urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 #  ------------------------
 #           VARS
 #  ------------------------
-services_cache = []
-# For schema, see cache_service()
+probe_targets = {}
+# { "custObjUuid": { "name": "prismserver-name", "verdict": True|False|None, "query": {...}|None,
+#                   "interval": float, "due": monotonic time of the next probe } }
+# Fed by PrismServer watch events, see track_target()
+
+probe_stats = {
+    "cycles": 0,
+    "probes": 0,
+    "last_cycle_seconds": 0.0,
+    "last_cycle_targets": 0,
+    "status_patches": 0
+}
+
+PROBE_INTERVAL = utils.env_float("PROBE_INTERVAL", 3.0)
+# Shortest interval, after a state change, a new server or a pod or service event
+PROBE_MAX_INTERVAL = utils.env_float("PROBE_MAX_INTERVAL", 15.0)
+# Longest interval of servers that keep responding, bounds how late an outage is detected
+PROBE_FAILING_MAX_INTERVAL = utils.env_float("PROBE_FAILING_MAX_INTERVAL", 6.0)
+# Longest interval of servers that keep failing, bounds how late a recovery is detected
+PROBE_BACKOFF = utils.env_float("PROBE_BACKOFF", 1.5)
+PROBE_JITTER = utils.env_float("PROBE_JITTER", 0.2)
+PROBE_TICK = utils.env_float("PROBE_TICK", 0.5)
+PROBE_INITIAL_DELAY = utils.env_float("PROBE_INITIAL_DELAY", 20.0)
+PROBE_TIMEOUT = utils.env_float("PROBE_TIMEOUT", 2.0)
+PROBE_CONCURRENCY = utils.env_int("PROBE_CONCURRENCY", 100)
+
+PROBE_MODE = os.environ.get("PROBE_MODE", "tcp").lower()
+# "tcp" connects to every server, "a2s" sends A2S_INFO queries from one UDP socket
+A2S_SEND_RATE = utils.env_int("A2S_SEND_RATE", 0)
+A2S_LATENCY_TOLERANCE_MS = utils.env_int("A2S_LATENCY_TOLERANCE_MS", 10)
 
 #  ------------------------
 #         FUNCTIONS
 #  ------------------------
 def cache_service(obj_uuid):
     """
-    Return a cached k8s service object.
-    If it does not exist, retrieve and cache it.
+    Return an indexed k8s service object.
 
     Args:
         uuid (string): UUID of the service to probe
         
     Returns:
-        dict: {"name": "example", "port": 27015, "uuid": 'UUID-...' }
+        dict: {"name": "example", "port": 27015, "uuid": 'UUID-...', "ip": "10.0.0.1", ... }
     """
     
     try:
         if not utils.is_uuid(obj_uuid):
             raise kopf.PermanentError(f"'{obj_uuid}' is not a valid UUID.")
         
-        # Check if service is already cached and return it
-        for item in services_cache:
-            if 'uuid' in item and item["uuid"] == obj_uuid:
-                return item
-            
-        # Service not yet cached: Append to cache and return cached obj
-        client = utils.kube_auth()
-        
-        api = client.resources.get(api_version="v1", kind="Service")
-        service = api.get(namespace="prism-servers", label_selector=f"custObjUuid={obj_uuid}").items
-        
-        if len(service) <= 0:
+        service = service_index.lookup(obj_uuid)
+        if service is None:
             raise ValueError("Found no service for this UUID.")
-        elif len(service) > 1:
-            raise ValueError(f"Found too many services for this UUID, got: {str(len(service))}.")
-        
-        service_name = service[0]["metadata"]["name"]
-        service_uuid = service[0]["metadata"]["labels"]["custObjUuid"]
-        service_port = service[0]["spec"]["ports"][0]["port"]
-        service_ip = service[0]["spec"]["clusterIP"]
-        
-        service_object = {
-            "name": service_name,
-            "uuid": service_uuid,
-            "port": service_port,
-            "ip": service_ip
-        }
-        
-        services_cache.append(service_object)
             
-        return service_object
+        return service
         
     except Exception as e:
         raise kopf.PermanentError(f"cache_service(): {str(e)}")
 
-def probe_service(obj_uuid):
-    """ Probe a service 
+def track_target(event_type, meta, status):
+    """ Register, update or forget a PrismServer as probe target from a watch event
 
     Args:
-        uuid (string): UUID of the service to probe
-        
+        event_type (string): Watch event type (None, ADDED, MODIFIED, DELETED)
+        meta (dict): PrismServer metadata
+        status (dict): PrismServer status
+    """
+
+    labels = meta.get("labels") or {}
+    obj_uuid = labels.get("custObjUuid")
+
+    if not obj_uuid:
+        return
+
+    if event_type == "DELETED":
+        probe_targets.pop(obj_uuid, None)
+        return
+
+    target = probe_targets.get(obj_uuid)
+    if target is None:
+        # Spread new targets over the first interval, e.g. all servers after an operator restart
+        target = probe_targets[obj_uuid] = {
+            "interval": PROBE_INTERVAL,
+            "due": time.monotonic() + random.uniform(0, PROBE_INTERVAL),
+            # Seeded once, later events may still carry a status from before the last probe
+            "verdict": (status or {}).get("tcpProbeResponding"),
+            "query": (status or {}).get("query")
+        }
+
+    target["name"] = meta["name"]
+
+def expedite(obj_uuid):
+    """ Probe a target on the next tick and fall back to the shortest interval, e.g. after its pod changed """
+
+    target = probe_targets.get(obj_uuid)
+    if target is None:
+        return
+
+    target["interval"] = PROBE_INTERVAL
+    target["due"] = time.monotonic()
+
+def reschedule(target, verdict, changed, now):
+    """ Schedule the next probe of a target
+
+    The interval of a server that keeps its verdict grows by PROBE_BACKOFF, up to PROBE_MAX_INTERVAL
+    while it responds and up to PROBE_FAILING_MAX_INTERVAL while it fails, which bounds how late its
+    recovery is detected. A changed verdict resets it to PROBE_INTERVAL. PROBE_JITTER spreads the
+    probes evenly around the interval.
+
+    Args:
+        target (dict): Probe target
+        verdict (bool): Verdict of the last probe
+        changed (bool): Whether the verdict of the last probe changed
+        now (float): Monotonic time of the last probe
+    """
+
+    if changed:
+        target["interval"] = PROBE_INTERVAL
+    else:
+        bound = PROBE_MAX_INTERVAL if verdict else PROBE_FAILING_MAX_INTERVAL
+        target["interval"] = max(PROBE_INTERVAL, min(target["interval"] * PROBE_BACKOFF, bound))
+
+    target["due"] = now + target["interval"] * random.uniform(1 - PROBE_JITTER, 1 + PROBE_JITTER)
+
+def due_targets(now):
+    """ Return the UUIDs of all targets of this shard that are due for a probe """
+
+    return [obj_uuid for obj_uuid, target in list(probe_targets.items())
+            if target["due"] <= now and shards.owns(obj_uuid)]
+
+def probe_state(verdict):
+    """ Metric state name of a probe verdict """
+
+    if verdict is None:
+        return "unknown"
+
+    return "responding" if verdict else "not_responding"
+
+def collect_endpoints(obj_uuids):
+    """ Resolve probe targets to (ip, port) endpoints
+
+    Args:
+        obj_uuids (list): UUIDs to resolve
+
     Returns:
-        bool: True if SUCCESS, False if FAIL
+        dict: { "custObjUuid": (ip, port) or None if the service is unknown }
     """
-    
+
+    endpoints = {}
+    for obj_uuid in obj_uuids:
+        try:
+            service = cache_service(obj_uuid)
+            endpoints[obj_uuid] = (service["ip"], service["port"])
+        except Exception:
+            endpoints[obj_uuid] = None
+
+    return endpoints
+
+async def probe_endpoint(ip, port, timeout):
+    """ Probe a single TCP endpoint without blocking the event loop
+
+    Args:
+        ip (string): Target IP
+        port (int): Target port
+        timeout (float): Connect timeout in seconds
+
+    Returns:
+        tuple: (verdict: bool, rtt: float in seconds or None)
+    """
+
+    start = time.monotonic()
     try:
-        if not utils.is_uuid(obj_uuid):
-            raise kopf.PermanentError(f"'{obj_uuid}' is not a valid UUID.")
+        _, writer = await asyncio.wait_for(asyncio.open_connection(ip, port), timeout=timeout)
+    except (OSError, asyncio.TimeoutError):
+        return False, None
 
-        # Get service from cache
-        service = cache_service(obj_uuid)
-        
-        target_ip = service["ip"]
-        target_port = service["port"]
-        
-        # Set up connection
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.settimeout(2)
-        
-        result = sock.connect_ex((target_ip, target_port))
-        if result == 0:
+    rtt = time.monotonic() - start
+
+    writer.close()
+    try:
+        await writer.wait_closed()
+    except OSError:
+        pass
+
+    return True, rtt
+
+async def probe_endpoints(endpoints, concurrency=PROBE_CONCURRENCY, timeout=PROBE_TIMEOUT):
+    """ Probe all endpoints concurrently with a bounded number of in-flight connects
+
+    Args:
+        endpoints (dict): { "custObjUuid": (ip, port) or None }
+        concurrency (int): Maximum number of simultaneous connects
+        timeout (float): Connect timeout in seconds
+
+    Returns:
+        dict: { "custObjUuid": (verdict, rtt) }
+    """
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def bounded(endpoint):
+        if endpoint is None:
+            return False, None
+
+        async with semaphore:
+            return await probe_endpoint(endpoint[0], endpoint[1], timeout)
+
+    obj_uuids = list(endpoints)
+    results = await asyncio.gather(*(bounded(endpoints[obj_uuid]) for obj_uuid in obj_uuids))
+
+    return dict(zip(obj_uuids, results))
+
+def write_probe_results(results, logger):
+    """ Queue a tcpProbeResponding patch for every PrismServer whose verdict changed
+
+    Args:
+        results (dict): { "custObjUuid": (verdict, rtt) }
+        logger: Logger to report to
+    """
+
+    for obj_uuid, (verdict, _) in results.items():
+        target = probe_targets.get(obj_uuid)
+
+        # Only patch status if is not already as expected
+        if not target or target["verdict"] == verdict:
+            continue
+
+        logger.info(f"> Updating tcpProbeResponding (New: {verdict}) for service with custObjUuid={obj_uuid}.")
+        patch_queue.submit(target["name"], {"status": {"tcpProbeResponding": verdict}}, priority=ratelimit.PROBE)
+        target["verdict"] = verdict
+        probe_stats["status_patches"] += 1
+
+def query_status(info, rtt):
+    """ Status of a server from its A2S_INFO answer, None if it did not answer """
+
+    if info is None:
+        return None
+
+    return {
+        "players": info["players"],
+        "maxPlayers": info["maxPlayers"],
+        "bots": info["bots"],
+        "map": info["map"],
+        "latencyMs": round(rtt * 1000)
+    }
+
+def query_changed(old, new):
+    """ Whether a query status is worth a patch, latency jitter within the tolerance is not """
+
+    if not old or not new:
+        return bool(old) != bool(new)
+
+    for key in ("players", "maxPlayers", "bots", "map"):
+        if old.get(key) != new[key]:
             return True
-        else:
-            return False
-        
-    except Exception as e:
-        raise kopf.PermanentError(f"probe_service(): {str(e)}")
\ No newline at end of file
+
+    return abs((old.get("latencyMs") or 0) - new["latencyMs"]) > A2S_LATENCY_TOLERANCE_MS
+
+def write_query_results(answers, logger):
+    """ Queue tcpProbeResponding and query patches for every PrismServer whose A2S answer changed
+
+    Args:
+        answers (dict): { "custObjUuid": (info, rtt) }
+        logger: Logger to report to
+    """
+
+    for obj_uuid, (info, rtt) in answers.items():
+        target = probe_targets.get(obj_uuid)
+        if not target:
+            continue
+
+        verdict = info is not None
+        query = query_status(info, rtt)
+
+        status = {}
+        if target["verdict"] != verdict:
+            logger.info(f"> Updating tcpProbeResponding (New: {verdict}) for service with custObjUuid={obj_uuid}.")
+            status["tcpProbeResponding"] = verdict
+        if query_changed(target.get("query"), query):
+            status["query"] = query
+
+        if not status:
+            continue
+
+        patch_queue.submit(target["name"], {"status": status}, priority=ratelimit.PROBE)
+        target["verdict"] = verdict
+        target["query"] = query
+        probe_stats["status_patches"] += 1
+
+#  ------------------------
+#           LOGIC
+#  ------------------------
+@profiling.profiled
+async def run_probe_cycle(logger):
+    """ Probe every target that is due once, write back changed verdicts in one batch and reschedule them """
+
+    start = time.monotonic()
+
+    obj_uuids = due_targets(start)
+    if not obj_uuids:
+        return
+
+    previous = {obj_uuid: probe_targets[obj_uuid]["verdict"] for obj_uuid in obj_uuids}
+    endpoints = collect_endpoints(obj_uuids)
+
+    if PROBE_MODE == "a2s":
+        answers = await a2s.query_endpoints(endpoints, timeout=PROBE_TIMEOUT, send_rate=A2S_SEND_RATE)
+        write_query_results(answers, logger)
+        results = {obj_uuid: (info is not None, rtt) for obj_uuid, (info, rtt) in answers.items()}
+    else:
+        results = await probe_endpoints(endpoints)
+        write_probe_results(results, logger)
+
+    now = time.monotonic()
+    for obj_uuid, (verdict, _) in results.items():
+        target = probe_targets.get(obj_uuid)
+        if target is not None:
+            reschedule(target, verdict, verdict != previous[obj_uuid], now)
+
+    probe_stats["cycles"] += 1
+    probe_stats["probes"] += len(obj_uuids)
+    probe_stats["last_cycle_seconds"] = time.monotonic() - start
+    probe_stats["last_cycle_targets"] = len(obj_uuids)
+
+    for _, rtt in results.values():
+        if rtt is not None:
+            metrics.probe_rtt.observe(rtt)
+
+    metrics.probe_cycle_duration.observe(probe_stats["last_cycle_seconds"])
+    metrics.count_state((probe_state(target["verdict"]) for target in list(probe_targets.values())),
+                        metrics.servers_by_probe_state, ["responding", "not_responding", "unknown"])
+
+async def run_probe_engine(logger):
+    """ Continuously monitor the readiness of all CS:GO services and update their PrismServer objects """
+
+    await asyncio.sleep(PROBE_INITIAL_DELAY)
+
+    while True:
+        try:
+            await run_probe_cycle(logger)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"run_probe_engine(): {str(e)}")
+
+        await asyncio.sleep(PROBE_TICK)
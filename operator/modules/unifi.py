@@ -0,0 +1,252 @@
+"""
+Persistent, non-blocking client for the UniFi (UDM SE/PRO) API, used from the operator's event loop
+"""
+
+import asyncio
+import json as json_module
+import os
+import random
+import ssl
+import time
+import modules.metrics as metrics
+import modules.ratelimit as ratelimit
+import modules.utils as utils
+
+import aiohttp
+
+#  ------------------------
+#           VARS
+#  ------------------------
+unifi_session = {
+    "session": None,
+    "csrf": None,
+    "generation": 0
+}
+# "generation" is bumped on every login, see login()
+
+unifi_lock = asyncio.Lock()
+# Serializes logins
+
+unifi_stats = {
+    "logins": 0,
+    "reauths": 0,
+    "retries": 0,
+    "in_flight": 0,
+    "latency": {}
+}
+# "latency": { "get": { "count": 0, "total": 0.0, "max": 0.0 } }
+
+IDEMPOTENT_METHODS = ("get", "put", "delete")
+
+UNIFI_POOL_SIZE = utils.env_int("UNIFI_POOL_SIZE", 8)
+UNIFI_CONCURRENCY = utils.env_int("UNIFI_CONCURRENCY", UNIFI_POOL_SIZE)
+UNIFI_RETRIES = utils.env_int("UNIFI_RETRIES", 3)
+UNIFI_BACKOFF = utils.env_float("UNIFI_BACKOFF", 0.2)
+UNIFI_BACKOFF_MAX = utils.env_float("UNIFI_BACKOFF_MAX", 2.0)
+UNIFI_TIMEOUT = utils.env_float("UNIFI_TIMEOUT", 10.0)
+
+unifi_slots = asyncio.Semaphore(UNIFI_CONCURRENCY)
+# Bounds the requests in flight, callers beyond it wait for a slot
+
+#  ------------------------
+#         FUNCTIONS
+#  ------------------------
+def base_url():
+    """ Base URL of the UniFi API, e.g. https://172.16.1.1 """
+
+    scheme = os.environ.get("UNIFI_API_SCHEME", "https")
+    return f"{scheme}://{os.environ['UNIFI_API_HOST']}"
+
+def tls_verify():
+    """ TLS verification setting: False (default), True or a CA bundle path """
+
+    value = os.environ.get("UNIFI_API_VERIFY", "false")
+    if value.lower() in ("false", "0", "no", ""):
+        return False
+    if value.lower() in ("true", "1", "yes"):
+        return True
+
+    return value
+
+def ssl_setting():
+    """ TLS setting of the session, from tls_verify() """
+
+    verify = tls_verify()
+    if verify is False:
+        return False
+    if verify is True:
+        return None
+
+    return ssl.create_default_context(cafile=verify)
+
+class Response:
+    """ Body and status of a completed request, read before the connection is handed back """
+
+    def __init__(self, status_code, headers, text):
+        self.status_code = status_code
+        self.headers = headers
+        self.text = text
+
+    def json(self):
+        return json_module.loads(self.text)
+
+def get_session():
+    """ Return the shared keep-alive session, creating it on first use. Must be called from the event loop. """
+
+    session = unifi_session["session"]
+    if session is not None and not session.closed:
+        return session
+
+    connector = aiohttp.TCPConnector(limit=UNIFI_POOL_SIZE, ssl=ssl_setting())
+    unifi_session["session"] = aiohttp.ClientSession(
+        connector=connector,
+        # The UDM is usually addressed by IP, whose cookies the default jar would drop
+        cookie_jar=aiohttp.CookieJar(unsafe=True),
+        timeout=aiohttp.ClientTimeout(total=UNIFI_TIMEOUT),
+        headers={
+            "Accept": "*/*",
+            "Content-Type": "application/json"
+        }
+    )
+
+    return unifi_session["session"]
+
+async def close():
+    """ Close the shared session, e.g. on shutdown """
+
+    session = unifi_session["session"]
+    unifi_session["session"] = None
+
+    if session is not None and not session.closed:
+        await session.close()
+
+async def send(method, url, headers=None, json=None):
+    """ Send one request over the shared session, rate limited and bounded by UNIFI_CONCURRENCY
+
+    Returns:
+        Response: Completed response
+    """
+
+    session = get_session()
+
+    await ratelimit.unifi_bucket.acquire_async(ratelimit.priority_for(method))
+
+    async with unifi_slots:
+        unifi_stats["in_flight"] += 1
+        start = time.monotonic()
+        try:
+            async with session.request(method.upper(), url, headers=headers, json=json) as response:
+                text = await response.text()
+        finally:
+            unifi_stats["in_flight"] -= 1
+
+    record_latency(method, time.monotonic() - start)
+
+    return Response(response.status, response.headers, text)
+
+def record_latency(method, seconds):
+    """ Record the latency of a UniFi request
+
+    Args:
+        method (string): HTTP method
+        seconds (float): Duration of the request
+    """
+
+    metrics.unifi_latency.labels(method).observe(seconds)
+
+    entry = unifi_stats["latency"].setdefault(method, {"count": 0, "total": 0.0, "max": 0.0})
+    entry["count"] += 1
+    entry["total"] += seconds
+    entry["max"] = max(entry["max"], seconds)
+
+async def login(seen_generation=None):
+    """ Logs onto Unifi API
+
+    Args:
+        seen_generation (int): Generation the caller was rejected with.
+                               Skips the login if another request already renewed it.
+    """
+
+    async with unifi_lock:
+        if seen_generation is not None and unifi_session["generation"] != seen_generation:
+            return
+
+        auth_payload = {
+            "username": os.environ['UNIFI_API_USER'],
+            "password": os.environ['UNIFI_API_PASS']
+        }
+
+        # All requests wait for the login
+        with ratelimit.priority(ratelimit.DELETE):
+            response = await send("post", f"{base_url()}/api/auth/login", json=auth_payload)
+        if response.status_code >= 400:
+            raise ValueError(f"Login failed with status code {response.status_code} - {response.text}")
+
+        # Auth cookie is kept by the session's cookie jar
+        unifi_session["csrf"] = response.headers.get("X-CSRF-Token")
+        unifi_session["generation"] += 1
+        unifi_stats["logins"] += 1
+
+async def backoff(attempt):
+    """ Sleep with bounded, jittered exponential backoff """
+
+    delay = min(UNIFI_BACKOFF_MAX, UNIFI_BACKOFF * (2 ** attempt))
+    await asyncio.sleep(delay * random.uniform(0.5, 1.0))
+
+async def request(method, path, json=None):
+    """ Do a request against the Unifi API
+
+    Logs on when required, re-authenticates once on 401/403 and retries idempotent requests.
+
+    Args:
+        method (string): HTTP method (get, post, put, delete)
+        path (string): Path below the API base URL
+        json (dict): Body dict
+
+    Returns:
+        Response: Completed response
+    """
+
+    url = f"{base_url()}{path}"
+
+    if unifi_session["generation"] == 0:
+        await login(seen_generation=0)
+
+    attempts = UNIFI_RETRIES if method in IDEMPOTENT_METHODS else 1
+    reauthed = False
+    attempt = 0
+
+    while True:
+        generation = unifi_session["generation"]
+        headers = {}
+        if unifi_session["csrf"]:
+            headers["X-CSRF-Token"] = unifi_session["csrf"]
+
+        try:
+            response = await send(method, url, headers=headers, json=json)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            attempt += 1
+            if attempt >= attempts:
+                raise ValueError(f"Error during request: {str(e) or type(e).__name__}")
+
+            unifi_stats["retries"] += 1
+            await backoff(attempt)
+            continue
+
+        # The UDM rotates its CSRF token from time to time
+        if response.headers.get("X-Updated-CSRF-Token"):
+            unifi_session["csrf"] = response.headers["X-Updated-CSRF-Token"]
+
+        if response.status_code in (401, 403) and not reauthed:
+            reauthed = True
+            unifi_stats["reauths"] += 1
+            await login(seen_generation=generation)
+            continue
+
+        if response.status_code >= 500 and attempt + 1 < attempts:
+            attempt += 1
+            unifi_stats["retries"] += 1
+            await backoff(attempt)
+            continue
+
+        return response
@@ -5,19 +5,161 @@ General utilities
 from openshift.dynamic import DynamicClient
 import kubernetes
 import kopf
+import os
+import threading
 import uuid
+import modules.metrics as metrics
+import modules.ratelimit as ratelimit
+
+#  ------------------------
+#           VARS
+#  ------------------------
+kube_client = {
+    "client": None,
+    "resources": {}
+}
+# { "client": DynamicClient, "resources": { (api_version, kind): Resource } }
+# Process-wide client, see kube_auth()
+
+kube_client_lock = threading.Lock()
+
+FIELD_MANAGER = "prism-server-operator"
+
+kube_client_stats = {
+    "client_builds": 0,
+    "discovery_calls": 0,
+    "discovery_avoided": 0,
+    "auth_refreshes": 0
+}
+
+#  ------------------------
+#         FUNCTIONS
+#  ------------------------
+def env_int(name, default):
+    """ Read an integer from the environment, falling back to a default """
+
+    value = os.environ.get(name)
+    if value is None or value == "":
+        return default
+
+    return int(value)
+
+def env_float(name, default):
+    """ Read a float from the environment, falling back to a default """
+
+    value = os.environ.get(name)
+    if value is None or value == "":
+        return default
+
+    return float(value)
+
+def build_kube_client():
+    """ Build a new dynamic client with a pooled, token-refreshing connection
+
+    Returns:
+        DynamicClient: Freshly built client (runs API discovery)
+    """
+
+    configuration = kubernetes.client.Configuration()
+
+    try:
+        # Re-reads the rotated service account token before it expires
+        kubernetes.config.load_incluster_config(client_configuration=configuration, try_refresh_token=True)
+    except kubernetes.config.ConfigException:
+        # Not running in a pod (e.g. local development or benchmarks)
+        kubernetes.config.load_kube_config(client_configuration=configuration)
+
+    configuration.connection_pool_maxsize = env_int("KUBE_CONNECTION_POOL_SIZE", 16)
+
+    k8s_client = kubernetes.client.ApiClient(configuration)
+
+    kube_client_stats["client_builds"] += 1
+    kube_client_stats["discovery_calls"] += 1
+
+    return DynamicClient(k8s_client)
 
 def kube_auth():
-    """ Authenticate against an oc cluster """
-    
+    """ Authenticate against an oc cluster
+
+    Returns the process-wide dynamic client, building it on first use.
+    """
+
     try:
-        kubernetes.config.load_incluster_config()
-        k8s_client = kubernetes.client.ApiClient()
-        return DynamicClient(k8s_client)
+        client = kube_client["client"]
+        if client is not None:
+            return client
+
+        with kube_client_lock:
+            if kube_client["client"] is None:
+                kube_client["client"] = build_kube_client()
+                kube_client["resources"] = {}
+
+            return kube_client["client"]
 
     except Exception as e:
         raise kopf.PermanentError(f"Failed to create dynamic client: {str(e)}")
-    
+
+def reset_kube_client():
+    """ Drop the shared client and its resource handles, e.g. after the token was rejected """
+
+    with kube_client_lock:
+        kube_client["client"] = None
+        kube_client["resources"] = {}
+        kube_client_stats["auth_refreshes"] += 1
+
+def get_resource_api(kind, api_version="v1"):
+    """ Return a memoized resource handle of the shared client
+
+    Args:
+        kind (string): Resource kind
+        api_version (string): API version of the resource
+
+    Returns:
+        Resource: Dynamic client resource handle
+    """
+
+    key = (api_version, kind)
+
+    api = kube_client["resources"].get(key)
+    if api is not None:
+        kube_client_stats["discovery_avoided"] += 1
+        return api
+
+    client = kube_auth()
+    api = client.resources.get(api_version=api_version, kind=kind)
+    kube_client["resources"][key] = api
+
+    return api
+
+def kube_request(verb, kind, api_version="v1", **kwargs):
+    """ Issue a call against the shared dynamic client
+
+    Waits for a token of the shared rate limiter, see ratelimit.priority_for().
+    Retries once with a fresh client if the apiserver rejects our credentials.
+
+    Args:
+        verb (string): Resource method to call (get, create, patch, delete, ...)
+        kind (string): Resource kind
+        api_version (string): API version of the resource
+        kwargs: Passed to the resource method
+
+    Returns:
+        ResourceInstance: Response of the call
+    """
+
+    ratelimit.kube_bucket.acquire(ratelimit.priority_for(verb))
+    metrics.kube_api_calls.labels(verb, kind).inc()
+
+    try:
+        return getattr(get_resource_api(kind, api_version), verb)(**kwargs)
+    except Exception as e:
+        if getattr(e, "status", None) != 401:
+            raise
+
+    reset_kube_client()
+
+    return getattr(get_resource_api(kind, api_version), verb)(**kwargs)
+
 def patch_resource(name, body, kind="PrismServer", namespace="prism-servers", content_type="application/merge-patch+json"):
     """ Patch a kubernetes resource, defaults to "PrismServer"
 
@@ -27,24 +169,64 @@ def patch_resource(name, body, kind="PrismServer", namespace="prism-servers", co
         kind (string): Resource kind
         namespace (string): Namespace of the resource
         content_type (string): Content type to use for patching operation
+
+    Returns:
+        ResourceInstance: Patched object
     """
-    
-    client = kube_auth()
-    
-    prismserver_api = client.resources.get(api_version="v1", kind=kind)
-    prismserver_api.patch(
+
+    return kube_request(
+        "patch",
+        kind,
         namespace=namespace,
         name=name,
         body=body,
         content_type=content_type
     )
 
+def apply_resource(body, namespace="prism-servers"):
+    """ Create or update a kubernetes resource with server-side apply
+
+    Args:
+        body (dict): Full resource body
+        namespace (string): Namespace of the resource
+
+    Returns:
+        ResourceInstance: Applied object
+    """
+
+    return kube_request(
+        "server_side_apply",
+        body["kind"],
+        api_version=body["apiVersion"],
+        body=body,
+        name=body["metadata"]["name"],
+        namespace=namespace,
+        field_manager=FIELD_MANAGER,
+        force_conflicts=True
+    )
+
+def delete_resource(name, kind, api_version="v1", namespace="prism-servers"):
+    """ Delete a kubernetes resource, ignoring resources which are already gone
+
+    Args:
+        name (string): Name of the kubernetes resource (meta.name)
+        kind (string): Resource kind
+        api_version (string): API version of the resource
+        namespace (string): Namespace of the resource
+    """
+
+    try:
+        kube_request("delete", kind, api_version=api_version, name=name, namespace=namespace)
+    except Exception as e:
+        if getattr(e, "status", None) != 404:
+            raise
+
 def is_uuid(value):
     """ Validate if argument is an UUID """
-    
+
     try:
         uuid.UUID(str(value))
 
         return True
     except ValueError:
-        return False
\ No newline at end of file
+        return False
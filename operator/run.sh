@@ -1,8 +1,14 @@
 #!/bin/bash
+# Sharded replicas must not compete for kopf's peering lock
+EXTRA_ARGS=""
+if [ "${SHARDING_ENABLED}" = "true" ]; then
+    EXTRA_ARGS="--standalone"
+fi
+
 if [ -z ${ENV_NAMESPACE} ]; then
     echo "[i] Not running namespaced"
-    kopf run main.py --verbose --all-namespaces
+    kopf run main.py --verbose --all-namespaces $EXTRA_ARGS
 else
     echo "[i] Running in namespace: $ENV_NAMESPACE"
-    kopf run main.py --verbose --namespace $ENV_NAMESPACE
+    kopf run main.py --verbose --namespace $ENV_NAMESPACE $EXTRA_ARGS
 fi
\ No newline at end of file